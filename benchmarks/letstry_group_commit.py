@@ -0,0 +1,122 @@
+"""Compares vote throughput during bursts of concurrent votes on a guild
+database, with every vote committed on its own against votes committed
+together by the guild's write queue, for both pragma profiles.
+
+Run from the repository root:
+
+    python -m benchmarks.letstry_group_commit
+"""
+from asyncio import gather, run
+from collections import namedtuple
+from tempfile import TemporaryDirectory
+from pathlib import Path
+from time import perf_counter
+import math
+
+from buffedbot.extensions.letstry import (
+    LETSTRY_SCHEMA,
+    LetsTryBallot,
+    LetsTryBallotGame,
+    LetsTryBallotVotes,
+    LetsTryGame,
+)
+from buffedbot.extensions.sqlite import (
+    GROUP_COMMIT_MS_SETTING,
+    PRAGMA_PROFILES,
+    SLOW_QUERY_MS_SETTING,
+    GuildDatabases,
+    StatementStats,
+    apply_pragmas,
+    connect,
+)
+
+BURST_SIZES = (1, 10, 50)
+VOTES = 500
+GAMES = 10
+
+Guild = namedtuple("Guild", ["id"])
+
+
+async def create_ballot(db):
+    await LETSTRY_SCHEMA.upgrade(db)
+    games = await LetsTryGame.insert_many(
+        db,
+        [
+            LetsTryGame.from_partial({"name": f"Game {i}", "url": f"https://{i}/"})
+            for i in range(GAMES)
+        ],
+    )
+    ballot = LetsTryBallot.from_partial({"discord_thread_id": 1})
+    await ballot.insert(db)
+    await LetsTryBallotGame.insert_many(
+        db,
+        [
+            LetsTryBallotGame.from_partial(
+                {"ballot_id": ballot.ballot_id, "game_id": game.game_id}
+            )
+            for game in games
+        ],
+    )
+    ballot.staging = False
+    ballot.date_open = "2023-01-01 00:00:00"
+    ballot.date_close = "2999-01-01 00:00:00"
+    await ballot.update(db)
+    return ballot, games
+
+
+async def measure(directory, profile, window_ms, burst):
+    settings = {GROUP_COMMIT_MS_SETTING: window_ms, SLOW_QUERY_MS_SETTING: math.inf}
+
+    def get_setting(setting, default):
+        return settings.get(setting, default)
+
+    async def connect_guild_db(guild):
+        db = await connect(
+            Path(directory, f"{guild.id}.db"), StatementStats(get_setting)
+        )
+        await apply_pragmas(db, PRAGMA_PROFILES[profile])
+        return db
+
+    guild_dbs = GuildDatabases(connect_guild_db, get_setting)
+    db = guild_dbs.add(Guild(f"{profile}-{window_ms}-{burst}"))
+    try:
+        ballot, games = await create_ballot(db)
+        votes = [
+            LetsTryBallotVotes(
+                discord_user_id=i,
+                ballot_id=ballot.ballot_id,
+                game_id=games[i % len(games)].game_id,
+            )
+            for i in range(VOTES)
+        ]
+        start = perf_counter()
+        for i in range(0, VOTES, burst):
+            await gather(*[vote.cast(db) for vote in votes[i : i + burst]])
+        elapsed = perf_counter() - start
+        return VOTES / elapsed, db.write_queue.commits
+    finally:
+        await guild_dbs.close()
+
+
+async def main():
+    with TemporaryDirectory() as directory:
+        for profile in PRAGMA_PROFILES:
+            print(f"{profile} profile, {VOTES} votes")
+            for burst in BURST_SIZES:
+                for window_ms in (None, 0, 2):
+                    throughput, commits = await measure(
+                        directory, profile, window_ms, burst
+                    )
+                    name = (
+                        "commit each"
+                        if window_ms is None
+                        else f"grouped, {window_ms} ms"
+                    )
+                    print(
+                        f"  bursts of {burst:3} {name:14} {throughput:8.0f} votes/s "
+                        f"({commits or VOTES} commits)"
+                    )
+
+
+if __name__ == "__main__":
+    run(main())
@@ -0,0 +1,152 @@
+"""Compares round trips to the connection thread, and the time they take, for
+casting a vote and finalizing a ballot: one await per statement, fetch and
+commit (as the commands used to do), against running the whole operation in
+the connection thread with run_sync_transaction.
+
+Run from the repository root:
+
+    python -m benchmarks.letstry_round_trips
+"""
+from asyncio import run
+from pathlib import Path
+from time import perf_counter
+from unittest import mock
+import aiosqlite
+
+from buffedbot.extensions.letstry import (
+    LetsTryBallot,
+    LetsTryBallotGame,
+    LetsTryBallotVotes,
+    LetsTryGame,
+)
+from buffedbot.extensions.sqlite import transaction
+
+VOTES = 2000
+GAMES = 10
+BALLOTS = 200
+
+SQL_DIR = Path(__file__).parent.parent / "buffedbot" / "extensions" / "letstry" / "sql"
+
+
+async def create_db():
+    db = await aiosqlite.connect(":memory:")
+    await db.executescript((SQL_DIR / "bootstrap.sql").read_text())
+    version = 0
+    while (migration := SQL_DIR / f"migrate_from_v{version}.sql").exists():
+        await db.executescript(f"BEGIN ; {migration.read_text()}")
+        version += 1
+        await db.execute("INSERT INTO letstry_versions VALUES (?)", (version,))
+        await db.commit()
+
+    games = await LetsTryGame.insert_many(
+        db,
+        [
+            LetsTryGame.from_partial({"name": f"Game {i}", "url": f"https://{i}/"})
+            for i in range(GAMES)
+        ],
+    )
+    ballots = []
+    for i in range(BALLOTS):
+        ballot = LetsTryBallot.from_partial({"discord_thread_id": i})
+        await ballot.insert(db)
+        await LetsTryBallotGame.insert_many(
+            db,
+            [
+                LetsTryBallotGame.from_partial(
+                    {"ballot_id": ballot.ballot_id, "game_id": game.game_id}
+                )
+                for game in games
+            ],
+        )
+        ballot.staging = False
+        ballot.date_open = "2023-01-01 00:00:00"
+        await ballot.update(db)
+        await ballot.refresh(db)
+        ballots.append(ballot)
+    return db, games, ballots
+
+
+def make_votes(ballots, games, offset):
+    return [
+        LetsTryBallotVotes(
+            discord_user_id=offset + i,
+            ballot_id=ballots[i % len(ballots)].ballot_id,
+            game_id=games[i % len(games)].game_id,
+        )
+        for i in range(VOTES)
+    ]
+
+
+async def cast_per_statement(db, vote):
+    await vote.insert(db)
+    async with LetsTryBallotGame.join_select(
+        db, "game_id", {"ballot_id": vote.ballot_id}, readonly=True
+    ) as cursor:
+        return await cursor.fetchall()
+
+
+async def cast_in_thread(db, vote):
+    return await vote.cast(db)
+
+
+async def finalize_per_statement(db, ballot):
+    async with transaction(db):
+        ballot.finalized = True
+        await ballot.update(db)
+        async with LetsTryBallotGame.join_select(
+            db, "game_id", ballot.primary_key_match(), readonly=True
+        ) as cursor:
+            return await cursor.fetchall()
+
+
+async def finalize_in_thread(db, ballot):
+    return await ballot.finalize(db)
+
+
+async def measure(name, db, operation, rows):
+    round_trips = 0
+    execute = db._execute
+
+    async def counted(fn, *args, **kwargs):
+        nonlocal round_trips
+        round_trips += 1
+        return await execute(fn, *args, **kwargs)
+
+    with mock.patch.object(db, "_execute", counted):
+        start = perf_counter()
+        for row in rows:
+            await operation(db, row)
+        elapsed = perf_counter() - start
+    print(
+        f"  {name:24} {round_trips / len(rows):5.1f} round trips "
+        f"{elapsed / len(rows) * 1e6:8.1f} µs/operation"
+    )
+
+
+async def main():
+    db, games, ballots = await create_db()
+    try:
+        print(f"Casting {VOTES} votes")
+        await measure(
+            "per statement", db, cast_per_statement, make_votes(ballots, games, 0)
+        )
+        await measure(
+            "run_sync_transaction",
+            db,
+            cast_in_thread,
+            make_votes(ballots, games, VOTES),
+        )
+
+        # Finalizing needs ballots that are no longer open
+        await db.execute("UPDATE letstry_ballots SET date_close = date_open")
+        await db.commit()
+        half = len(ballots) // 2
+        print(f"Finalizing {half} ballots each")
+        await measure("per statement", db, finalize_per_statement, ballots[:half])
+        await measure("run_sync_transaction", db, finalize_in_thread, ballots[half:])
+    finally:
+        await db.close()
+
+
+if __name__ == "__main__":
+    run(main())
@@ -0,0 +1,149 @@
+"""Compares the time the letstry cog spends bootstrapping guild databases on
+startup: running the full bootstrap script and migration probes for every
+guild (as cog_load used to), the version-gated fast path for every guild,
+and the lazy cog_load, which bootstraps nothing until a guild is accessed.
+
+The synthetic guild databases are copies of a database at the current schema
+version, which is the common case on a restart.
+
+Run from the repository root:
+
+    python -m benchmarks.letstry_startup
+"""
+from asyncio import Semaphore, gather, run
+from collections import namedtuple
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from time import perf_counter
+from types import SimpleNamespace
+import shutil
+import sqlite3
+
+from buffedbot.extensions.letstry import LetsTry
+from buffedbot.extensions.sqlite import GuildDatabases, StatementStats, connect
+
+GUILD_COUNTS = (1000, 10000)
+CONCURRENCY = 64
+ITERATIONS = 1000
+
+SQL_DIR = Path(__file__).parent.parent / "buffedbot" / "extensions" / "letstry" / "sql"
+
+Guild = namedtuple("Guild", ["id"])
+
+
+def create_template(path):
+    db = sqlite3.connect(path)
+    # Small pages keep 10k copies of the database small
+    db.execute("PRAGMA page_size = 512")
+    db.executescript((SQL_DIR / "bootstrap.sql").read_text())
+    version = 0
+    while (migration := SQL_DIR / f"migrate_from_v{version}.sql").exists():
+        db.executescript(f"BEGIN ; {migration.read_text()}")
+        version += 1
+        db.execute("INSERT INTO letstry_versions VALUES (?)", (version,))
+        db.commit()
+    db.execute("VACUUM")
+    db.close()
+
+
+def create_letstry(directory, guilds):
+    # Bootstrapping 10k databases at once is slow; keep it out of the log
+    stats = StatementStats(lambda setting, default: float("inf"))
+
+    async def connect_guild_db(guild):
+        return await connect(directory / f"{guild.id}.db", stats)
+
+    guild_dbs = GuildDatabases(
+        connect_guild_db,
+        lambda setting, default: CONCURRENCY,
+    )
+    for guild in guilds:
+        guild_dbs.add(guild)
+    sqlite = SimpleNamespace(get_guild_db=lambda guild: guild_dbs[guild.id])
+    bot = SimpleNamespace(guilds=guilds, get_cog=lambda name: sqlite)
+    return LetsTry(bot), guild_dbs
+
+
+async def for_each_guild(guilds, coro):
+    # Bounded, so that the connection limit holds
+    semaphore = Semaphore(CONCURRENCY)
+
+    async def run_one(guild):
+        async with semaphore:
+            await coro(guild)
+
+    await gather(*[run_one(guild) for guild in guilds])
+
+
+async def measure(directory, guilds, name, coro):
+    letstry, guild_dbs = create_letstry(directory, guilds)
+    try:
+        start = perf_counter()
+        await coro(letstry)
+        elapsed = perf_counter() - start
+    finally:
+        await guild_dbs.close()
+    print(
+        f"    {name:14} {elapsed:8.3f} s {elapsed / len(guilds) * 1e6:10.1f} µs/guild"
+    )
+
+
+async def measure_open_db(directory, guild):
+    # Without the cost of opening the connection
+    letstry, guild_dbs = create_letstry(directory, [guild])
+    try:
+        for name, coro in [
+            ("full", letstry.bootstrap_db_full),
+            ("version-gated", letstry.is_guild_db_current),
+        ]:
+            await coro(guild)
+            start = perf_counter()
+            for _ in range(ITERATIONS):
+                await coro(guild)
+            elapsed = perf_counter() - start
+            print(f"    {name:14} {elapsed / ITERATIONS * 1e6:10.1f} µs/guild")
+    finally:
+        await guild_dbs.close()
+
+
+async def main():
+    with TemporaryDirectory() as directory:
+        directory = Path(directory)
+        template = directory / "template.db"
+        create_template(template)
+        shutil.copyfile(template, directory / "0.db")
+        print("  1 open database")
+        await measure_open_db(directory, Guild(0))
+
+        for count in GUILD_COUNTS:
+            guilds = [Guild(id) for id in range(count)]
+            for guild in guilds:
+                path = directory / f"{guild.id}.db"
+                if not path.exists():
+                    shutil.copyfile(template, path)
+
+            print(f"  {count} guilds")
+            await measure(
+                directory,
+                guilds,
+                "full",
+                lambda letstry: for_each_guild(guilds, letstry.bootstrap_db_full),
+            )
+            await measure(
+                directory,
+                guilds,
+                "version-gated",
+                lambda letstry: for_each_guild(guilds, letstry.ensure_guild_db),
+            )
+            await measure(
+                directory,
+                guilds,
+                "lazy",
+                # cog_load bootstraps nothing, so only the first guild accessed
+                # pays for its bootstrap
+                lambda letstry: letstry.ensure_guild_db(guilds[0]),
+            )
+
+
+if __name__ == "__main__":
+    run(main())
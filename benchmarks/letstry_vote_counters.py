@@ -0,0 +1,92 @@
+"""Compares vote insert throughput of the recounting vote triggers (v2
+schema) and the incremental vote counters (v3 schema).
+
+The recounting triggers count all votes of the ballot on every vote, so
+their throughput drops as the ballot fills up. Each schema gets the same
+time budget; the recounting triggers usually run out of it long before all
+votes are in.
+
+Run from the repository root:
+
+    python -m benchmarks.letstry_vote_counters
+"""
+from pathlib import Path
+from time import perf_counter
+import sqlite3
+
+VOTE_COUNT = 100000
+GAME_COUNT = 10
+BATCH_SIZE = 10000
+TIME_BUDGET = 30.0
+
+SQL_DIR = Path(__file__).parent.parent / "buffedbot" / "extensions" / "letstry" / "sql"
+
+
+def create_db(version):
+    db = sqlite3.connect(":memory:")
+    db.executescript((SQL_DIR / "bootstrap.sql").read_text())
+    for v in range(version):
+        db.executescript(f"BEGIN ; {(SQL_DIR / f'migrate_from_v{v}.sql').read_text()}")
+        db.execute("INSERT INTO letstry_versions VALUES (?)", (v + 1,))
+        db.commit()
+
+    db.execute(
+        """
+        INSERT INTO letstry_ballots (ballot_id, discord_thread_id, date_open, staging)
+        VALUES (1, 1, '2023-01-01 00:00:00', FALSE)
+        """
+    )
+    db.executemany(
+        "INSERT INTO letstry_games (game_id, name, url) VALUES (?, ?, ?)",
+        [(i, f"Game {i}", f"https://{i}/") for i in range(GAME_COUNT)],
+    )
+    db.executemany(
+        "INSERT INTO letstry_ballot_games (ballot_id, game_id) VALUES (1, ?)",
+        [(i,) for i in range(GAME_COUNT)],
+    )
+    db.commit()
+    return db
+
+
+def measure(db):
+    inserted = 0
+    elapsed = 0.0
+    while inserted < VOTE_COUNT and elapsed < TIME_BUDGET:
+        votes = [
+            (user_id, user_id % GAME_COUNT)
+            for user_id in range(inserted, min(inserted + BATCH_SIZE, VOTE_COUNT))
+        ]
+        start = perf_counter()
+        db.executemany(
+            """
+            INSERT INTO letstry_ballot_votes (ballot_id, discord_user_id, game_id)
+            VALUES (1, ?, ?)
+            """,
+            votes,
+        )
+        db.commit()
+        batch_elapsed = perf_counter() - start
+        elapsed += batch_elapsed
+        inserted += len(votes)
+        print(
+            f"    {inserted:7} votes {len(votes) / batch_elapsed:12.0f} votes/s (batch)"
+        )
+
+    (total,) = db.execute("SELECT SUM(votes) FROM letstry_ballot_games").fetchone()
+    assert total == inserted
+    return inserted, elapsed
+
+
+def main():
+    print(f"Inserting up to {VOTE_COUNT} votes for {GAME_COUNT} games")
+    for name, version in [("recount", 2), ("incremental", 3)]:
+        print(f"  {name}")
+        inserted, elapsed = measure(create_db(version))
+        print(
+            f"  {name:12} {inserted:7} votes in {elapsed:6.2f} s, "
+            f"{inserted / elapsed:10.0f} votes/s"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+"""Compares CPU time and memory of hydrating sqldatarow rows.
+
+"legacy" emulates the previous hydration path: a dict-backed dataclass built
+through keyword arguments and __init__ with change tracking. "tracked" and
+"read-only" use the positional from_row hydration of the slotted row classes.
+
+Run from the repository root:
+
+    python -m benchmarks.sqldatarow_hydration
+"""
+from dataclasses import dataclass
+from time import perf_counter
+import gc
+import tracemalloc
+
+from buffedbot.extensions.letstry import GameState, LetsTryGame, sqldatarow
+
+ROW_COUNT = 10000
+
+
+@sqldatarow("letstry_games")
+@dataclass
+class DictLetsTryGame:
+    game_id: int
+    name: str
+    url: str
+    state: GameState
+
+
+def legacy_from_row(cursor, row):
+    data = {k: v for k, v in zip(DictLetsTryGame.column_names, row)}
+    game = DictLetsTryGame(**data)
+    # Rows used to allocate their own change set
+    object.__setattr__(game, "_changed", set())
+    return game
+
+
+def make_rows():
+    return [
+        (i, f"Game {i}", f"https://store.steampowered.com/app/{i}/", "submitted")
+        for i in range(ROW_COUNT)
+    ]
+
+
+def measure(from_row, rows):
+    gc.collect()
+    start = perf_counter()
+    hydrated = [from_row(None, row) for row in rows]
+    elapsed = perf_counter() - start
+    del hydrated
+
+    gc.collect()
+    tracemalloc.start()
+    hydrated = [from_row(None, row) for row in rows]
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del hydrated
+    return elapsed, peak
+
+
+def main():
+    rows = make_rows()
+    print(f"Hydrating {ROW_COUNT} rows")
+    for name, from_row in [
+        ("legacy", legacy_from_row),
+        ("tracked", LetsTryGame.from_row),
+        ("read-only", LetsTryGame.ReadOnly.from_row),
+    ]:
+        elapsed, peak = measure(from_row, rows)
+        print(
+            f"  {name:10} {elapsed * 1e3:8.2f} ms {peak / 1024:10.1f} KiB peak memory"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,49 @@
+"""Compares sqldatarow statement build times with and without the statement cache.
+
+Run from the repository root:
+
+    python -m benchmarks.sqldatarow_statements
+"""
+from timeit import timeit
+from buffedbot.extensions.letstry import (
+    LetsTryBallot,
+    LetsTryBallotGame,
+    LetsTryGame,
+)
+
+ITERATIONS = 20000
+
+
+def build_statements():
+    LetsTryGame.select_stmt(("name", "url"))
+    LetsTryGame.exists_stmt(("name",))
+    LetsTryGame.update_stmt(("game_id",), {"state"})
+    LetsTryGame.delete_stmt(("game_id",))
+    LetsTryBallot.select_stmt(("discord_thread_id",))
+    LetsTryBallotGame.join_select_stmt("game_id", ("ballot_id",))
+    LetsTryGame.from_partial({"name": "name", "url": "url"}).insert_stmt()
+
+
+def clear_statement_caches():
+    for cls in (LetsTryBallot, LetsTryBallotGame, LetsTryGame):
+        cls._statement_cache.clear()
+
+
+def uncached():
+    clear_statement_caches()
+    build_statements()
+
+
+def main():
+    before = timeit(uncached, number=ITERATIONS)
+    build_statements()
+    after = timeit(build_statements, number=ITERATIONS)
+
+    print(f"{ITERATIONS} iterations of {build_statements.__name__}")
+    print(f"  uncached: {before * 1e6 / ITERATIONS:8.2f} us/iteration")
+    print(f"  cached:   {after * 1e6 / ITERATIONS:8.2f} us/iteration")
+    print(f"  speedup:  {before / after:8.2f}x")
+
+
+if __name__ == "__main__":
+    main()
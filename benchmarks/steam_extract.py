@@ -0,0 +1,59 @@
+"""Compares the CPU time and peak memory of reading Steam store pages with
+the extraction engines: parsing the whole page into a BeautifulSoup tree and
+querying it (soup), against the single-pass parsers of extract.py (stream).
+
+The pages are the saved fixtures of the steam tests: a game's store page
+and a search results page.
+
+Run from the repository root:
+
+    python -m benchmarks.steam_extract
+"""
+from pathlib import Path
+from time import process_time
+import tracemalloc
+
+from buffedbot.extensions.steam.steam import EXTRACTORS, MAX_SEARCH_RESULTS
+
+ITERATIONS = 20
+
+FIXTURES_DIR = (
+    Path(__file__).parent.parent / "buffedbot" / "extensions" / "__tests__" / "fixtures"
+)
+
+
+def measure(name, extract, markup):
+    start = process_time()
+    for _ in range(ITERATIONS):
+        extract(markup)
+    elapsed = (process_time() - start) / ITERATIONS
+
+    tracemalloc.start()
+    extract(markup)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"  {name:8} {elapsed * 1000:8.2f} ms CPU {peak / 1024 / 1024:8.2f} MiB peak")
+
+
+def main():
+    pages = [
+        (
+            "steam_app.html",
+            lambda extractor: extractor.get_game_fields,
+        ),
+        (
+            "steam_search.html",
+            lambda extractor: lambda markup: extractor.get_search_results(
+                markup, MAX_SEARCH_RESULTS
+            ),
+        ),
+    ]
+    for filename, get_extract in pages:
+        markup = (FIXTURES_DIR / filename).read_bytes()
+        print(f"{filename} ({len(markup) / 1024:.0f} KiB)")
+        for name, extractor in EXTRACTORS.items():
+            measure(name, get_extract(extractor), markup)
+
+
+if __name__ == "__main__":
+    main()
@@ -24,3 +24,8 @@ class ElementNotFoundError(RuntimeError):
 
 class AttributeNotFoundError(RuntimeError):
     pass
+
+
+class SteamBusyError(RuntimeError):
+    def __str__(self):
+        return "Too many Steam lookups at once, please try again in a moment."
@@ -1,4 +1,15 @@
-from buffedbot.extensions.letstry import LetsTry, LetsTryProposal
+from buffedbot.extensions.letstry import (
+    get_row_cache,
+    LetsTry,
+    LetsTryProposal,
+    LetsTryGame,
+    LetsTryBallot,
+    LetsTryBallotGame,
+    LetsTryBallotVotes,
+    CLOSED_BALLOTS_CONDITION,
+)
+from buffedbot.extensions.letstry.merge import merge
+from buffedbot.extensions.sqlite import TenantDatabases, get_changes
 from buffedbot.extensions.steam import Game as SteamGame
 from discord.ext import commands
 import unittest.mock as mock
@@ -6,6 +17,8 @@ from pytimeparse import parse as timeparse
 from datetime import datetime, timedelta, timezone
 
 import aiosqlite
+import sqlite3
+from pathlib import Path
 import pytest
 import pytest_asyncio
 import dataclasses
@@ -100,9 +113,10 @@ def steam_game(request, default_game_name, default_game_url):
 
 
 @pytest_asyncio.fixture
-async def letstry(mock_guild_db, mock_bot, steam_game, mock_settings):
+async def letstry(mock_guild_db, mock_bot, steam_game, mock_settings, default_guild):
     letstry = LetsTry(mock_bot)
     await letstry.cog_load()
+    await letstry.ensure_guild_db(default_guild)
     with mock.patch.object(letstry, "get_steam_game", return_value=steam_game):
         yield letstry
     await letstry.cog_unload()
@@ -269,6 +283,7 @@ async def added_rejected_game(
     await test_db.execute(
         game.update_stmt(where.keys()), where | dataclasses.asdict(game)
     )
+    await test_db.commit()
     return game
 
 
@@ -924,3 +939,459 @@ async def test_finalize_ballots(
     assert_called_with_game_embed(
         default_guild_context.reply, 0, default_game_name, mock.ANY, "elected"
     )
+
+
+def test_statement_cache():
+    where = ("name", "url")
+    assert LetsTryGame.select_stmt(where) is LetsTryGame.select_stmt(list(where))
+    assert LetsTryGame.select_stmt(where) is not LetsTryGame.select_stmt(
+        where, logic="AND"
+    )
+    assert LetsTryGame.update_stmt(("game_id",), {"state"}) is LetsTryGame.update_stmt(
+        ("game_id",), ["state"]
+    )
+    assert LetsTryBallotGame.join_select_stmt(
+        "game_id", ("ballot_id",)
+    ) is LetsTryBallotGame.join_select_stmt("game_id", ["ballot_id"])
+
+
+def test_from_row():
+    row = (1, "A buffed game", "http://www.boldlyunbuffed.com", "submitted")
+    game = LetsTryGame.from_row(None, row)
+    assert dataclasses.astuple(game) == row
+    assert not game.changed
+    game.state = "accepted"
+    assert game.changed
+
+    readonly_game = LetsTryGame.ReadOnly.from_row(None, row)
+    assert isinstance(readonly_game, LetsTryGame)
+    assert dataclasses.astuple(readonly_game) == row
+    assert readonly_game.primary_key_match() == {"game_id": 1}
+    with pytest.raises(dataclasses.FrozenInstanceError):
+        readonly_game.state = "accepted"
+
+
+@pytest.mark.asyncio
+async def test_bulk_rows(letstry, test_db):
+    games = await LetsTryGame.insert_many(
+        test_db,
+        [
+            LetsTryGame.from_partial({"name": f"Game {i}", "url": f"https://{i}/"})
+            for i in range(5)
+        ],
+    )
+    assert all(game.game_id is not None for game in games)
+    assert len({game.game_id for game in games}) == 5
+
+    for game in games[:3]:
+        game.state = "accepted"
+    assert await LetsTryGame.update_many(test_db, games) == 3
+
+    async with LetsTryGame.select(test_db, {"state": "accepted"}) as cursor:
+        accepted = [game async for game in cursor]
+    assert {game.game_id for game in accepted} == {game.game_id for game in games[:3]}
+
+    assert await LetsTryGame.delete_many(test_db, games[1:]) == 4
+    async with test_db.execute("SELECT COUNT(*) FROM letstry_games") as cursor:
+        assert await cursor.fetchone() == (1,)
+
+    # A failing row rolls back the whole batch
+    duplicates = [
+        LetsTryGame.from_partial({"name": "New game", "url": "https://new/"}),
+        LetsTryGame.from_partial({"name": games[0].name, "url": games[0].url}),
+    ]
+    with pytest.raises(aiosqlite.IntegrityError):
+        await LetsTryGame.insert_many(test_db, duplicates)
+    async with test_db.execute("SELECT COUNT(*) FROM letstry_games") as cursor:
+        assert await cursor.fetchone() == (1,)
+
+
+@pytest.mark.asyncio
+async def test_games_list_pages(
+    letstry,
+    test_db,
+    invoke_command,
+    default_guild_context,
+    default_member,
+    click_button,
+):
+    await LetsTryGame.insert_many(
+        test_db,
+        [
+            LetsTryGame.from_partial({"name": f"Game {i}", "url": f"https://{i}/"})
+            for i in range(25)
+        ],
+    )
+
+    def titles(embeds):
+        return [e.title for e in embeds]
+
+    await invoke_command(letstry, "letstry games list", default_guild_context)
+    reply = default_guild_context.reply
+    assert titles(reply.call_args.kwargs["embeds"]) == [f"Game {i}" for i in range(10)]
+
+    interaction = await click_button(default_member, reply, "Next")
+    embeds = interaction.response.edit_message.call_args.kwargs["embeds"]
+    assert titles(embeds) == [f"Game {i}" for i in range(10, 20)]
+
+    interaction = await click_button(default_member, reply, "Next")
+    embeds = interaction.response.edit_message.call_args.kwargs["embeds"]
+    assert titles(embeds) == [f"Game {i}" for i in range(20, 25)]
+    view = interaction.response.edit_message.call_args.kwargs["view"]
+    assert view.next_button.disabled
+
+    interaction = await click_button(default_member, reply, "Previous")
+    embeds = interaction.response.edit_message.call_args.kwargs["embeds"]
+    assert titles(embeds) == [f"Game {i}" for i in range(10, 20)]
+
+    interaction = await click_button(default_member, reply, "Previous")
+    embeds = interaction.response.edit_message.call_args.kwargs["embeds"]
+    assert titles(embeds) == [f"Game {i}" for i in range(10)]
+    assert view.previous_button.disabled
+
+    pages = [
+        page
+        async for page in LetsTryGame.select_pages(
+            test_db, {"state": "submitted"}, page_size=7
+        )
+    ]
+    assert [len(page) for page in pages] == [7, 7, 7, 4]
+
+
+@pytest.mark.asyncio
+async def test_eager_load(letstry, test_db):
+    games = await LetsTryGame.insert_many(
+        test_db,
+        [
+            LetsTryGame.from_partial({"name": f"Game {i}", "url": f"https://{i}/"})
+            for i in range(4)
+        ],
+    )
+    ballots = await LetsTryBallot.insert_many(
+        test_db,
+        [LetsTryBallot.from_partial({"discord_thread_id": i}) for i in range(3)],
+    )
+    await LetsTryBallotGame.insert_many(
+        test_db,
+        [
+            LetsTryBallotGame.from_partial(
+                {"ballot_id": ballot.ballot_id, "game_id": game.game_id}
+            )
+            for ballot, game in [
+                (ballots[0], games[0]),
+                (ballots[0], games[1]),
+                (ballots[1], games[2]),
+            ]
+        ],
+    )
+
+    with mock.patch.object(test_db, "execute", wraps=test_db.execute) as execute:
+        loaded = await LetsTryBallotGame.eager_load(
+            test_db, "ballot_id", ballots, ("ballot_id", "game_id"), readonly=True
+        )
+        execute.assert_called_once()
+
+    def names(ballot):
+        return {game.name for _, _, game in loaded[ballot.ballot_id]}
+
+    assert names(ballots[0]) == {"Game 0", "Game 1"}
+    assert names(ballots[1]) == {"Game 2"}
+    assert names(ballots[2]) == set()
+    for ballot_game, ballot, game in loaded[ballots[0].ballot_id]:
+        assert ballot.discord_thread_id == 0
+        assert ballot.state == "staging"
+        assert ballot_game.game_id == game.game_id
+
+    edges = await LetsTryBallotGame.eager_load(test_db, "game_id", games)
+    assert [len(edges[game.game_id]) for game in games] == [1, 1, 1, 0]
+
+
+@pytest.mark.asyncio
+async def test_row_cache(letstry, test_db, default_guild, added_default_game):
+    async def select_game(where):
+        with mock.patch.object(test_db, "execute", wraps=test_db.execute) as execute:
+            game = await LetsTryGame.select_fetchone(test_db, where)
+            return game, execute.call_count
+
+    where = {"name": added_default_game.name}
+    game, queries = await select_game(where)
+    assert queries == 0
+    assert game == added_default_game
+    assert game is not added_default_game
+
+    # Cached under the primary key and other unique columns, too
+    game, queries = await select_game({"url": added_default_game.url})
+    assert queries == 0
+    game, queries = await select_game(game.primary_key_match())
+    assert queries == 0
+
+    # Writes to tables whose triggers update cached tables invalidate the cache
+    await letstry.add_proposal(default_guild, mock.Mock(id=1), game.game_id)
+    game, queries = await select_game(where)
+    assert queries == 1
+    game, queries = await select_game(where)
+    assert queries == 0
+
+    # As do writes to the table itself
+    game.state = "accepted"
+    await game.update(test_db)
+    game, queries = await select_game(where)
+    assert queries == 1
+    assert game.state == "accepted"
+
+    # And changes by other connections, which may have touched any table
+    get_changes(test_db).publish(None)
+    game, queries = await select_game(where)
+    assert queries == 1
+
+
+@pytest.mark.asyncio
+async def test_row_cache_ballot_expiry(letstry, test_db):
+    ballot = LetsTryBallot.from_partial(
+        {"discord_thread_id": 1, "date_open": "2023-01-01 00:00:00"}
+    )
+    await ballot.insert(test_db)
+    where = {"discord_thread_id": 1}
+    ballot = await LetsTryBallot.select_fetchone(test_db, where)
+    assert ballot.state == "staging"
+
+    # Ballots expire from the cache when they open or close
+    now = datetime.now(tz=timezone.utc)
+    key = LetsTryBallot.cache_key(where)
+    row_cache = get_row_cache(test_db)
+    assert row_cache.get("letstry_ballots", key) is not None
+    with mock.patch("time.time", return_value=now.timestamp() + timeparse("4 days")):
+        assert row_cache.get("letstry_ballots", key) is None
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "sql,index_name",
+    [
+        # Vote count triggers
+        (
+            "SELECT COUNT(*) FROM letstry_ballot_votes WHERE game_id = 1 AND ballot_id = 1",
+            "letstry_ballot_votes_ballot_game",
+        ),
+        (
+            "UPDATE letstry_ballot_games SET votes = 0 WHERE ballot_id = 1",
+            "letstry_ballot_games_ballot_votes",
+        ),
+        # Proposal state triggers
+        (
+            "SELECT COUNT(*) FROM letstry_proposals WHERE game_id = 1",
+            "letstry_proposals_game",
+        ),
+        # Electing the winner of a finalized ballot
+        (
+            """SELECT game_id FROM letstry_ballot_games WHERE ballot_id = 1
+               ORDER BY votes DESC LIMIT 1""",
+            "letstry_ballot_games_ballot_votes",
+        ),
+        # finalize_guild_ballots
+        (
+            LetsTryBallot.select_stmt(condition=CLOSED_BALLOTS_CONDITION),
+            "letstry_ballots_finalized_staging_close",
+        ),
+    ],
+)
+async def test_hot_statements_use_indexes(letstry, test_db, sql, index_name):
+    async with test_db.execute(f"EXPLAIN QUERY PLAN {sql}") as cursor:
+        plan = [detail for *_, detail in await cursor.fetchall()]
+
+    assert any(index_name in detail for detail in plan), plan
+    assert not any(detail.startswith("SCAN") for detail in plan), plan
+    assert not any("TEMP B-TREE" in detail for detail in plan), plan
+
+
+@pytest.mark.asyncio
+async def test_vote_counters(letstry, test_db):
+    games = await LetsTryGame.insert_many(
+        test_db,
+        [
+            LetsTryGame.from_partial({"name": f"Game {i}", "url": f"https://{i}/"})
+            for i in range(2)
+        ],
+    )
+    ballot = LetsTryBallot.from_partial({"discord_thread_id": 1})
+    await ballot.insert(test_db)
+    await LetsTryBallotGame.insert_many(
+        test_db,
+        [
+            LetsTryBallotGame.from_partial(
+                {"ballot_id": ballot.ballot_id, "game_id": game.game_id}
+            )
+            for game in games
+        ],
+    )
+    ballot.staging = False
+    ballot.date_open = "2023-01-01 00:00:00"
+    await ballot.update(test_db)
+
+    votes = await LetsTryBallotVotes.insert_many(
+        test_db,
+        [
+            LetsTryBallotVotes(
+                discord_user_id=user_id,
+                ballot_id=ballot.ballot_id,
+                game_id=games[user_id % 2].game_id,
+            )
+            for user_id in range(5)
+        ],
+    )
+    # Only deletes the vote matching the whole composite primary key
+    assert await votes[0].delete(test_db) == 1
+
+    async def vote_counts():
+        async with test_db.execute(
+            "SELECT game_id, votes FROM letstry_ballot_games ORDER BY game_id"
+        ) as cursor:
+            return [votes for _, votes in await cursor.fetchall()]
+
+    assert await vote_counts() == [2, 2]
+
+    await test_db.execute("UPDATE letstry_ballot_games SET votes = 7")
+    await test_db.commit()
+    assert await LetsTryBallotGame.recount_votes(test_db) == 2
+    assert await vote_counts() == [2, 2]
+    assert await LetsTryBallotGame.recount_votes(test_db) == 0
+
+    # Casting a vote returns the updated counts in the same round trip
+    vote = LetsTryBallotVotes(
+        discord_user_id=10, ballot_id=ballot.ballot_id, game_id=games[0].game_id
+    )
+    ballot_games = await vote.cast(test_db)
+    assert sorted((game.name, edge.votes) for edge, game in ballot_games) == [
+        ("Game 0", 3),
+        ("Game 1", 2),
+    ]
+    assert not test_db.in_transaction
+    with pytest.raises(aiosqlite.IntegrityError):
+        await vote.cast(test_db)
+    assert await vote_counts() == [3, 2]
+
+
+@pytest.mark.asyncio
+async def test_lazy_bootstrap(
+    mock_guild_db, test_db, mock_bot, mock_settings, default_guild_context
+):
+    letstry = LetsTry(mock_bot)
+    guild = default_guild_context.guild
+    assert not await letstry.is_guild_db_current(guild)
+
+    # The first command of a guild bootstraps its database
+    assert await letstry.cog_check(default_guild_context)
+    assert await letstry.is_guild_db_current(guild)
+    assert guild.id in letstry.guild_bootstraps
+
+    # Current databases skip the bootstrap script
+    letstry = LetsTry(mock_bot)
+    with mock.patch.object(test_db, "executescript") as executescript:
+        await letstry.ensure_guild_db(guild)
+        await letstry.ensure_guild_db(guild)
+    executescript.assert_not_called()
+
+    await letstry.on_guild_remove(guild)
+    assert guild.id not in letstry.guild_bootstraps
+
+
+@pytest_asyncio.fixture
+async def consolidated_letstry(mock_bot, default_guild, other_guild):
+    async with aiosqlite.connect(":memory:") as con:
+        tenant_dbs = TenantDatabases(con)
+        for guild in (default_guild, other_guild):
+            tenant_dbs.add(guild)
+        letstry = LetsTry(mock_bot)
+        with mock.patch.object(
+            letstry, "get_guild_db", side_effect=lambda guild: tenant_dbs[guild.id]
+        ):
+            await letstry.bootstrap_guild(default_guild)
+            await letstry.bootstrap_guild(other_guild)
+            yield letstry
+
+
+@pytest.mark.asyncio
+async def test_consolidated_storage(consolidated_letstry, default_guild, other_guild):
+    letstry = consolidated_letstry
+    # Names are only unique per guild
+    for guild in (default_guild, other_guild):
+        await letstry.add_game(guild, "A buffed game", "https://buffed.game/")
+        await letstry.add_game(guild, f"Game of {guild.id}", f"https://{guild.id}/")
+
+    default_game = await letstry.get_game(default_guild, "A buffed game")
+    other_game = await letstry.get_game(other_guild, "A buffed game")
+    assert default_game.game_id != other_game.game_id
+    assert await letstry.get_game(default_guild, f"Game of {other_guild.id}") is None
+
+    default_db = letstry.get_guild_db(default_guild)
+    page = await LetsTryGame.select_page(default_db, limit=10)
+    assert [game.name for game in page] == [
+        "A buffed game",
+        f"Game of {default_guild.id}",
+    ]
+
+    # Writes only touch the guild's own rows
+    default_game.state = "rejected"
+    assert await default_game.update(default_db) == 1
+    assert await default_game.delete(default_db) == 1
+    await other_game.refresh(letstry.get_guild_db(other_guild))
+    assert other_game.state == "submitted"
+
+
+def create_guild_db(path, version=3):
+    path.parent.mkdir(parents=True)
+    db = sqlite3.connect(path)
+    sql_dir = Path(LetsTry.get_sql_scriptpath("bootstrap.sql")).parent
+    db.executescript((sql_dir / "bootstrap.sql").read_text())
+    for v in range(version):
+        db.executescript(f"BEGIN ; {(sql_dir / f'migrate_from_v{v}.sql').read_text()}")
+        db.execute("INSERT INTO letstry_versions VALUES (?)", (v + 1,))
+        db.commit()
+    return db
+
+
+def test_merge(tmp_path):
+    for guild_id in (1, 2):
+        db = create_guild_db(tmp_path / "guilds" / str(guild_id) / "sqlite.db")
+        db.executescript(
+            f"""
+            INSERT INTO letstry_games (name, url)
+            VALUES ('Shared', 'https://shared/'), ('Game {guild_id}', 'https://{guild_id}/') ;
+            INSERT INTO letstry_proposals (discord_user_id, game_id) VALUES (10, 2) ;
+            INSERT INTO letstry_ballots (discord_thread_id) VALUES ({guild_id}) ;
+            INSERT INTO letstry_ballot_games (ballot_id, game_id) VALUES (1, 1), (1, 2) ;
+            UPDATE letstry_ballots SET staging = FALSE ;
+            INSERT INTO letstry_ballot_votes (ballot_id, game_id, discord_user_id)
+            VALUES (1, 1, 10) ;
+            UPDATE letstry_ballots SET finalized = TRUE ;
+            """
+        )
+        db.commit()
+        db.close()
+    create_guild_db(tmp_path / "guilds" / "3" / "sqlite.db", version=2).close()
+
+    output = tmp_path / "guilds.db"
+    # Guild 3 was not migrated to the current version yet
+    assert merge(tmp_path / "guilds", output) == [3]
+    # Already merged guilds are skipped
+    assert merge(tmp_path / "guilds", output) == [3]
+
+    db = sqlite3.connect(output)
+    assert db.execute(
+        "SELECT guild_id, game_id, name, state FROM letstry_games ORDER BY game_id"
+    ).fetchall() == [
+        (1, 1, "Shared", "elected"),
+        (1, 2, "Game 1", "accepted"),
+        (2, 3, "Shared", "elected"),
+        (2, 4, "Game 2", "accepted"),
+    ]
+    assert db.execute(
+        "SELECT guild_id, ballot_id, game_id, votes FROM letstry_ballot_games"
+    ).fetchall() == [(1, 1, 1, 1), (1, 1, 2, 0), (2, 2, 3, 1), (2, 2, 4, 0)]
+    assert db.execute(
+        "SELECT guild_id, discord_user_id, game_id FROM letstry_proposals"
+    ).fetchall() == [(1, 10, 2), (2, 10, 4)]
+    (triggers,) = db.execute(
+        "SELECT COUNT(*) FROM sqlite_master WHERE type = 'trigger'"
+    ).fetchone()
+    assert triggers == 11
@@ -1,6 +1,11 @@
-from buffedbot.extensions.settings import Settings, RESTRICTED_SETTINGS_KEY
+from buffedbot.extensions.settings import (
+    Settings,
+    RESTRICTED_SETTINGS_KEY,
+    get_number_setting,
+)
 from discord.ext import commands
 import json
+import math
 
 import pytest
 import pytest_asyncio
@@ -260,3 +265,35 @@ async def test_restrict(
         await legacy_invoke_command(
             settings, "command_guild_set", default_guild_context, key, "some value"
         )
+
+
+@pytest.mark.parametrize(
+    "value, expected",
+    [
+        (None, 5),
+        ("2.5", 2.5),
+        ("inf", math.inf),
+        ("abc", 5),
+        ("nan", 5),
+        ("-1", 5),
+        (["1"], 5),
+    ],
+)
+def test_get_number_setting(value, expected):
+    settings = {} if value is None else {"number": value}
+
+    def get_setting(setting, default):
+        return settings.get(setting, default)
+
+    assert get_number_setting(get_setting, "number", 5, minimum=0) == expected
+    assert get_number_setting(get_setting, "other", None) is None
+
+
+def test_get_number_setting_finite_int():
+    settings = {"number": "inf", "count": "3"}
+
+    def get_setting(setting, default):
+        return settings.get(setting, default)
+
+    assert get_number_setting(get_setting, "number", 1.0, finite=True) == 1.0
+    assert get_number_setting(get_setting, "count", 1, int) == 3
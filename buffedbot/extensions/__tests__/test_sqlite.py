@@ -0,0 +1,627 @@
+from buffedbot.extensions.sqlite import (
+    SQLite,
+    get_reader,
+    transaction,
+    run_sync,
+    run_sync_transaction,
+    run_sync_exclusive,
+    run_sync_grouped,
+    get_changes,
+    notify_changes,
+    connect,
+    format_stats,
+    GuildDatabases,
+    MAX_GUILD_CONNECTIONS_SETTING,
+    GROUP_COMMIT_MS_SETTING,
+    StatementStats,
+    SLOW_QUERY_MS_SETTING,
+    EXPLAIN_QUERY_MS_SETTING,
+    Schema,
+)
+from buffedbot.extensions.sqlite.migrate import Target, migrate
+from buffedbot.extensions.sqlite.backup import (
+    Backups,
+    backup_database,
+    BACKUP_DIR_SETTING,
+    BACKUP_KEEP_SETTING,
+)
+from buffedbot.extensions.sqlite.maintenance import (
+    Maintenance,
+    maintain_connection,
+    MAINTENANCE_BUDGET_SECONDS_SETTING,
+)
+import unittest.mock as mock
+import asyncio
+from collections import namedtuple
+import math
+import sqlite3
+
+import aiosqlite
+import pytest
+import pytest_asyncio
+
+
+@pytest_asyncio.fixture
+async def test_db():
+    async with aiosqlite.connect(":memory:") as con:
+        await con.execute("CREATE TABLE items (item_id INTEGER PRIMARY KEY)")
+        await con.commit()
+        yield con
+
+
+async def count_items(db):
+    async with db.execute("SELECT COUNT(*) FROM items") as cursor:
+        (count,) = await cursor.fetchone()
+    return count
+
+
+@pytest.mark.asyncio
+async def test_transaction_commits_once(test_db):
+    with mock.patch.object(test_db, "commit", wraps=test_db.commit) as commit:
+        async with transaction(test_db):
+            await test_db.execute("INSERT INTO items VALUES (1)")
+            async with transaction(test_db):
+                await test_db.execute("INSERT INTO items VALUES (2)")
+            commit.assert_not_called()
+        commit.assert_called_once()
+    assert await count_items(test_db) == 2
+
+
+@pytest.mark.asyncio
+async def test_transaction_rolls_back(test_db):
+    with pytest.raises(aiosqlite.IntegrityError):
+        async with transaction(test_db):
+            await test_db.execute("INSERT INTO items VALUES (1)")
+            await test_db.execute("INSERT INTO items VALUES (1)")
+    assert await count_items(test_db) == 0
+
+
+@pytest.mark.asyncio
+async def test_transaction_isolates_concurrent_units(test_db):
+    inserted = asyncio.Event()
+    release = asyncio.Event()
+
+    async def failing_unit():
+        async with transaction(test_db):
+            await test_db.execute("INSERT INTO items VALUES (1)")
+            inserted.set()
+            await release.wait()
+            raise RuntimeError()
+
+    async def other_unit():
+        await inserted.wait()
+        async with transaction(test_db):
+            await test_db.execute("INSERT INTO items VALUES (2)")
+
+    failing = asyncio.create_task(failing_unit())
+    other = asyncio.create_task(other_unit())
+    await inserted.wait()
+    await asyncio.sleep(0)
+    release.set()
+    with pytest.raises(RuntimeError):
+        await failing
+    await other
+
+    # The failed unit's insert was rolled back without taking the other
+    # unit's insert with it
+    async with test_db.execute("SELECT item_id FROM items") as cursor:
+        assert await cursor.fetchall() == [(2,)]
+
+
+@pytest.mark.asyncio
+async def test_spawned_tasks_do_not_join_unit(test_db):
+    published = []
+    get_changes(test_db).listen(published.append)
+
+    async def spawned_unit():
+        async with transaction(test_db):
+            await test_db.execute("INSERT INTO items VALUES (2)")
+            notify_changes(test_db, ["items"])
+        await run_sync_transaction(test_db, insert_items, 3)
+
+    async with transaction(test_db):
+        await test_db.execute("INSERT INTO items VALUES (1)")
+        # Inherits the context of the unit, but waits for it to end
+        spawned = asyncio.create_task(spawned_unit())
+        await asyncio.sleep(0)
+        assert not published
+    await spawned
+
+    assert not test_db.in_transaction
+    assert await count_items(test_db) == 3
+    assert published == [frozenset({"items"})]
+
+
+def insert_items(connection, *item_ids):
+    connection.executemany("INSERT INTO items VALUES (?)", [(i,) for i in item_ids])
+    return connection.execute("SELECT COUNT(*) FROM items").fetchone()[0]
+
+
+@pytest.mark.asyncio
+async def test_run_sync_transaction(test_db):
+    with mock.patch.object(test_db, "_execute", wraps=test_db._execute) as execute:
+        assert await run_sync_transaction(test_db, insert_items, 1, 2) == 2
+    # BEGIN, the statements and COMMIT in one round trip
+    assert execute.call_count == 1
+    assert not test_db.in_transaction
+
+    with pytest.raises(sqlite3.IntegrityError):
+        await run_sync_transaction(test_db, insert_items, 3, 1)
+    assert await count_items(test_db) == 2
+
+    # Joins an enclosing unit of work
+    with pytest.raises(RuntimeError):
+        async with transaction(test_db):
+            assert await run_sync_transaction(test_db, insert_items, 3) == 3
+            raise RuntimeError
+    assert await count_items(test_db) == 2
+
+
+@pytest_asyncio.fixture
+async def instrumented_db():
+    settings = {}
+    stats = StatementStats(lambda setting, default: settings.get(setting, default))
+    async with connect(":memory:", stats) as con:
+        con.settings = settings
+        yield con
+
+
+@pytest.mark.asyncio
+async def test_statement_stats(instrumented_db):
+    db = instrumented_db
+    await db.execute("CREATE TABLE items (item_id INTEGER PRIMARY KEY)")
+    await db.executemany("INSERT INTO items VALUES (?)", [(1,), (2,)])
+    for item_id in (1, 2):
+        async with db.execute(
+            """SELECT *
+                 FROM items WHERE item_id = ?""",
+            (item_id,),
+        ) as cursor:
+            assert await cursor.fetchone() == (item_id,)
+    await db.commit()
+
+    templates = db.stats.templates
+    select = templates["SELECT * FROM items WHERE item_id = ?"]
+    assert select.count == 2
+    assert sum(select.histogram) == 2
+    assert templates["INSERT INTO items VALUES (?)"].count == 1
+    assert templates["COMMIT"].count == 1
+    assert not db.stats.slow_queries
+    assert "SELECT * FROM items" in format_stats(db.stats)
+
+    db.stats.reset()
+    assert not db.stats.templates
+
+
+@pytest.mark.asyncio
+async def test_slow_query_log(instrumented_db):
+    db = instrumented_db
+    db.settings[SLOW_QUERY_MS_SETTING] = "0"
+    await db.execute("CREATE TABLE items (item_id INTEGER PRIMARY KEY)")
+    await db.execute("SELECT * FROM items WHERE item_id = ?", (1,))
+    assert [query.plan for query in db.stats.slow_queries] == [None, None]
+
+    db.settings[EXPLAIN_QUERY_MS_SETTING] = "0"
+    await db.execute("SELECT * FROM items WHERE item_id = ?", (1,))
+    slow_query = db.stats.slow_queries[-1]
+    assert slow_query.template == "SELECT * FROM items WHERE item_id = ?"
+    assert any("USING INTEGER PRIMARY KEY" in line for line in slow_query.plan)
+
+    # Invalid thresholds fall back to their defaults instead of failing
+    # every statement
+    db.settings[SLOW_QUERY_MS_SETTING] = "abc"
+    db.settings[EXPLAIN_QUERY_MS_SETTING] = "abc"
+    assert await db.execute_fetchall("SELECT 1") == [(1,)]
+    assert db.stats.explain_query_ms is None
+
+
+Guild = namedtuple("Guild", ["id"])
+
+
+@pytest_asyncio.fixture
+async def guild_dbs(tmp_path):
+    settings = {MAX_GUILD_CONNECTIONS_SETTING: "2", GROUP_COMMIT_MS_SETTING: "0"}
+    stats = StatementStats()
+
+    async def connect_guild_db(guild):
+        return await connect(tmp_path / f"{guild.id}.db", stats)
+
+    guild_dbs = GuildDatabases(
+        connect_guild_db, lambda setting, default: settings.get(setting, default)
+    )
+    yield guild_dbs
+    await guild_dbs.close()
+
+
+@pytest.mark.asyncio
+async def test_guild_databases_open_lazily(guild_dbs):
+    dbs = [guild_dbs.add(Guild(i)) for i in range(3)]
+    assert not guild_dbs.connected
+
+    await dbs[0].execute("CREATE TABLE items (item_id INTEGER PRIMARY KEY)")
+    await dbs[0].execute("INSERT INTO items VALUES (1)")
+    await dbs[0].commit()
+    await dbs[1].execute("SELECT 1")
+    assert list(guild_dbs.connected) == [0, 1]
+
+    # Using 0 makes 1 the least recently used connection
+    await dbs[0].execute("SELECT 1")
+    await dbs[2].execute("SELECT 1")
+    assert list(guild_dbs.connected) == [0, 2]
+    assert dbs[1].connection is None
+    assert (guild_dbs.opened, guild_dbs.evicted) == (3, 1)
+
+    # Evicted databases are reopened on use
+    await dbs[1].execute("SELECT 1")
+    await dbs[2].execute("SELECT 1")
+    assert list(guild_dbs.connected) == [1, 2]
+    async with dbs[0].execute("SELECT * FROM items") as cursor:
+        assert await cursor.fetchall() == [(1,)]
+    assert (guild_dbs.opened, guild_dbs.evicted) == (5, 3)
+
+
+@pytest.mark.asyncio
+async def test_guild_databases_keep_busy_connections(guild_dbs):
+    dbs = [guild_dbs.add(Guild(i)) for i in range(3)]
+    await dbs[0].execute("CREATE TABLE items (item_id INTEGER PRIMARY KEY)")
+    await dbs[1].execute("SELECT 1")
+
+    async with transaction(dbs[0]):
+        await dbs[0].execute("INSERT INTO items VALUES (1)")
+        await dbs[2].execute("SELECT 1")
+        assert list(guild_dbs.connected) == [0, 2]
+        await dbs[1].execute("SELECT 1")
+        assert list(guild_dbs.connected) == [0, 1]
+
+    async with dbs[0].execute("SELECT * FROM items") as cursor:
+        assert await cursor.fetchall() == [(1,)]
+
+
+@pytest.mark.asyncio
+async def test_guild_databases_bound_sweeps(guild_dbs):
+    connect = guild_dbs.connect
+
+    async def connect_within_limit(guild):
+        # Includes the connection being opened
+        assert len(guild_dbs.connected) + guild_dbs.opening <= 2
+        return await connect(guild)
+
+    guild_dbs.connect = connect_within_limit
+    dbs = [guild_dbs.add(Guild(i)) for i in range(10)]
+    for db in dbs:
+        await db.execute_fetchall("SELECT 1")
+    assert len(guild_dbs.connected) == 2
+    assert guild_dbs.evicted == 8
+
+    await asyncio.gather(*[db.execute_fetchall("SELECT 1") for db in dbs])
+    assert len(guild_dbs.connected) == 2
+    assert guild_dbs.opened - guild_dbs.evicted == 2
+
+
+@pytest.mark.asyncio
+async def test_guild_databases_wait_for_busy_connections(guild_dbs):
+    dbs = [guild_dbs.add(Guild(i)) for i in range(3)]
+    for db in dbs[:2]:
+        await db.execute("CREATE TABLE items (item_id INTEGER PRIMARY KEY)")
+        await db.executemany("INSERT INTO items VALUES (?)", [(1,), (2,)])
+        await db.commit()
+
+    async with dbs[0].execute("SELECT * FROM items") as cursor:
+        # Cursors that are still being iterated keep their connection
+        assert await cursor.fetchone() == (1,)
+        async with dbs[1].execute("SELECT * FROM items") as other:
+            opening = asyncio.create_task(dbs[2].execute_fetchall("SELECT 1"))
+            await asyncio.sleep(0.1)
+            assert not opening.done()
+            assert await other.fetchall() == [(1,), (2,)]
+        del other
+        assert await opening == [(1,)]
+        assert list(guild_dbs.connected) == [0, 2]
+        assert await cursor.fetchone() == (2,)
+    assert guild_dbs.waited == 1
+
+
+@pytest.mark.asyncio
+async def test_grouped_writes(guild_dbs):
+    db = guild_dbs.add(Guild(0))
+    await db.execute("CREATE TABLE items (item_id INTEGER PRIMARY KEY)")
+    await db.commit()
+
+    # A burst of writes is committed at once, and only the write that fails
+    # gets its error
+    results = await asyncio.gather(
+        *[run_sync_grouped(db, insert_items, i) for i in (1, 2, 1, 3)],
+        return_exceptions=True,
+    )
+    assert results[:2] == [1, 2] and results[3] == 3
+    assert isinstance(results[2], sqlite3.IntegrityError)
+    assert (db.write_queue.writes, db.write_queue.commits) == (4, 1)
+    assert await count_items(db) == 3
+
+    # Unless enabled, every write commits on its own
+    db.write_queue.get_setting = lambda setting, default: default
+    assert await asyncio.gather(
+        *[run_sync_grouped(db, insert_items, i) for i in (4, 5)]
+    ) == [4, 5]
+    assert db.write_queue.commits == 1
+
+
+@pytest_asyncio.fixture
+async def sqlite_cog(mock_bot, tmp_path):
+    mock_bot.get_cog.return_value = None
+    sqlite = SQLite(mock_bot)
+    with mock.patch.object(
+        sqlite,
+        "get_guild_db_path",
+        side_effect=lambda guild: str(tmp_path / f"{guild.id}.db"),
+    ):
+        yield sqlite
+        await sqlite.guild_dbs.close()
+
+
+@pytest.mark.asyncio
+async def test_guild_database_profile_and_reader(sqlite_cog):
+    db = sqlite_cog.guild_dbs.add(Guild(1))
+    async with db.execute("PRAGMA journal_mode") as cursor:
+        assert await cursor.fetchone() == ("wal",)
+    async with db.execute("PRAGMA foreign_keys") as cursor:
+        assert await cursor.fetchone() == (1,)
+    async with db.execute("PRAGMA auto_vacuum") as cursor:
+        assert await cursor.fetchone() == (2,)
+
+    await db.execute("CREATE TABLE items (item_id INTEGER PRIMARY KEY)")
+    await db.execute("INSERT INTO items VALUES (1)")
+    await db.commit()
+
+    reader = get_reader(db)
+    assert reader is db.reader
+    async with transaction(db):
+        await db.execute("INSERT INTO items VALUES (2)")
+        # The unit of work reads its own writes on the writer...
+        assert get_reader(db) is db
+        # ...while the reader keeps reading the last commit without waiting
+        async with reader.execute("SELECT * FROM items") as cursor:
+            assert await cursor.fetchall() == [(1,)]
+    assert reader.connection is not db.connection
+    assert len(await reader.execute_fetchall("SELECT * FROM items")) == 2
+
+    with pytest.raises(aiosqlite.OperationalError, match="readonly"):
+        await reader.execute("INSERT INTO items VALUES (3)")
+
+
+@pytest.fixture
+def schema(tmp_path):
+    directory = tmp_path / "schema"
+    directory.mkdir()
+    (directory / "bootstrap.sql").write_text(
+        """
+        CREATE TABLE IF NOT EXISTS items (item_id INTEGER PRIMARY KEY) ;
+        CREATE TABLE IF NOT EXISTS item_versions (version INTEGER PRIMARY KEY) ;
+        INSERT INTO item_versions VALUES (0) ON CONFLICT DO NOTHING ;
+        """
+    )
+    (directory / "migrate_from_v0.sql").write_text(
+        "ALTER TABLE items ADD COLUMN name TEXT ;"
+    )
+    (directory / "migrate_from_v1.sql").write_text(
+        "CREATE UNIQUE INDEX items_name ON items (name) ;"
+    )
+    return Schema("items", directory, "item_versions")
+
+
+def get_version(path):
+    with sqlite3.connect(path) as db:
+        return db.execute("SELECT MAX(version) FROM item_versions").fetchone()[0]
+
+
+@pytest.mark.asyncio
+async def test_migrate(tmp_path, schema):
+    targets = [Target(f"guild {i}", tmp_path / f"{i}.db", (schema,)) for i in range(3)]
+    with sqlite3.connect(targets[0].path) as db:
+        db.executescript(schema.script("bootstrap.sql"))
+        db.executescript(schema.migration(0))
+        db.execute("INSERT INTO item_versions VALUES (1)")
+        # Breaks the unique index of the v1 migration
+        db.execute("INSERT INTO items VALUES (1, 'duplicate'), (2, 'duplicate')")
+    for target in targets[1:]:
+        sqlite3.connect(target.path).close()
+
+    reports = []
+    results = await migrate(targets, jobs=2, dry_run=True, report=reports.append)
+    assert len(reports) == 3
+    assert {result.target.label: result.scripts for result in results} == {
+        "guild 0": ["items/migrate_from_v1.sql"],
+        "guild 1": ["items/bootstrap.sql"],
+        "guild 2": ["items/bootstrap.sql"],
+    }
+    assert get_version(targets[0].path) == 1
+
+    results = await migrate(targets, jobs=2, report=reports.append)
+    results = {result.target.label: result for result in results}
+    assert (
+        "left at v1"
+        in reports[-3:][
+            [r.startswith("[") and "guild 0" in r for r in reports[-3:]].index(True)
+        ]
+    )
+    assert isinstance(results["guild 0"].error, sqlite3.IntegrityError)
+    assert get_version(targets[0].path) == 1
+    assert results["guild 1"].scripts == [
+        "items/bootstrap.sql",
+        "items/migrate_from_v0.sql",
+        "items/migrate_from_v1.sql",
+    ]
+    assert get_version(targets[1].path) == 2
+
+    # Running again resumes the failed database
+    with sqlite3.connect(targets[0].path) as db:
+        db.execute("UPDATE items SET name = 'unique' WHERE item_id = 2")
+    results = await migrate(targets, report=reports.append)
+    assert {result.target.label: result.scripts for result in results} == {
+        "guild 0": ["items/migrate_from_v1.sql"],
+        "guild 1": [],
+        "guild 2": [],
+    }
+    assert get_version(targets[0].path) == 2
+
+
+def test_backup_database_in_steps(tmp_path):
+    source = tmp_path / "source.db"
+    with sqlite3.connect(source) as db:
+        db.execute("CREATE TABLE items (item_id INTEGER PRIMARY KEY, name TEXT)")
+        db.executemany(
+            "INSERT INTO items VALUES (?, ?)", [(i, "x" * 100) for i in range(1000)]
+        )
+    steps = []
+    with mock.patch("time.sleep", side_effect=steps.append):
+        pages = backup_database(source, tmp_path / "copy.db", pages=8)
+    assert pages > 8 and len(steps) == math.ceil(pages / 8) - 1
+
+    with sqlite3.connect(tmp_path / "copy.db") as db:
+        assert db.execute("SELECT COUNT(*) FROM items").fetchone() == (1000,)
+
+
+@pytest.mark.asyncio
+async def test_backups(tmp_path):
+    source = tmp_path / "source.db"
+    with sqlite3.connect(source) as db:
+        db.execute("CREATE TABLE items (item_id INTEGER PRIMARY KEY)")
+    settings = {BACKUP_DIR_SETTING: str(tmp_path / "backups"), BACKUP_KEEP_SETTING: 2}
+    backups = Backups(
+        lambda: [("guilds/1/sqlite.db", source), ("missing.db", tmp_path / "no.db")],
+        lambda setting, default: settings.get(setting, default),
+    )
+    assert backups.is_due()
+
+    stats = await backups.run()
+    assert stats.databases == 1
+    assert list(stats.failed) == ["missing.db"]
+    assert (stats.snapshot / "guilds" / "1" / "sqlite.db").exists()
+    assert not (stats.snapshot / "missing.db").exists()
+    assert not backups.is_due()
+
+    # Only the most recent snapshots are kept
+    await backups.run()
+    await backups.run()
+    snapshots = backups.snapshots()
+    assert len(snapshots) == 2 and stats.snapshot not in snapshots
+    assert snapshots[-1] == backups.last.snapshot
+
+
+@pytest.mark.asyncio
+async def test_run_sync_is_recorded(instrumented_db):
+    await instrumented_db.execute("CREATE TABLE items (item_id INTEGER PRIMARY KEY)")
+    assert await run_sync(instrumented_db, insert_items, 1) == 1
+    assert "run_sync insert_items" in instrumented_db.stats.templates
+
+
+def fill_and_empty(connection):
+    connection.executemany(
+        "INSERT INTO items (payload) VALUES (?)", [("x" * 1000,)] * 500
+    )
+    connection.commit()
+    connection.execute("DELETE FROM items")
+    connection.commit()
+
+
+@pytest.mark.asyncio
+async def test_maintain_connection(tmp_path):
+    path = tmp_path / "old.db"
+    with sqlite3.connect(path) as db:
+        db.execute("CREATE TABLE items (item_id INTEGER PRIMARY KEY, payload TEXT)")
+    async with aiosqlite.connect(path) as db:
+        await run_sync(db, fill_and_empty)
+        # Switching a database to incremental vacuum rewrites it
+        result = await run_sync_exclusive(db, maintain_connection)
+        assert result.analyzed and result.converted
+        assert result.reclaimed > 0
+        async with db.execute("PRAGMA auto_vacuum") as cursor:
+            assert await cursor.fetchone() == (2,)
+
+        await run_sync(db, fill_and_empty)
+        result = await run_sync_exclusive(db, maintain_connection)
+        assert not result.analyzed and not result.converted
+        assert result.reclaimed > 0
+        assert result.error is None
+
+
+@pytest.mark.asyncio
+async def test_maintenance_cycles(tmp_path):
+    settings = {}
+    maintained = []
+
+    async def run(db, fn):
+        maintained.append(db)
+        return maintain_connection(db)
+
+    dbs = {}
+    for name in ("a", "b", "c"):
+        dbs[name] = sqlite3.connect(tmp_path / f"{name}.db")
+        dbs[name].execute("CREATE TABLE items (item_id INTEGER PRIMARY KEY)")
+    maintenance = Maintenance(
+        lambda: list(dbs.items()),
+        run,
+        lambda setting, default: settings.get(setting, default),
+    )
+    try:
+        # A spent budget leaves all databases to the next cycle
+        settings[MAINTENANCE_BUDGET_SECONDS_SETTING] = 0
+        assert await maintenance.run_cycle() == []
+
+        settings[MAINTENANCE_BUDGET_SECONDS_SETTING] = 60
+        results = await maintenance.run_cycle()
+        assert sorted(result.name for result in results) == ["a", "b", "c"]
+        assert len(maintained) == 3
+        # Databases are maintained once per interval
+        assert await maintenance.run_cycle() == []
+        assert maintenance.maintained == 3
+    finally:
+        for db in dbs.values():
+            db.close()
+
+
+@pytest.mark.asyncio
+async def test_change_notifications(test_db):
+    changes = get_changes(test_db)
+    published = []
+    changes.listen(published.append)
+    version = changes.get_version(["items"])
+
+    # Writes of a unit of work are published once it commits...
+    async with transaction(test_db):
+        await test_db.execute("INSERT INTO items VALUES (1)")
+        notify_changes(test_db, ["items"])
+        assert published == []
+    assert published == [frozenset({"items"})]
+    assert changes.get_version(["items"]) != version
+
+    # ...and not at all if it rolls back
+    with pytest.raises(RuntimeError):
+        async with transaction(test_db):
+            notify_changes(test_db, ["items"])
+            raise RuntimeError
+    assert len(published) == 1
+
+    notify_changes(test_db, ["items", "others"])
+    assert published[-1] == frozenset({"items", "others"})
+
+
+@pytest.mark.asyncio
+async def test_changes_of_other_connections(sqlite_cog, tmp_path):
+    db = sqlite_cog.guild_dbs.add(Guild(1))
+    await db.execute("CREATE TABLE items (item_id INTEGER PRIMARY KEY)")
+    await db.commit()
+    published = []
+    get_changes(db).listen(published.append)
+
+    await sqlite_cog.check_changes(db, db.connection)
+    # The connection's own commits don't count as changes of others
+    await db.execute("INSERT INTO items VALUES (1)")
+    await db.commit()
+    await sqlite_cog.check_changes(db, db.connection)
+    assert published == []
+
+    with sqlite3.connect(tmp_path / "1.db") as other:
+        other.execute("INSERT INTO items VALUES (2)")
+    await sqlite_cog.check_changes(db, db.connection)
+    assert published == [None]
@@ -0,0 +1,268 @@
+from buffedbot.extensions.steam import (
+    Steam,
+    Game,
+    SearchCache,
+    STEAM_SCHEMA,
+    EXTRACTORS,
+    MAX_SEARCH_RESULTS,
+)
+from buffedbot.extensions.steam.pool import (
+    ParsePool,
+    PARSE_EXECUTOR_SETTING,
+    PARSE_QUEUE_SIZE_SETTING,
+    PARSE_WORKERS_SETTING,
+)
+from buffedbot.errors import ElementNotFoundError, SteamBusyError
+import unittest.mock as mock
+import asyncio
+from pathlib import Path
+
+import aiosqlite
+import pytest
+import pytest_asyncio
+
+FIXTURES_DIR = Path(__file__).parent / "fixtures"
+
+
+@pytest.fixture
+def steam(mock_bot):
+    # No settings cog, so settings have their defaults
+    mock_bot.get_cog = lambda cog: None
+    return Steam(mock_bot)
+
+
+@pytest_asyncio.fixture
+async def steam_db(steam):
+    async with aiosqlite.connect(":memory:") as db:
+        await STEAM_SCHEMA.upgrade(db)
+        with mock.patch.object(Steam, "db", db):
+            yield db
+
+
+def create_game(url):
+    return Game(
+        name="Game",
+        url=url,
+        description="",
+        image="",
+        price=0,
+        review_count=0,
+        review_summary="",
+        date_created="2023-01-01 00:00:00",
+    )
+
+
+@pytest.mark.asyncio
+async def test_get_game_coalesces_requests(steam):
+    release = asyncio.Event()
+
+    async def fetch_game(url):
+        await release.wait()
+        return create_game(url)
+
+    with mock.patch.object(steam, "fetch_game", side_effect=fetch_game) as fetch:
+        requests = [
+            asyncio.create_task(steam.get_game(url))
+            for url in (
+                "https://store.steampowered.com/app/1/Game/",
+                "https://store.steampowered.com/app/1/",
+                "https://store.steampowered.com/app/1/Game/?l=german",
+            )
+        ]
+        await asyncio.sleep(0)
+        # A caller giving up does not cancel the fetch for the others
+        requests[0].cancel()
+        release.set()
+        games = await asyncio.gather(*requests[1:])
+
+    fetch.assert_called_once_with("https://store.steampowered.com/app/1")
+    assert games[0] is games[1]
+    assert (steam.game_flights.calls, steam.game_flights.coalesced) == (1, 2)
+    assert not steam.game_flights.in_flight
+
+    # Requests after the fetch completed fetch again
+    with mock.patch.object(steam, "fetch_game", side_effect=fetch_game) as fetch:
+        await steam.get_game("https://store.steampowered.com/app/1/")
+    fetch.assert_called_once()
+
+
+@pytest.mark.asyncio
+async def test_search_coalesces_errors(steam):
+    async def fetch_search_results(term):
+        await asyncio.sleep(0)
+        raise RuntimeError(term)
+
+    with mock.patch.object(
+        steam, "fetch_search_results", side_effect=fetch_search_results
+    ) as fetch:
+        results = await asyncio.gather(
+            steam.get_search_results("term"),
+            steam.get_search_results("term"),
+            steam.get_search_results("other"),
+            return_exceptions=True,
+        )
+
+    assert [str(result) for result in results] == ["term", "term", "other"]
+    assert fetch.call_count == 2
+    assert steam.search_flights.coalesced == 1
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("executor", ["process", "thread", "inline"])
+async def test_parse_pool(executor):
+    settings = {PARSE_EXECUTOR_SETTING: executor, PARSE_WORKERS_SETTING: 1}
+    pool = ParsePool(lambda setting, default: settings.get(setting, default))
+    search = (FIXTURES_DIR / "steam_search.html").read_bytes()
+    try:
+        results = await asyncio.gather(
+            *[
+                pool.run(EXTRACTORS["stream"].get_search_results, search, 3)
+                for _ in range(3)
+            ]
+        )
+        assert [len(result) for result in results] == [3, 3, 3]
+        assert pool.parses == 3 and pool.pending == 0
+        assert pool.parse_time > 0
+
+        # Errors of the parser reach the caller
+        with pytest.raises(ElementNotFoundError):
+            await pool.run(EXTRACTORS["stream"].get_game_fields, b"<html></html>")
+    finally:
+        pool.close()
+
+
+@pytest.mark.asyncio
+async def test_parse_pool_rejects_when_full():
+    settings = {PARSE_EXECUTOR_SETTING: "thread", PARSE_QUEUE_SIZE_SETTING: 2}
+    pool = ParsePool(lambda setting, default: settings.get(setting, default))
+    try:
+        results = await asyncio.gather(
+            *[pool.run(sum, [i, 1]) for i in range(3)], return_exceptions=True
+        )
+        assert results[:2] == [1, 2]
+        assert isinstance(results[2], SteamBusyError)
+        assert pool.rejected == 1
+    finally:
+        pool.close()
+
+
+@pytest.mark.asyncio
+async def test_search_cache(steam, steam_db):
+    results = [{"name": "Game", "url": "https://store.steampowered.com/app/1/"}]
+    with mock.patch.object(
+        steam, "download_search_results", return_value=results
+    ) as download:
+        assert await steam.get_search_results("Some  Game") == results
+        # Served from memory by normalized term
+        assert await steam.get_search_results("some game") == results
+        download.assert_called_once_with("some game")
+
+        # And from the table when not in memory
+        steam.search_cache = SearchCache()
+        assert await steam.get_search_results("SOME GAME") == results
+        assert download.call_count == 1
+        assert steam.search_cache.table_hits == 1
+
+        # Until the results expire
+        steam.search_cache = SearchCache()
+        await steam_db.execute(
+            "UPDATE steam_search_cache SET date_created = '2000-01-01 00:00:00'"
+        )
+        await steam_db.commit()
+        assert await steam.get_search_results("some game") == results
+        assert download.call_count == 2
+
+
+@pytest.mark.asyncio
+async def test_stale_games_are_refreshed_in_background(steam, steam_db):
+    url = "https://store.steampowered.com/app/1"
+    await steam.store_game_in_cache(create_game(url))
+    refreshed = create_game(url)
+    refreshed.price = 9.99
+
+    async def set_age(hours):
+        await steam_db.execute(
+            "UPDATE steam_games_cache SET date_created = DATETIME('now', ?)",
+            (f"-{hours} hours",),
+        )
+        await steam_db.commit()
+
+    release = asyncio.Event()
+
+    async def download_game(url):
+        await release.wait()
+        return refreshed
+
+    with mock.patch.object(
+        steam, "download_game", side_effect=download_game
+    ) as download:
+        # Fresh games are served from the table
+        await set_age(1)
+        assert (await steam.get_game(url)).price == 0
+        assert download.call_count == 0
+
+        # Stale ones too, while one refresh runs in the background
+        await set_age(48)
+        assert (await steam.get_game(url)).price == 0
+        assert (await steam.get_game(url)).price == 0
+        assert download.call_count == 1
+        assert steam.game_refreshes.stale_hits == 2
+        release.set()
+        await asyncio.gather(*steam.game_refreshes.tasks.values())
+        assert not steam.game_refreshes.tasks
+
+        # Past the hard TTL lookups wait for the download
+        await set_age(24 * 8)
+        assert await steam.get_game(url) is refreshed
+        assert download.call_count == 2
+        assert steam.game_refreshes.downloads == 1
+
+    # Failed refreshes are counted and the stale game kept
+    await set_age(48)
+    with mock.patch.object(steam, "download_game", side_effect=SteamBusyError()):
+        assert (await steam.get_game(url)).price == 0
+        await asyncio.gather(
+            *steam.game_refreshes.tasks.values(), return_exceptions=True
+        )
+    assert steam.game_refreshes.failures == 1
+
+
+def test_extractors_agree():
+    app = (FIXTURES_DIR / "steam_app.html").read_bytes()
+    search = (FIXTURES_DIR / "steam_search.html").read_bytes()
+    soup, stream = EXTRACTORS["soup"], EXTRACTORS["stream"]
+
+    game = stream.get_game_fields(app)
+    assert game == soup.get_game_fields(app)
+    assert (game["name"], game["price"], game["review_count"]) == (
+        "Portal 2",
+        9.99,
+        387239,
+    )
+
+    results = stream.get_search_results(search, MAX_SEARCH_RESULTS)
+    assert results == soup.get_search_results(search, MAX_SEARCH_RESULTS)
+    assert len(results) == MAX_SEARCH_RESULTS
+    # Each row has its own price, even though rows have two price elements
+    assert results[1] == {
+        "name": "Portal",
+        "url": "https://store.steampowered.com/app/627/Portal/",
+        "price": 2.5,
+    }
+
+
+def test_stream_extractor_defaults():
+    markup = b"""
+        <meta property="og:url" content="https://store.steampowered.com/app/1/">
+        <meta property="og:description" content="">
+        <meta property="og:image" content="https://image/">
+        <div><span itemprop="name">Game</span></div>
+    """
+    game = EXTRACTORS["stream"].get_game_fields(markup)
+    assert (game["price"], game["review_count"], game["review_summary"]) == (
+        -1.0,
+        0,
+        "No reviews",
+    )
+    with pytest.raises(ElementNotFoundError):
+        EXTRACTORS["stream"].get_game_fields(markup.replace(b"itemprop", b"class"))
@@ -1,12 +1,24 @@
-from collections import namedtuple
+from collections import namedtuple, OrderedDict, defaultdict
 from datetime import datetime, timedelta, timezone
 from discord.ext import commands, tasks
-from aiopath import PurePath, AsyncPath
+from aiopath import AsyncPath
 from buffedbot.checks import is_guild_owner
 from buffedbot.strings import SOMETHING_WENT_WRONG
-from buffedbot.errors import GameNotFoundError
+from buffedbot.errors import GameNotFoundError, SteamBusyError
 from buffedbot.extensions.steam import Game as SteamGame
-from asyncio import gather
+from buffedbot.extensions.sqlite import (
+    Schema,
+    transaction,
+    run_sync_grouped,
+    run_sync_transaction,
+    dict_compact,
+    get_changes,
+    get_reader,
+    get_tenant,
+    notify_changes,
+    TENANT_COLUMN,
+)
+from asyncio import gather, ensure_future
 from sqlite3 import IntegrityError, Error as SQLiteError
 from typing import (
     Literal,
@@ -16,19 +28,24 @@ from typing import (
     cast,
     Mapping,
     Iterable,
+    Callable,
 )
 from dataclasses import dataclass
 from contextlib import asynccontextmanager
 from pytimeparse import parse as timeparse
 from functools import partial
+from weakref import WeakKeyDictionary
 import dataclasses
 import discord
 import re
 import itertools
+import time
 
 import aiofiles
 import os
 
+from pathlib import Path
+
 STEAM_STORE_URL_PATTERN = r"^(https?://)?store\.steampowered\.com/app/[0-9]+.+$"
 URL_PATTERN = r"^https?://.+$"
 
@@ -73,6 +90,23 @@ def join(items: Iterable[str], sep: str = ",") -> str:
 
 T = TypeVar("T")
 
+NO_CHANGES: frozenset[str] = frozenset()
+
+# Maximum number of values bound to a single IN (...) when eager loading
+IN_BATCH_SIZE = 512
+
+# Maximum number of cache entries per table and guild database
+ROW_CACHE_SIZE = 256
+
+# Same ballots as state = 'closed' in letstry_ballots_view, but in terms of
+# the indexed columns of letstry_ballots
+CLOSED_BALLOTS_CONDITION = """
+    finalized = FALSE AND
+    staging = FALSE AND
+    date_close <= DATETIME('NOW') AND
+    date_open <= DATETIME('NOW')
+"""
+
 
 def notnone(v: Optional[T]) -> T:
     if v is None:
@@ -80,26 +114,158 @@ def notnone(v: Optional[T]) -> T:
     return v
 
 
+def fetch_rows(connection, sql: str, parameters: Mapping, row_factory: Callable):
+    """fetchall for functions run with run_sync"""
+    cursor = connection.execute(sql, parameters)
+    cursor.row_factory = row_factory
+    try:
+        return cursor.fetchall()
+    finally:
+        cursor.close()
+
+
+class RowCache:
+    """Bounded LRU cache of the rows of one (guild) database.
+
+    Rows are stored as tuples of column values, so every lookup hydrates a row
+    of its own. Each table is invalidated as a whole whenever a sqldatarow
+    writes to it (or to a table whose triggers write to it), and again when
+    the database publishes a change of it (see get_changes)."""
+
+    def __init__(self):
+        self.tables: dict[str, OrderedDict] = {}
+        # Bumped on every invalidation. Lookups that started before an
+        # invalidation must not store what they read.
+        self.generations: defaultdict[str, int] = defaultdict(int)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, table: str, key: tuple) -> Optional[tuple]:
+        rows = self.tables.get(table)
+        entry = rows.get(key) if rows is not None else None
+        if entry is None:
+            self.misses += 1
+            return None
+
+        values, expires = entry
+        if expires is not None and expires <= time.time():
+            del rows[key]
+            self.misses += 1
+            return None
+
+        rows.move_to_end(key)
+        self.hits += 1
+        return values
+
+    def put(
+        self,
+        table: str,
+        keys: Iterable[tuple],
+        values: tuple,
+        *,
+        generation: int,
+        expires: Optional[float],
+        max_size: int,
+    ):
+        if generation != self.generations[table]:
+            return
+        if expires is not None and expires <= time.time():
+            return
+
+        rows = self.tables.setdefault(table, OrderedDict())
+        for key in keys:
+            rows[key] = (values, expires)
+            rows.move_to_end(key)
+        while len(rows) > max_size:
+            rows.popitem(last=False)
+
+    def invalidate(self, tables: Iterable[str]):
+        for table in tables:
+            self.generations[table] += 1
+            self.tables.pop(table, None)
+
+    def on_change(self, tables: Optional[frozenset[str]]):
+        # Changes made by other connections may have touched any table
+        self.invalidate(
+            tables if tables is not None else [*self.generations, *self.tables]
+        )
+
+
+row_caches: WeakKeyDictionary = WeakKeyDictionary()
+
+
+def get_row_cache(db) -> RowCache:
+    if db not in row_caches:
+        row_caches[db] = RowCache()
+        get_changes(db).listen(row_caches[db].on_change)
+    return row_caches[db]
+
+
 def sqldatarow(
     table_name,
     *,
     primary_key: Optional[tuple[str, ...]] = None,
     view_name: Optional[str] = None,
+    unique: tuple[str, ...] = (),
+    cache_size: int = 0,
+    invalidates: tuple[str, ...] = (),
 ):
+    """Turns a dataclass into a row of table_name.
+
+    Rows of classes with a cache_size are kept in the per-database RowCache
+    when they are looked up by primary key or by one of the unique columns.
+    invalidates lists the tables other than table_name that the table's
+    triggers write to, so writes also invalidate their cached rows."""
+
     def wrapper(parent):
         nonlocal primary_key
         if primary_key is None:
             primary_key = (dataclasses.fields(parent)[0].name,)
 
+        # Column sets a single row can be looked up by
+        cache_keys = [tuple(sorted(notnone(primary_key)))] + [(k,) for k in unique]
+        invalidated_tables = (table_name, *invalidates)
+        # Rows can define when they go stale on their own, e.g. when a
+        # virtual column depends on the current time
+        cache_expiry = getattr(parent, "cache_expiry", lambda row: None)
+
+        # Column metadata can't change after the dataclass has been declared,
+        # so compute it once instead of on every statement build. Columns are
+        # kept in field order, which is also the order of SELECT lists, so rows
+        # can be hydrated by position.
+        fields = dataclasses.fields(parent)
+        column_names = tuple(f.name for f in fields)
+        non_virtual_column_names = tuple(
+            f.name for f in fields if not "virtual" in f.metadata
+        )
+        foreign_keys = {
+            f.name: f.metadata["foreign_key"]
+            for f in fields
+            if "foreign_key" in f.metadata
+        }
+
         class _(parent):
+            __slots__ = ("_changed",)
+
+            # Compiled SQL keyed by (statement kind, where-keys, logic, columns)
+            _statement_cache: dict[tuple, str] = {}
+
+            _readonly = False
+
             def __init__(self, *args, **kwargs):
+                # Assignments made by the dataclass __init__ aren't changes
+                self.clear_changes()
                 super().__init__(*args, **kwargs)
-                self._changed = set()
+                self.clear_changes()
 
             def __setattr__(self, prop, val):
-                if hasattr(self, "_changed"):
-                    self._changed.add(prop)
                 super().__setattr__(prop, val)
+                object.__setattr__(self, "_changed", self._changed | {prop})
+
+            def clear_changes(self):
+                # Unchanged rows share one immutable empty set, so hydrating
+                # rows doesn't allocate anything for change tracking.
+                object.__setattr__(self, "_changed", NO_CHANGES)
 
             @classmethod
             @property
@@ -126,8 +292,45 @@ def sqldatarow(
                         {join(comparisons, sep=f' {logic} ')}
                 """
 
+            @classmethod
+            def where_conditions(
+                cls,
+                where: Iterable[str],
+                *,
+                logic: Literal["OR", "AND"] = "OR",
+                condition: Optional[str] = None,
+                tenant: bool = False,
+                qualifier: str = "",
+            ) -> list[str]:
+                conditions = []
+                comparisons = cls.placeholder_compare(
+                    {f"{qualifier}{k}": k for k in where}
+                )
+                if len(comparisons):
+                    conditions.append(f"({join(comparisons, sep=f' {logic} ')})")
+                if condition is not None:
+                    conditions.append(f"({condition})")
+                if tenant:
+                    conditions.append(f"{qualifier}{TENANT_COLUMN} = :_tenant")
+                return conditions
+
+            @classmethod
+            def where_clause(cls, where: Iterable[str], **kwargs) -> str:
+                conditions = cls.where_conditions(where, **kwargs)
+                if not len(conditions):
+                    return ""
+                return f"WHERE {join(conditions, sep=' AND ')}"
+
+            @staticmethod
+            def bind(db, parameters: Mapping) -> Mapping:
+                """Adds the tenant of db to a statement's parameters"""
+                tenant = get_tenant(db)
+                if tenant is None:
+                    return parameters
+                return {**parameters, "_tenant": tenant}
+
             def primary_key_match(self):
-                return {k: self.__dict__[k] for k in notnone(primary_key)}
+                return {k: getattr(self, k) for k in notnone(primary_key)}
 
             @staticmethod
             def placeholder_compare(names: Iterable[str]) -> list[str]:
@@ -137,8 +340,14 @@ def sqldatarow(
 
             @classmethod
             def from_row(cls, cursor, row: tuple):
-                data = {k: v for k, v in zip(cls.column_names, row)}
-                return cls(**data)
+                # Rows are selected in column_names order, so they can be
+                # hydrated by position without going through __init__.
+                self = object.__new__(cls)
+                for name, value in zip(column_names, row):
+                    object.__setattr__(self, name, value)
+                if not cls._readonly:
+                    object.__setattr__(self, "_changed", NO_CHANGES)
+                return self
 
             @classmethod
             def from_partial(cls, partial: dict):
@@ -149,17 +358,13 @@ def sqldatarow(
 
             @classmethod
             @property
-            def column_names(cls) -> set[str]:
-                return {f.name for f in dataclasses.fields(cls)}
+            def column_names(cls) -> tuple[str, ...]:
+                return column_names
 
             @classmethod
             @property
-            def non_virtual_column_names(cls) -> set[str]:
-                return {
-                    f.name
-                    for f in dataclasses.fields(cls)
-                    if not "virtual" in f.metadata
-                }
+            def non_virtual_column_names(cls) -> tuple[str, ...]:
+                return non_virtual_column_names
 
             @staticmethod
             def placeholders(names: Iterable[str]):
@@ -167,45 +372,240 @@ def sqldatarow(
 
             @classmethod
             def select_stmt(
-                cls, where: Iterable[str] = [], *, logic: Literal["AND", "OR"] = "OR"
+                cls,
+                where: Iterable[str] = [],
+                *,
+                logic: Literal["AND", "OR"] = "OR",
+                condition: Optional[str] = None,
+                tenant: bool = False,
             ) -> str:
-                return f"""
+                key = ("select", tuple(where), logic, condition, tenant)
+                if key in cls._statement_cache:
+                    return cls._statement_cache[key]
+
+                sql = f"""
                     SELECT
                         {join(cls.column_names)}
                     FROM
                         {cls.view_name}
-                    {cls.where_expr(where, logic=logic)}
+                    {cls.where_clause(where, logic=logic, condition=condition, tenant=tenant)}
                 """
+                cls._statement_cache[key] = sql
+                return sql
 
             @classmethod
             @asynccontextmanager
             async def select(
-                cls, db, where: Mapping[str, str], logic: Literal["AND", "OR"] = "OR"
+                cls,
+                db,
+                where: Mapping[str, str],
+                logic: Literal["AND", "OR"] = "OR",
+                *,
+                condition: Optional[str] = None,
+                readonly: bool = False,
             ):
-                async with db.execute(
-                    cls.select_stmt(where.keys(), logic=logic), where
-                ) as cursor:
-                    cursor.row_factory = cls.from_row
+                row_cls = cls.ReadOnly if readonly else cls
+                sql = cls.select_stmt(
+                    where.keys(),
+                    logic=logic,
+                    condition=condition,
+                    tenant=get_tenant(db) is not None,
+                )
+                async with db.execute(sql, cls.bind(db, where)) as cursor:
+                    cursor.row_factory = row_cls.from_row
                     yield cursor
 
+            @classmethod
+            def cache_key(
+                cls, where: Mapping[str, str], logic: Literal["AND", "OR"] = "OR"
+            ) -> Optional[tuple]:
+                if not cache_size:
+                    return None
+                names = tuple(sorted(where))
+                if names not in cache_keys or (len(names) > 1 and logic != "AND"):
+                    return None
+                return (names, tuple(where[name] for name in names))
+
             @classmethod
             async def select_fetchone(
-                cls, db, where: Mapping[str, str], logic: Literal["AND", "OR"] = "OR"
+                cls,
+                db,
+                where: Mapping[str, str],
+                logic: Literal["AND", "OR"] = "OR",
+                *,
+                readonly: bool = False,
             ) -> "_":
-                async with cls.select(db, where, logic) as cursor:
-                    return await cursor.fetchone()
+                row_cls = cls.ReadOnly if readonly else cls
+                key = cls.cache_key(where, logic)
+                if key is None:
+                    async with cls.select(
+                        db, where, logic, readonly=readonly
+                    ) as cursor:
+                        return await cursor.fetchone()
+
+                row_cache = get_row_cache(db)
+                values = row_cache.get(table_name, key)
+                if values is not None:
+                    return row_cls.from_row(None, values)
+
+                generation = row_cache.generations[table_name]
+                async with cls.select(db, where, logic, readonly=readonly) as cursor:
+                    row = await cursor.fetchone()
+                # Reads inside a transaction may see uncommitted writes
+                if row is not None and not db.in_transaction:
+                    row.store_in_cache(db, key, generation=generation)
+                return row
+
+            def store_in_cache(self, db, *lookup_keys: tuple, generation: int):
+                keys = [
+                    (names, tuple(getattr(self, name) for name in names))
+                    for names in cache_keys
+                ]
+                get_row_cache(db).put(
+                    table_name,
+                    [*keys, *lookup_keys],
+                    tuple(getattr(self, name) for name in column_names),
+                    generation=generation,
+                    expires=cache_expiry(self),
+                    max_size=cache_size,
+                )
+
+            @classmethod
+            def invalidate_cache(cls, db):
+                get_row_cache(db).invalidate(invalidated_tables)
+                notify_changes(db, invalidated_tables)
+
+            @classmethod
+            def page_stmt(
+                cls,
+                where: Iterable[str] = [],
+                *,
+                logic: Literal["AND", "OR"] = "OR",
+                condition: Optional[str] = None,
+                after: bool = False,
+                before: bool = False,
+                tenant: bool = False,
+            ) -> str:
+                key = ("page", tuple(where), logic, condition, after, before, tenant)
+                if key in cls._statement_cache:
+                    return cls._statement_cache[key]
+
+                keys = notnone(primary_key)
+                conditions = cls.where_conditions(
+                    where, logic=logic, condition=condition, tenant=tenant
+                )
+                if after or before:
+                    key_placeholders = cls.placeholders(f"_key_{k}" for k in keys)
+                    conditions.append(
+                        f"({join(keys)}) {'<' if before else '>'} ({join(key_placeholders)})"
+                    )
+                order = "DESC" if before else "ASC"
+
+                sql = f"""
+                    SELECT
+                        {join(cls.column_names)}
+                    FROM
+                        {cls.view_name}
+                    {f"WHERE {join(conditions, sep=' AND ')}" if len(conditions) else ""}
+                    ORDER BY
+                        {join(f"{k} {order}" for k in keys)}
+                    LIMIT :_limit
+                """
+                cls._statement_cache[key] = sql
+                return sql
+
+            @classmethod
+            async def select_page(
+                cls,
+                db,
+                where: Mapping[str, str] = {},
+                logic: Literal["AND", "OR"] = "OR",
+                *,
+                condition: Optional[str] = None,
+                after: Optional[Mapping[str, str]] = None,
+                before: Optional[Mapping[str, str]] = None,
+                limit: int = 10,
+                readonly: bool = False,
+            ) -> list["_"]:
+                """Selects up to limit rows in primary key order.
+
+                Pages are found by seeking past the primary key of the last
+                (after) or first (before) row of an adjacent page instead of
+                scanning over an OFFSET, so every page costs the same."""
+                assert after is None or before is None
+                sql = cls.page_stmt(
+                    where.keys(),
+                    logic=logic,
+                    condition=condition,
+                    after=after is not None,
+                    before=before is not None,
+                    tenant=get_tenant(db) is not None,
+                )
+                parameters = dict(cls.bind(db, where))
+                parameters["_limit"] = limit
+                for k, v in (after or before or {}).items():
+                    parameters[f"_key_{k}"] = v
+
+                row_cls = cls.ReadOnly if readonly else cls
+                async with db.execute(sql, parameters) as cursor:
+                    cursor.row_factory = row_cls.from_row
+                    rows = await cursor.fetchall()
+                if before is not None:
+                    rows.reverse()
+                return rows
+
+            @classmethod
+            async def select_pages(
+                cls,
+                db,
+                where: Mapping[str, str] = {},
+                logic: Literal["AND", "OR"] = "OR",
+                *,
+                condition: Optional[str] = None,
+                page_size: int = 10,
+                readonly: bool = False,
+            ):
+                """Yields all matching rows in pages of up to page_size rows."""
+                after = None
+                while True:
+                    page = await cls.select_page(
+                        db,
+                        where,
+                        logic,
+                        condition=condition,
+                        after=after,
+                        limit=page_size,
+                        readonly=readonly,
+                    )
+                    if not len(page):
+                        return
+                    yield page
+                    if len(page) < page_size:
+                        return
+                    after = page[-1].primary_key_match()
 
             async def refresh(self, db):
                 where = self.primary_key_match()
-                new = await self.select_fetchone(db, where)
-                self.__dict__.update(new.__dict__)
+                new = await self.select_fetchone(db, where, readonly=True)
+                for name in column_names:
+                    object.__setattr__(self, name, getattr(new, name))
+                if not self._readonly:
+                    self.clear_changes()
                 return self
 
             @classmethod
             def exists_stmt(
-                cls, where: Iterable[str] = [], *, logic: Literal["AND", "OR"] = "OR"
+                cls,
+                where: Iterable[str] = [],
+                *,
+                logic: Literal["AND", "OR"] = "OR",
+                tenant: bool = False,
             ) -> str:
-                return f"""
+                key = ("exists", tuple(where), logic, tenant)
+                if key in cls._statement_cache:
+                    return cls._statement_cache[key]
+
+                sql = f"""
                     SELECT
                         COUNT(1)
                     WHERE EXISTS (
@@ -213,145 +613,379 @@ def sqldatarow(
                             1
                         FROM
                             {cls.table_name}
-                        {cls.where_expr(where, logic=logic)}
+                        {cls.where_clause(where, logic=logic, tenant=tenant)}
                     )
                 """
+                cls._statement_cache[key] = sql
+                return sql
 
             @classmethod
             async def exists(
                 cls, db, where: Mapping[str, str], *, logic: Literal["AND", "OR"] = "OR"
             ) -> bool:
-                async with db.execute(
-                    cls.exists_stmt(where.keys(), logic=logic), where
-                ) as cursor:
+                key = cls.cache_key(where, logic)
+                if key is not None and get_row_cache(db).get(table_name, key):
+                    return True
+                sql = cls.exists_stmt(
+                    where.keys(), logic=logic, tenant=get_tenant(db) is not None
+                )
+                async with db.execute(sql, cls.bind(db, where)) as cursor:
                     result = await cursor.fetchone()
                 return result[0]
 
             @classmethod
             def join_select_stmt(
                 cls,
-                foreign_key: str,
-                where: Iterable[str],
+                foreign_keys: str | Iterable[str],
+                where: Iterable[str] = [],
                 logic: Literal["OR", "AND"] = "OR",
+                *,
+                in_column: Optional[str] = None,
+                in_count: int = 0,
+                tenant: bool = False,
             ):
-                foreign_cls = cls.get_foreign_key_class(foreign_key)
+                """Selects rows joined with the rows of one or more foreign keys.
+
+                With in_column, rows are additionally filtered to in_column
+                values bound to the in_count placeholders :_in_0, :_in_1..."""
+                if isinstance(foreign_keys, str):
+                    foreign_keys = (foreign_keys,)
+                foreign_keys = tuple(foreign_keys)
+                key = (
+                    "join_select",
+                    foreign_keys,
+                    tuple(where),
+                    logic,
+                    in_column,
+                    in_count,
+                    tenant,
+                )
+                if key in cls._statement_cache:
+                    return cls._statement_cache[key]
+
+                foreign_classes = [cls.get_foreign_key_class(k) for k in foreign_keys]
+
+                columns = [f"{cls.view_name}.{c}" for c in cls.column_names]
+                joins = []
+                for foreign_key, foreign_cls in zip(foreign_keys, foreign_classes):
+                    columns += (
+                        f"{foreign_cls.view_name}.{c}" for c in foreign_cls.column_names
+                    )
+                    joins.append(
+                        f"INNER JOIN {foreign_cls.view_name} ON {foreign_cls.view_name}.{foreign_key} = {cls.view_name}.{foreign_key}"
+                    )
 
-                where = {f"{cls.view_name}.{k}": k for k in where}
-                columns = itertools.chain(
-                    (f"{cls.view_name}.{c}" for c in cls.column_names),
-                    (f"{foreign_cls.view_name}.{c}" for c in foreign_cls.column_names),
+                conditions = cls.where_conditions(
+                    where, logic=logic, tenant=tenant, qualifier=f"{cls.view_name}."
                 )
+                if in_column is not None:
+                    in_placeholders = cls.placeholders(
+                        f"_in_{i}" for i in range(in_count)
+                    )
+                    conditions.append(
+                        f"{cls.view_name}.{in_column} IN ({join(in_placeholders)})"
+                    )
 
-                return f"""
+                sql = f"""
                     SELECT
                         {join(columns)}
-                    FROM {foreign_cls.view_name}
-                    INNER JOIN {cls.table_name} ON {foreign_cls.view_name}.{foreign_key} = {cls.view_name}.{foreign_key}
-                    {cls.where_expr(where, logic=logic)}
+                    FROM {cls.view_name}
+                    {join(joins, sep=" ")}
+                    {f"WHERE {join(conditions, sep=' AND ')}" if len(conditions) else ""}
                 """
+                cls._statement_cache[key] = sql
+                return sql
 
             @classmethod
             def get_foreign_key_class(cls, key: str) -> Type["_"]:
-                field = next(
-                    (field for field in dataclasses.fields(cls) if field.name == key),
-                    None,
-                )
-                if field is None or "foreign_key" not in field.metadata:
+                if key not in foreign_keys:
                     raise ValueError(f"Field {key} is not a foreign key field")
-                return field.metadata["foreign_key"]
+                return foreign_keys[key]
+
+            @classmethod
+            def join_row_factory(cls, foreign_keys: Iterable[str], readonly: bool):
+                row_classes = [cls] + [
+                    cls.get_foreign_key_class(k) for k in foreign_keys
+                ]
+                if readonly:
+                    row_classes = [row_cls.ReadOnly for row_cls in row_classes]
+
+                slices = []
+                start = 0
+                for row_cls in row_classes:
+                    end = start + len(row_cls.column_names)
+                    slices.append((row_cls.from_row, start, end))
+                    start = end
+
+                return lambda cursor, row: tuple(
+                    from_row(cursor, row[start:end]) for from_row, start, end in slices
+                )
 
             @classmethod
             @asynccontextmanager
             async def join_select(
                 cls,
                 db,
-                foreign_key: str,
+                foreign_keys: str | Iterable[str],
                 where: Iterable[str],
                 logic: Literal["OR", "AND"] = "OR",
+                *,
+                readonly: bool = False,
             ):
-                sql = cls.join_select_stmt(foreign_key, where, logic)
-                foreign_cls = cls.get_foreign_key_class(foreign_key)
-                cls_column_count = sum(1 for _ in cls.column_names)
-
-                async with db.execute(sql, where) as cursor:
-                    cursor.row_factory = lambda cursor, row: (
-                        cls.from_row(cursor, row[0:cls_column_count]),
-                        foreign_cls.from_row(cursor, row[cls_column_count:]),
-                    )
+                sql, parameters, row_factory = cls.join_select_args(
+                    db, foreign_keys, where, logic, readonly=readonly
+                )
+                async with db.execute(sql, parameters) as cursor:
+                    cursor.row_factory = row_factory
                     yield cursor
 
+            @classmethod
+            def join_select_args(
+                cls,
+                db,
+                foreign_keys: str | Iterable[str],
+                where: Iterable[str],
+                logic: Literal["OR", "AND"] = "OR",
+                *,
+                readonly: bool = False,
+            ) -> tuple[str, Mapping, Callable]:
+                """The statement, parameters and row factory of join_select, for
+                running it with run_sync"""
+                if isinstance(foreign_keys, str):
+                    foreign_keys = (foreign_keys,)
+                sql = cls.join_select_stmt(
+                    foreign_keys, where, logic, tenant=get_tenant(db) is not None
+                )
+                row_factory = cls.join_row_factory(foreign_keys, readonly)
+                return sql, cls.bind(db, where), row_factory
+
+            @classmethod
+            async def eager_load(
+                cls,
+                db,
+                foreign_key: str,
+                parents: Iterable,
+                foreign_keys: str | Iterable[str] = (),
+                *,
+                readonly: bool = False,
+            ) -> dict:
+                """Loads the rows referencing each of the parents through foreign_key.
+
+                The rows of all parents are selected with one IN query (per
+                IN_BATCH_SIZE parents) instead of one query per parent. Rows of
+                foreign_keys are joined in like join_select does. Returns the
+                rows (or join tuples) grouped by the parents' foreign_key value.
+                """
+                if isinstance(foreign_keys, str):
+                    foreign_keys = (foreign_keys,)
+                foreign_keys = tuple(foreign_keys)
+                row_factory = cls.join_row_factory(foreign_keys, readonly)
+
+                values = list(dict.fromkeys(getattr(p, foreign_key) for p in parents))
+                children: dict = {value: [] for value in values}
+                for start in range(0, len(values), IN_BATCH_SIZE):
+                    batch = values[start : start + IN_BATCH_SIZE]
+                    # Padding the batch to a power of two by repeating its last
+                    # value keeps the number of distinct statements small
+                    in_count = 1 << (len(batch) - 1).bit_length()
+                    parameters = {
+                        f"_in_{i}": batch[min(i, len(batch) - 1)]
+                        for i in range(in_count)
+                    }
+                    sql = cls.join_select_stmt(
+                        foreign_keys,
+                        in_column=foreign_key,
+                        in_count=in_count,
+                        tenant=get_tenant(db) is not None,
+                    )
+                    async with db.execute(sql, cls.bind(db, parameters)) as cursor:
+                        cursor.row_factory = row_factory
+                        async for row in cursor:
+                            value = getattr(row[0], foreign_key)
+                            children[value].append(row if len(foreign_keys) else row[0])
+                return children
+
             async def join_fetchone(self, db, foreign_key):
                 where = self.primary_key_match()
                 async with self.join_select(db, foreign_key, where) as cursor:
                     return await cursor.fetchone()
 
-            def insert_stmt(self) -> str:
-                filtered_columns = [
+            def insert_stmt(self, *, tenant: bool = False) -> str:
+                filtered_columns = tuple(
                     k for k, v in self.placeholder_values.items() if v is not None
-                ]
-                return f"""
+                )
+                key = ("insert", filtered_columns, tenant)
+                if key in self._statement_cache:
+                    return self._statement_cache[key]
+
+                columns = list(filtered_columns)
+                placeholders = self.placeholders(filtered_columns)
+                if tenant:
+                    columns.append(TENANT_COLUMN)
+                    placeholders.append(":_tenant")
+                sql = f"""
                     INSERT INTO
-                        {self.table_name} ({join(filtered_columns)})
+                        {self.table_name} ({join(columns)})
                     VALUES
-                        ({join(self.placeholders(filtered_columns))})
+                        ({join(placeholders)})
                 """
+                self._statement_cache[key] = sql
+                return sql
+
+            def insert_args(self, db) -> tuple[str, Mapping]:
+                return (
+                    self.insert_stmt(tenant=get_tenant(db) is not None),
+                    self.bind(db, self.placeholder_values),
+                )
 
             async def insert(self, db):
-                async with db.execute(
-                    self.insert_stmt(), self.placeholder_values
-                ) as cursor:
-                    await db.commit()
-                    self._changed.clear()
+                async with transaction(db), db.execute(*self.insert_args(db)) as cursor:
+                    self.invalidate_cache(db)
+                    self.clear_changes()
                     if len(notnone(primary_key)) == 1:
                         setattr(self, notnone(primary_key)[0], cursor.lastrowid)
                 return self
 
+            @classmethod
+            async def insert_many(cls, db, rows: Iterable["_"]) -> list["_"]:
+                """Inserts all rows in a single unit of work.
+
+                sqlite3 only reports lastrowid for single statements, so rows of
+                tables with a rowid primary key that still need one are inserted
+                one by one. All other rows are inserted with executemany."""
+                rows = list(rows)
+                rowid = (
+                    notnone(primary_key)[0] if len(notnone(primary_key)) == 1 else None
+                )
+                tenant = get_tenant(db) is not None
+                async with transaction(db):
+                    for sql, group in itertools.groupby(
+                        rows, lambda row: row.insert_stmt(tenant=tenant)
+                    ):
+                        group = list(group)
+                        if rowid is not None and any(
+                            getattr(row, rowid) is None for row in group
+                        ):
+                            for row in group:
+                                async with db.execute(
+                                    sql, cls.bind(db, row.placeholder_values)
+                                ) as cursor:
+                                    object.__setattr__(row, rowid, cursor.lastrowid)
+                        else:
+                            async with db.executemany(
+                                sql,
+                                [cls.bind(db, row.placeholder_values) for row in group],
+                            ):
+                                pass
+                    cls.invalidate_cache(db)
+                for row in rows:
+                    row.clear_changes()
+                return rows
+
             @classmethod
             def update_stmt(
                 cls,
                 where: Iterable[str] = [],
                 columns: Optional[set[str]] = None,
+                *,
+                tenant: bool = False,
             ):
-                placeholders = set(cls.non_virtual_column_names)
+                placeholders = cls.non_virtual_column_names
                 if columns is not None:
                     assert len(columns) != 0
-                    placeholders &= set(columns)
+                    placeholders = tuple(c for c in placeholders if c in columns)
+
+                key = ("update", tuple(where), placeholders, tenant)
+                if key in cls._statement_cache:
+                    return cls._statement_cache[key]
 
                 sql = f"""
                     UPDATE
                         {cls.table_name}
                     SET
                         {join(cls.placeholder_compare(placeholders))}
-                    {cls.where_expr(where)}
+                    {cls.where_clause(where, logic="AND", tenant=tenant)}
                 """
+                cls._statement_cache[key] = sql
                 return sql
 
-            async def update(self, db) -> int:
-                cursor = await db.execute(
+            def update_args(self, db) -> tuple[str, Mapping]:
+                return (
                     self.update_stmt(
                         self.primary_key_match().keys(),
                         self._changed,
+                        tenant=get_tenant(db) is not None,
                     ),
-                    self.placeholder_values,
+                    self.bind(db, self.placeholder_values),
                 )
-                await db.commit()
-                self._changed.clear()
-                return cursor.rowcount
+
+            async def update(self, db) -> int:
+                async with transaction(db), db.execute(*self.update_args(db)) as cursor:
+                    self.invalidate_cache(db)
+                    self.clear_changes()
+                    return cursor.rowcount
+
+            @classmethod
+            async def update_many(cls, db, rows: Iterable["_"]) -> int:
+                """Writes the changes of all rows in a single unit of work.
+
+                Returns the total number of updated rows. executemany only
+                reports the sum over all parameter sets, not per-row counts."""
+                rows = [row for row in rows if row.changed]
+                rowcount = 0
+                tenant = get_tenant(db) is not None
+                async with transaction(db):
+                    for sql, group in itertools.groupby(
+                        rows,
+                        lambda row: row.update_stmt(
+                            notnone(primary_key), row._changed, tenant=tenant
+                        ),
+                    ):
+                        async with db.executemany(
+                            sql, [cls.bind(db, row.placeholder_values) for row in group]
+                        ) as cursor:
+                            rowcount += cursor.rowcount
+                    cls.invalidate_cache(db)
+                for row in rows:
+                    row.clear_changes()
+                return rowcount
 
             async def delete(self, db):
                 where = self.primary_key_match()
-                sql = self.delete_stmt(where.keys())
-                cursor = await db.execute(sql, where)
-                await db.commit()
-                return cursor.rowcount
+                sql = self.delete_stmt(where.keys(), tenant=get_tenant(db) is not None)
+                async with transaction(db), db.execute(
+                    sql, self.bind(db, where)
+                ) as cursor:
+                    self.invalidate_cache(db)
+                    return cursor.rowcount
 
             @classmethod
-            def delete_stmt(cls, where: Iterable[str]):
-                return f"""
+            async def delete_many(cls, db, rows: Iterable["_"]) -> int:
+                """Deletes all rows in a single unit of work.
+
+                Returns the total number of deleted rows."""
+                sql = cls.delete_stmt(
+                    notnone(primary_key), tenant=get_tenant(db) is not None
+                )
+                async with transaction(db), db.executemany(
+                    sql, [cls.bind(db, row.primary_key_match()) for row in rows]
+                ) as cursor:
+                    cls.invalidate_cache(db)
+                    return cursor.rowcount
+
+            @classmethod
+            def delete_stmt(cls, where: Iterable[str], *, tenant: bool = False):
+                key = ("delete", tuple(where), tenant)
+                if key in cls._statement_cache:
+                    return cls._statement_cache[key]
+
+                sql = f"""
                     DELETE FROM
                         {cls.table_name}
-                    {cls.where_expr(where)}
+                    {cls.where_clause(where, logic="AND", tenant=tenant)}
                 """
+                cls._statement_cache[key] = sql
+                return sql
 
             @property
             def placeholder_values(self):
@@ -363,6 +997,27 @@ def sqldatarow(
             def changed(self):
                 return len(self._changed) > 0
 
+        class ReadOnly(_):
+            """Row variant without change tracking. Rows can't be modified."""
+
+            __slots__ = ()
+
+            _readonly = True
+
+            def __init__(self, *args, **kwargs):
+                raise TypeError("Read-only rows can only be hydrated from a select")
+
+            def __setattr__(self, prop, val):
+                raise dataclasses.FrozenInstanceError(
+                    f"cannot assign to field {prop!r} of a read-only row"
+                )
+
+            @property
+            def changed(self):
+                return False
+
+        _.ReadOnly = ReadOnly
+
         return _
 
     return wrapper
@@ -397,8 +1052,9 @@ class LetsTryBallotVoteView(discord.ui.View):
             ballot_id=self.ballot.ballot_id,
             discord_user_id=interaction.user.id,
         )
+        ballot_games = None
         try:
-            await vote.insert(self.db)
+            ballot_games = await vote.cast(self.db)
         except IntegrityError as ie:
             if "ballot not open" in str(ie):
                 return await interaction.response.edit_message(
@@ -411,8 +1067,11 @@ class LetsTryBallotVoteView(discord.ui.View):
             content=f"*☑️ Vote recorded.*", view=None, delete_after=3
         )
 
-        if self.embed_message is not None:
-            embed = await LetsTryBallotGame.as_embed(self.db, self.ballot)
+        # The votes only changed if the vote was recorded
+        if self.embed_message is not None and ballot_games is not None:
+            embed = self.ballot.as_embed()
+            for ballot_game, game in ballot_games:
+                LetsTryBallotGame.add_to_embed(embed, ballot_game, game)
             await self.embed_message.edit(embed=embed)
 
     def add(self, ballot_game: "LetsTryBallotGame", game: "LetsTryGame"):
@@ -509,8 +1168,9 @@ class LetsTryBallotEditView(discord.ui.View):
     async def update_ballot(self, interaction):
         db = self.db
 
-        await self.ballot.update(db)
-        await self.ballot.refresh(db)
+        async with transaction(db):
+            await self.ballot.update(db)
+            await self.ballot.refresh(db)
 
         coros = [
             self.ballot.update_thread(interaction.guild),
@@ -569,7 +1229,7 @@ class LetsTryBallotVoteNowView(discord.ui.View):
             "discord_user_id": interaction.user.id,
         }
         async with LetsTryBallotVotes.join_select(
-            self.db, "game_id", where, "AND"
+            self.db, "game_id", where, "AND", readonly=True
         ) as cursor:
             async for _, game in cursor:
                 return await interaction.response.send_message(
@@ -579,11 +1239,13 @@ class LetsTryBallotVoteNowView(discord.ui.View):
                 )
 
         where = self.ballot.primary_key_match()
-        ballot = await LetsTryBallot.select_fetchone(self.db, where)
+        ballot = await LetsTryBallot.select_fetchone(self.db, where, readonly=True)
 
         view = LetsTryBallotVoteView(self.db, ballot, interaction.message)
 
-        async with LetsTryBallotGame.join_select(self.db, "game_id", where) as cursor:
+        async with LetsTryBallotGame.join_select(
+            self.db, "game_id", where, readonly=True
+        ) as cursor:
             async for ballot_game, game in cursor:
                 view.add(ballot_game, game)
 
@@ -602,8 +1264,87 @@ class LetsTryBallotVoteNowView(discord.ui.View):
         return await super().on_timeout()
 
 
-@sqldatarow("letstry_ballots", view_name="letstry_ballots_view")
-@dataclass
+class LetsTryGamesListView(discord.ui.View):
+    def __init__(
+        self,
+        db,
+        where: Mapping[str, str],
+        condition: Optional[str] = None,
+        *,
+        page_size: int = 10,
+        timeout=180,
+    ):
+        super().__init__(timeout=timeout)
+        self.message: Optional[discord.Message] = None
+        self.db = db
+        self.where = where
+        self.condition = condition
+        self.page_size = page_size
+        self.page: list["LetsTryGame"] = []
+        self.has_previous = False
+        self.has_next = False
+
+    @property
+    def embeds(self) -> list[discord.Embed]:
+        return [game.as_embed() for game in self.page]
+
+    async def fetch_page(self, **kwargs):
+        # Fetching one row beyond the page tells whether there is another
+        # page in that direction
+        page = await LetsTryGame.select_page(
+            get_reader(self.db),
+            self.where,
+            condition=self.condition,
+            limit=self.page_size + 1,
+            readonly=True,
+            **kwargs,
+        )
+        has_more = len(page) > self.page_size
+        if "before" in kwargs:
+            self.page = page[-self.page_size :]
+            self.has_previous = has_more
+            self.has_next = True
+        else:
+            self.page = page[: self.page_size]
+            self.has_previous = "after" in kwargs
+            self.has_next = has_more
+
+        self.previous_button.disabled = not self.has_previous
+        self.next_button.disabled = not self.has_next
+        return self.page
+
+    @discord.ui.button(
+        label="Previous", style=discord.ButtonStyle.secondary, emoji="◀️"
+    )
+    async def previous_button(
+        self, interaction: discord.Interaction, button: discord.ui.Button
+    ):
+        await self.fetch_page(before=self.page[0].primary_key_match())
+        await interaction.response.edit_message(embeds=self.embeds, view=self)
+
+    @discord.ui.button(label="Next", style=discord.ButtonStyle.secondary, emoji="▶️")
+    async def next_button(
+        self, interaction: discord.Interaction, button: discord.ui.Button
+    ):
+        await self.fetch_page(after=self.page[-1].primary_key_match())
+        await interaction.response.edit_message(embeds=self.embeds, view=self)
+
+    async def on_timeout(self):
+        message = self.message
+        if message is not None:
+            await message.edit(view=None)
+        self.message = None
+        return await super().on_timeout()
+
+
+@sqldatarow(
+    "letstry_ballots",
+    view_name="letstry_ballots_view",
+    unique=("discord_thread_id",),
+    cache_size=ROW_CACHE_SIZE,
+    invalidates=("letstry_games",),
+)
+@dataclass(slots=True)
 class LetsTryBallot:
     ballot_id: int
     discord_thread_id: int
@@ -634,6 +1375,37 @@ class LetsTryBallot:
         embed.add_field(name=" ", value=" ")
         return embed
 
+    def cache_expiry(self) -> Optional[float]:
+        # The state column is computed from the current time, so a cached
+        # ballot goes stale when it opens or closes. SQLite compares to
+        # DATETIME('NOW') in whole seconds, so ballots that just passed a date
+        # expire right away rather than risk caching the previous state.
+        now = datetime.now(tz=timezone.utc)
+        dates = [
+            to_datetime_utc(date)
+            for date in (self.date_open, self.date_close)
+            if to_datetime_utc(date) > now - timedelta(seconds=2)
+        ]
+        return min(dates).timestamp() if len(dates) else None
+
+    async def finalize(self, db) -> list[tuple["LetsTryBallotGame", "LetsTryGame"]]:
+        """Finalizes the ballot, which elects its winner. Returns the ballot's
+        games with their final votes."""
+        self.finalized = True
+        update = self.update_args(db)
+        select = LetsTryBallotGame.join_select_args(
+            db, "game_id", self.primary_key_match(), readonly=True
+        )
+
+        def finalize(connection):
+            connection.execute(*update)
+            return fetch_rows(connection, *select)
+
+        ballot_games = await run_sync_transaction(db, finalize)
+        self.invalidate_cache(db)
+        self.clear_changes()
+        return ballot_games
+
     async def update_thread(self, guild):
         thread = guild.get_thread(self.discord_thread_id)
         if not self.staging:
@@ -642,8 +1414,8 @@ class LetsTryBallot:
             )
 
 
-@sqldatarow("letstry_games")
-@dataclass
+@sqldatarow("letstry_games", unique=("name", "url"), cache_size=ROW_CACHE_SIZE)
+@dataclass(slots=True)
 class LetsTryGame:
     game_id: int
     name: str
@@ -660,8 +1432,12 @@ class LetsTryGame:
         return embed
 
 
-@sqldatarow("letstry_ballot_games", primary_key=("ballot_id", "game_id"))
-@dataclass
+@sqldatarow(
+    "letstry_ballot_games",
+    primary_key=("ballot_id", "game_id"),
+    invalidates=("letstry_games",),
+)
+@dataclass(slots=True)
 class LetsTryBallotGame:
     votes: int
     ballot_id: int = foreign_key(LetsTryBallot)
@@ -671,7 +1447,9 @@ class LetsTryBallotGame:
     @staticmethod
     async def select_ballot_games(db, ballot: LetsTryBallot):
         where = ballot.primary_key_match()
-        async with LetsTryBallotGame.join_select(db, "game_id", where) as cursor:
+        async with LetsTryBallotGame.join_select(
+            get_reader(db), "game_id", where, readonly=True
+        ) as cursor:
             yield cursor
 
     @staticmethod
@@ -709,17 +1487,67 @@ class LetsTryBallotGame:
             else:
                 raise ie
 
+    @classmethod
+    async def recount_votes(cls, db) -> int:
+        """Recounts the votes of all ballot games from letstry_ballot_votes.
+
+        The vote triggers only add or subtract one vote, so a counter that
+        drifted (e.g. through manual edits) stays wrong until it is recounted.
+        Returns the number of repaired counters."""
+        count = """
+            SELECT
+                COUNT(*)
+            FROM
+                letstry_ballot_votes
+            WHERE
+                letstry_ballot_votes.ballot_id = letstry_ballot_games.ballot_id AND
+                letstry_ballot_votes.game_id = letstry_ballot_games.game_id
+        """
+        tenant = get_tenant(db) is not None
+        async with transaction(db):
+            cursor = await db.execute(
+                f"""
+                    UPDATE
+                        {cls.table_name}
+                    SET
+                        votes = ({count})
+                    {cls.where_clause([], condition=f"votes != ({count})", tenant=tenant)}
+                """,
+                cls.bind(db, {}),
+            )
+            cls.invalidate_cache(db)
+        return cursor.rowcount
+
 
 @sqldatarow("letstry_ballot_votes", primary_key=("ballot_id", "discord_user_id"))
-@dataclass
+@dataclass(slots=True)
 class LetsTryBallotVotes:
     discord_user_id: int
     ballot_id: int = foreign_key(LetsTryBallot)
     game_id: int = foreign_key(LetsTryGame)
 
+    async def cast(self, db) -> list[tuple[LetsTryBallotGame, LetsTryGame]]:
+        """Records the vote. Returns the ballot's games with their votes
+        including this one.
+
+        Votes cast at about the same time are committed together."""
+        insert = self.insert_args(db)
+        select = LetsTryBallotGame.join_select_args(
+            db, "game_id", {"ballot_id": self.ballot_id}, readonly=True
+        )
+
+        def cast(connection):
+            connection.execute(*insert)
+            return fetch_rows(connection, *select)
+
+        ballot_games = await run_sync_grouped(db, cast)
+        self.invalidate_cache(db)
+        self.clear_changes()
+        return ballot_games
 
-@sqldatarow("letstry_proposals")
-@dataclass
+
+@sqldatarow("letstry_proposals", invalidates=("letstry_games",))
+@dataclass(slots=True)
 class LetsTryProposal:
     discord_user_id: int
     date_created: str
@@ -750,7 +1578,9 @@ class CantVoteBallots(commands.CheckFailure):
 def is_ballot_thread():
     async def predicate(ctx):
         db = ctx.bot.get_cog("letstry").get_guild_db(ctx.guild)
-        if not await LetsTryBallot.exists(db, {"discord_thread_id": ctx.channel.id}):
+        # Not using exists() so that the following get_ballot is a cache hit
+        where = {"discord_thread_id": ctx.channel.id}
+        if await LetsTryBallot.select_fetchone(db, where, readonly=True) is None:
             raise NotBallotThread(
                 f"The command {ctx.command} can only be run from within a ballot thread."
             )
@@ -790,6 +1620,32 @@ def can_propose():
     return commands.check(predicate)
 
 
+# For the migration runner, see buffedbot.extensions.sqlite.migrate
+LETSTRY_SCHEMA = Schema("letstry", Path(__file__).parent / "sql", "letstry_versions")
+LETSTRY_CONSOLIDATED_SCHEMA = Schema(
+    "letstry (consolidated)",
+    Path(__file__).parent / "sql" / "consolidated",
+    "letstry_versions",
+)
+
+
+# Contents of the sql scripts by path, read once per process. Scripts that do
+# not exist are cached as None.
+SQL_SCRIPTS: dict[str, Optional[str]] = {}
+
+
+async def read_sql_script(path) -> Optional[str]:
+    key = str(path)
+    if key not in SQL_SCRIPTS:
+        path = AsyncPath(path)
+        if await path.exists():
+            async with aiofiles.open(path, mode="r") as file:
+                SQL_SCRIPTS[key] = await file.read()
+        else:
+            SQL_SCRIPTS[key] = None
+    return SQL_SCRIPTS[key]
+
+
 class LetsTry(
     commands.Cog,
     name="letstry",
@@ -799,9 +1655,14 @@ class LetsTry(
 
     def __init__(self, bot):
         self.bot = bot
+        self.consolidated_bootstrap = None
+        # Guild databases are bootstrapped on first access rather than on load
+        self.guild_bootstraps = {}
 
     async def cog_check(self, ctx):
-        return await commands.guild_only().predicate(ctx)
+        await commands.guild_only().predicate(ctx)
+        await self.ensure_guild_db(ctx.guild)
+        return True
 
     @commands.group(name="letstry")
     async def letstry(self, ctx):
@@ -822,23 +1683,24 @@ class LetsTry(
     async def ballots(self, ctx: commands.Context):
         """Lists ballots open for votes."""
         db = self.get_guild_db(ctx.guild)
-        sql = f"""{LetsTryBallot.select_stmt()} WHERE state in ("open", "submitted")"""
-        async with db.execute(sql) as cursor:
-            cursor.row_factory = LetsTryBallot.from_row
-            ballot = None
-            async for ballot in cursor:
-                view = LetsTryBallotVoteNowView(db, ballot)
-                embed = ballot.as_embed()
+        reader = get_reader(db)
+        async with LetsTryBallot.select(
+            reader, {}, condition="state IN ('open', 'submitted')", readonly=True
+        ) as cursor:
+            ballots = await cursor.fetchall()
+        if not len(ballots):
+            return await ctx.reply("*No ballots found.*")
 
-                async with LetsTryBallotGame.join_select(
-                    db, "game_id", ballot.primary_key_match()
-                ) as cursor:
-                    async for ballot_game, game in cursor:
-                        LetsTryBallotGame.add_to_embed(embed, ballot_game, game)
+        ballot_games = await LetsTryBallotGame.eager_load(
+            reader, "ballot_id", ballots, "game_id", readonly=True
+        )
+        for ballot in ballots:
+            view = LetsTryBallotVoteNowView(db, ballot)
+            embed = ballot.as_embed()
+            for ballot_game, game in ballot_games[ballot.ballot_id]:
+                LetsTryBallotGame.add_to_embed(embed, ballot_game, game)
 
-                view.message = await ctx.reply(embed=embed, view=view, silent=True)
-            if ballot is None:
-                await ctx.reply("*No ballots found.*")
+            view.message = await ctx.reply(embed=embed, view=view, silent=True)
 
     @can_propose()
     @letstry.command(name="propose")
@@ -927,28 +1789,18 @@ class LetsTry(
         Valid values for state are "orphaned", "submitted", "rejected", "accepted", "elected" and "done".
         """
         db = self.get_guild_db(ctx.guild)
-        cur = await db.cursor()
         if not state:
-            cursor_awaitable = db.execute(
-                f"""{LetsTryGame.select_stmt()}
-                    WHERE
-                        state NOT IN ('rejected', 'done', 'orphaned')
-                    LIMIT 10
-                """
+            view = LetsTryGamesListView(
+                db, {}, "state NOT IN ('rejected', 'done', 'orphaned')"
             )
         else:
-            where = {"state": state}
-            cursor_awaitable = db.execute(
-                f"{LetsTryGame.select_stmt(where.keys())} LIMIT 10", where
-            )
-        embeds = []
-        async with cursor_awaitable as cursor:
-            cursor.row_factory = LetsTryGame.from_row
-            async for game in cursor:
-                embeds.append(game.as_embed())
-        if not len(embeds):
+            view = LetsTryGamesListView(db, {"state": state})
+
+        if not len(await view.fetch_page()):
             return await ctx.reply("*No results.*")
-        await ctx.reply(embeds=embeds)
+        if not view.has_next:
+            return await ctx.reply(embeds=view.embeds)
+        view.message = await ctx.reply(embeds=view.embeds, view=view)
 
     async def remove_proposal(self, guild, user):
         db = self.get_guild_db(guild)
@@ -984,6 +1836,8 @@ class LetsTry(
             return await ctx.reply(
                 f'*"{url or name}" not found. Please provide name and URL to propose non-Steam games.*'
             )
+        except SteamBusyError as e:
+            return await ctx.reply(f"*{str(e)}*")
 
         if game is None:
             return await ctx.reply(
@@ -1031,18 +1885,12 @@ class LetsTry(
     async def finalize_ballot(self, guild, ballot):
         db = self.get_guild_db(guild)
 
-        ballot.finalized = True
-        await ballot.update(db)
-
         ballot_embed = ballot.as_embed()
         winner = None
-        async with LetsTryBallotGame.join_select(
-            db, "game_id", ballot.primary_key_match()
-        ) as cursor:
-            async for ballot_game, game in cursor:
-                if winner is None or winner[0].votes < ballot_game.votes:
-                    winner = ballot_game, game
-                LetsTryBallotGame.add_to_embed(ballot_embed, ballot_game, game)
+        for ballot_game, game in await ballot.finalize(db):
+            if winner is None or winner[0].votes < ballot_game.votes:
+                winner = ballot_game, game
+            LetsTryBallotGame.add_to_embed(ballot_embed, ballot_game, game)
 
         assert winner is not None
 
@@ -1089,7 +1937,7 @@ class LetsTry(
     ) -> Optional[LetsTryGame]:
         db = self.get_guild_db(guild)
 
-        where = {"name": name, "url": url}
+        where = dict_compact({"name": name, "url": url})
         return await LetsTryGame.select_fetchone(db, where)
 
     async def get_or_add_game(
@@ -1131,7 +1979,7 @@ class LetsTry(
         if url is None or name is None:
             try:
                 game = await self.get_steam_game(url or name)
-            except GameNotFoundError as e:
+            except (GameNotFoundError, SteamBusyError) as e:
                 return await ctx.reply(f"*{str(e)}*")
             else:
                 name = cast(str, game.name)
@@ -1172,8 +2020,9 @@ class LetsTry(
         )
         db = self.get_guild_db(thread.guild)
         ballot = LetsTryBallot.from_partial({"discord_thread_id": thread.id})
-        await ballot.insert(db)
-        await ballot.refresh(db)
+        async with transaction(db):
+            await ballot.insert(db)
+            await ballot.refresh(db)
 
         edit_view = LetsTryBallotEditView(db, ballot)
         edit_view.message = await thread.send(
@@ -1188,6 +2037,12 @@ class LetsTry(
         await self.finalize_ballot(ctx.guild, ballot)
         await ctx.reply(f"*Ballot finalized.*")
 
+    @ballot.command(name="recount")
+    async def ballot_recount(self, ctx):
+        db = self.get_guild_db(ctx.guild)
+        repaired = await LetsTryBallotGame.recount_votes(db)
+        await ctx.reply(f"*Recounted votes, repaired {repaired} vote counts.*")
+
     @is_ballot_thread()
     @ballot.command(name="add")
     async def ballot_add(self, ctx, *, game):
@@ -1344,22 +2199,33 @@ class LetsTry(
 
     @commands.Cog.listener()
     async def on_guild_join(self, guild):
-        await self.bootstrap_guild(guild)
+        await self.ensure_guild_db(guild)
+
+    @commands.Cog.listener()
+    async def on_guild_remove(self, guild):
+        # The guild database is gone, so it must be bootstrapped on rejoin
+        self.guild_bootstraps.pop(guild.id, None)
 
     @staticmethod
-    def get_sql_scriptpath(filename):
-        return AsyncPath(os.path.dirname(__file__), "sql", filename)
+    def get_sql_scriptpath(filename, *, consolidated=False):
+        # The consolidated database has a schema (and migrations) of its own
+        directory = ("sql", "consolidated") if consolidated else ("sql",)
+        return AsyncPath(os.path.dirname(__file__), *directory, filename)
 
     async def migrate_db(self, guild):
+        db = self.get_guild_db(guild)
+        consolidated = get_tenant(db) is not None
         version = await self.get_guild_db_version(guild)
-        migration_file = self.get_sql_scriptpath(f"migrate_from_v{version}.sql")
-        if not await migration_file.exists():
+        sql = await read_sql_script(
+            self.get_sql_scriptpath(
+                f"migrate_from_v{version}.sql", consolidated=consolidated
+            )
+        )
+        if sql is None:
             return False
 
-        print(f"> Migrating guild {guild.id} database from v{version}...", end="")
-        async with aiofiles.open(migration_file, mode="r") as file:
-            sql = await file.read()
-        db = self.get_guild_db(guild)
+        name = "consolidated" if consolidated else f"guild {guild.id}"
+        print(f"> Migrating {name} database from v{version}...", end="")
 
         try:
             await db.executescript(f"BEGIN TRANSACTION ; {sql}")
@@ -1392,10 +2258,54 @@ class LetsTry(
 
         return version
 
+    async def is_guild_db_current(self, guild, *, consolidated=False):
+        """Whether the guild database is bootstrapped and has no pending
+        migrations"""
+        try:
+            version = await self.get_guild_db_version(guild)
+        except SQLiteError:
+            # letstry_versions does not exist yet
+            return False
+        migration_file = self.get_sql_scriptpath(
+            f"migrate_from_v{version}.sql", consolidated=consolidated
+        )
+        return await read_sql_script(migration_file) is None
+
+    async def ensure_guild_db(self, guild):
+        bootstrap = self.guild_bootstraps.get(guild.id)
+        if bootstrap is None:
+            bootstrap = ensure_future(self.bootstrap_guild(guild))
+            self.guild_bootstraps[guild.id] = bootstrap
+        try:
+            await bootstrap
+        except Exception:
+            # Retry on the next access
+            if self.guild_bootstraps.get(guild.id) is bootstrap:
+                del self.guild_bootstraps[guild.id]
+            raise
+
     async def bootstrap_guild(self, guild):
-        path = PurePath(os.path.dirname(__file__), "sql", "bootstrap.sql")
-        async with aiofiles.open(path, mode="r") as file:
-            sql = await file.read()
+        db = self.get_guild_db(guild)
+        if get_tenant(db) is None:
+            return await self.bootstrap_db(guild)
+
+        # All guilds share the consolidated database, which only needs to be
+        # bootstrapped once
+        if self.consolidated_bootstrap is None:
+            self.consolidated_bootstrap = ensure_future(
+                self.bootstrap_db(guild, consolidated=True)
+            )
+        await self.consolidated_bootstrap
+
+    async def bootstrap_db(self, guild, *, consolidated=False):
+        if await self.is_guild_db_current(guild, consolidated=consolidated):
+            return
+        await self.bootstrap_db_full(guild, consolidated=consolidated)
+
+    async def bootstrap_db_full(self, guild, *, consolidated=False):
+        sql = await read_sql_script(
+            self.get_sql_scriptpath("bootstrap.sql", consolidated=consolidated)
+        )
         db = self.get_guild_db(guild)
         await db.executescript(sql)
         await db.commit()
@@ -1403,7 +2313,6 @@ class LetsTry(
             pass
 
     async def cog_load(self):
-        await gather(*[self.bootstrap_guild(guild) for guild in self.bot.guilds])
         self.finalize_ballots.start()
 
     async def cog_unload(self):
@@ -1414,10 +2323,12 @@ class LetsTry(
         await gather(*[self.finalize_guild_ballots(guild) for guild in self.bot.guilds])
 
     async def finalize_guild_ballots(self, guild):
+        await self.ensure_guild_db(guild)
         db = self.get_guild_db(guild)
         coros = []
-        where = {"state": "closed"}
-        async with LetsTryBallot.select(db, where) as cursor:
+        async with LetsTryBallot.select(
+            db, {}, condition=CLOSED_BALLOTS_CONDITION
+        ) as cursor:
             async for ballot in cursor:
                 coros.append(self.finalize_ballot(guild, ballot))
 
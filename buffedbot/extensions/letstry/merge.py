@@ -0,0 +1,144 @@
+"""Merges per-guild letstry databases into the consolidated database.
+
+Run from the bot's working directory while the bot is stopped:
+
+    python -m buffedbot.extensions.letstry.merge
+
+Guild databases have to be at the schema version of the consolidated
+database, i.e. the bot has to have migrated them in guild storage mode.
+Guilds that are already part of the consolidated database are skipped, so
+merging can be repeated. Each guild is merged in a transaction of its own.
+"""
+from pathlib import Path
+import argparse
+import sqlite3
+import sys
+
+from buffedbot.extensions.guildstorage import GUILD_STORAGE_ROOT
+from buffedbot.extensions.sqlite import (
+    DB_FILENAME,
+    CONSOLIDATED_DB_FILENAME,
+    TENANT_COLUMN,
+)
+
+SQL_DIR = Path(__file__).parent / "sql"
+
+# Parents before children, so foreign keys always point at merged rows
+TABLES = (
+    "letstry_games",
+    "letstry_ballots",
+    "letstry_proposals",
+    "letstry_ballot_games",
+    "letstry_ballot_votes",
+)
+# Ids are only unique within a guild's database, so they are shifted past the
+# ids already in the consolidated database
+ID_COLUMNS = {
+    "game_id": "letstry_games",
+    "ballot_id": "letstry_ballots",
+}
+
+
+def get_version(db, schema):
+    (version,) = db.execute(
+        f"SELECT MAX(version) FROM {schema}.letstry_versions"
+    ).fetchone()
+    return version
+
+
+def merge_guild(db, guild_id, path):
+    db.execute("ATTACH DATABASE ? AS guild", (f"{path.absolute().as_uri()}?mode=ro",))
+    try:
+        if get_version(db, "guild") != get_version(db, "main"):
+            raise RuntimeError(
+                f"{path} is at v{get_version(db, 'guild')}, "
+                f"expected v{get_version(db, 'main')}"
+            )
+
+        db.execute("BEGIN")
+        try:
+            # Merged rows keep their vote counts and states, which the
+            # triggers would otherwise recount or reject
+            triggers = db.execute(
+                "SELECT name, sql FROM main.sqlite_master WHERE type = 'trigger'"
+            ).fetchall()
+            for name, _ in triggers:
+                db.execute(f"DROP TRIGGER main.{name}")
+
+            offsets = {
+                column: db.execute(
+                    f"SELECT COALESCE(MAX({column}), 0) FROM main.{table}"
+                ).fetchone()[0]
+                for column, table in ID_COLUMNS.items()
+            }
+            counts = {}
+            for table in TABLES:
+                columns = [
+                    row[1] for row in db.execute(f"PRAGMA guild.table_info({table})")
+                ]
+                values = [f"{c} + {offsets[c]}" if c in offsets else c for c in columns]
+                cursor = db.execute(
+                    f"""
+                    INSERT INTO main.{table} ({", ".join(columns)}, {TENANT_COLUMN})
+                    SELECT {", ".join(values)}, :guild_id FROM guild.{table}
+                    """,
+                    {"guild_id": guild_id},
+                )
+                counts[table] = cursor.rowcount
+
+            for _, sql in triggers:
+                db.execute(sql)
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+    finally:
+        db.execute("DETACH DATABASE guild")
+    return counts
+
+
+def merge(guilds_dir, output):
+    """Merges the guild databases found in guilds_dir into output. Returns
+    the ids of the guilds that could not be merged."""
+    db = sqlite3.connect(output, isolation_level=None)
+    try:
+        db.executescript((SQL_DIR / "consolidated" / "bootstrap.sql").read_text())
+        merged = {
+            guild_id
+            for (guild_id,) in db.execute(
+                f"SELECT DISTINCT {TENANT_COLUMN} FROM letstry_games "
+                f"UNION SELECT DISTINCT {TENANT_COLUMN} FROM letstry_ballots"
+            )
+        }
+
+        failed = []
+        paths = sorted(Path(guilds_dir).glob(f"*/{DB_FILENAME}"))
+        for i, path in enumerate(paths, start=1):
+            guild_id = int(path.parent.name)
+            prefix = f"[{i}/{len(paths)}] guild {guild_id}:"
+            if guild_id in merged:
+                print(f"{prefix} already merged, skipped.")
+                continue
+            try:
+                counts = merge_guild(db, guild_id, path)
+            except (sqlite3.Error, RuntimeError) as e:
+                print(f"{prefix} FAILED: {e}")
+                failed.append(guild_id)
+                continue
+            rows = ", ".join(f"{count} {table}" for table, count in counts.items())
+            print(f"{prefix} merged {rows}.")
+        return failed
+    finally:
+        db.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--guilds", default=GUILD_STORAGE_ROOT)
+    parser.add_argument("--output", default=CONSOLIDATED_DB_FILENAME)
+    args = parser.parse_args(argv)
+    return 1 if merge(args.guilds, args.output) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
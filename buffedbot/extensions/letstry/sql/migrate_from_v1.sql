@@ -0,0 +1,25 @@
+-- The vote count triggers count the votes of a (ballot_id, game_id) pair
+CREATE INDEX IF NOT EXISTS
+  letstry_ballot_votes_ballot_game
+ON
+  letstry_ballot_votes (ballot_id, game_id) ;
+
+-- The proposal state triggers look up the proposals of a game
+CREATE INDEX IF NOT EXISTS
+  letstry_proposals_game
+ON
+  letstry_proposals (game_id) ;
+
+-- The vote count triggers and ballot game lookups filter by ballot_id, and
+-- electing the winner of a finalized ballot orders its games by votes
+CREATE INDEX IF NOT EXISTS
+  letstry_ballot_games_ballot_votes
+ON
+  letstry_ballot_games (ballot_id, votes) ;
+
+-- Closed ballots are found by these columns instead of the computed state
+-- column of letstry_ballots_view, which can not be indexed
+CREATE INDEX IF NOT EXISTS
+  letstry_ballots_finalized_staging_close
+ON
+  letstry_ballots (finalized, staging, date_close) ;
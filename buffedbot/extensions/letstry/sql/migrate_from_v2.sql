@@ -0,0 +1,31 @@
+-- Keep the trigger names of bootstrap.sql, so its CREATE TRIGGER IF NOT
+-- EXISTS does not bring back the recounting triggers
+DROP TRIGGER letstry_ballot_games_count_votes_insert ;
+
+CREATE TRIGGER
+  letstry_ballot_games_count_votes_insert
+AFTER INSERT ON letstry_ballot_votes
+BEGIN
+  UPDATE
+    letstry_ballot_games
+  SET
+    votes = votes + 1
+  WHERE
+    ballot_id = NEW.ballot_id AND
+    game_id = NEW.game_id ;
+END ;
+
+DROP TRIGGER letstry_ballot_games_count_votes_delete ;
+
+CREATE TRIGGER
+  letstry_ballot_games_count_votes_delete
+AFTER DELETE ON letstry_ballot_votes
+BEGIN
+  UPDATE
+    letstry_ballot_games
+  SET
+    votes = votes - 1
+  WHERE
+    ballot_id = OLD.ballot_id AND
+    game_id = OLD.game_id ;
+END ;
@@ -4,9 +4,11 @@ from buffedbot.checks import is_guild_owner
 from buffedbot.strings import SOMETHING_WENT_WRONG
 from aiopath import AsyncPath, PurePath
 from asyncio import gather
+from functools import lru_cache
 import aiofiles
 import json
 import logging
+import math
 
 SETTINGS_FILENAME = "settings.json"
 
@@ -22,6 +24,8 @@ SETTING_DOES_NOT_EXIST = "This setting does not exist"
 RESTRICTED_SETTINGS_KEY = "__restricted_settings"
 HIDDEN_KEYS = [RESTRICTED_SETTINGS_KEY]
 
+logger = logging.getLogger(__name__)
+
 
 def get_settings_list(settings, restricted_list):
     if not len(settings):
@@ -37,6 +41,44 @@ def get_settings_list(settings, restricted_list):
     return f"{SETTINGS_HEADER}\n" + body
 
 
+def get_number_setting(
+    get_setting, setting, default, type=float, *, minimum=None, finite=False
+):
+    """Value of a numeric setting, as type.
+
+    Settings are stored as text. Values that are not a number, are NaN, are
+    below minimum or (if finite) are infinite fall back to default, with a
+    warning logged once per value. Unset settings are default, which may be
+    None (e.g. for "disabled")."""
+    value = get_setting(setting, default)
+    if value is None or value is default:
+        return default
+    try:
+        return parse_number_setting(setting, value, default, type, minimum, finite)
+    except TypeError:
+        # Unhashable values (e.g. lists in the settings file) aren't cached
+        return parse_number_setting.__wrapped__(
+            setting, value, default, type, minimum, finite
+        )
+
+
+@lru_cache(maxsize=256)
+def parse_number_setting(setting, value, default, type, minimum, finite):
+    try:
+        number = type(value)
+    except (TypeError, ValueError, OverflowError):
+        number = None
+    if (
+        number is None
+        or math.isnan(number)
+        or (finite and math.isinf(number))
+        or (minimum is not None and number < minimum)
+    ):
+        logger.warning(f"Invalid value {value!r} of {setting}, using {default}")
+        return default
+    return number
+
+
 class Settings(commands.Cog, name="settings"):
     def __init__(self, bot):
         super().__init__()
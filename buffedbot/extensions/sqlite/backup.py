@@ -0,0 +1,227 @@
+import asyncio
+import shutil
+import sqlite3
+import time
+
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Callable, Optional
+
+from buffedbot.extensions.settings import get_number_setting
+
+BACKUP_DIR_SETTING = "sqlite-backup-dir"
+DEFAULT_BACKUP_DIR = "backups"
+# Hours between scheduled backups, 0 disables them
+BACKUP_INTERVAL_HOURS_SETTING = "sqlite-backup-interval-hours"
+DEFAULT_BACKUP_INTERVAL_HOURS = 24
+BACKUP_KEEP_SETTING = "sqlite-backup-keep"
+DEFAULT_BACKUP_KEEP = 7
+
+# Pages copied per backup step, and the pause after each step that lets
+# writers in
+BACKUP_PAGES_PER_STEP = 256
+BACKUP_STEP_PAUSE_SECONDS = 0.005
+# Writes by other connections restart a backup. A database written to more
+# often than it can be copied is given up on rather than copied forever.
+BACKUP_MAX_RESTARTS = 10
+
+SNAPSHOT_FORMAT = "%Y%m%dT%H%M%S.%fZ"
+PARTIAL_SUFFIX = ".partial"
+
+
+class BackupRestartedTooOften(sqlite3.OperationalError):
+    pass
+
+
+def format_size(size: int) -> str:
+    for unit in ("B", "KiB", "MiB"):
+        if size < 1024:
+            return f"{size:.0f} {unit}" if unit == "B" else f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} GiB"
+
+
+def backup_database(
+    source,
+    target,
+    *,
+    pages=BACKUP_PAGES_PER_STEP,
+    pause=BACKUP_STEP_PAUSE_SECONDS,
+    max_restarts=BACKUP_MAX_RESTARTS,
+) -> int:
+    """Copies the database source to target with SQLite's online backup API,
+    a few pages at a time. The source is only locked while a step copies
+    pages, so writers can go on in between. Blocks, so run it in a thread.
+    Returns the number of pages copied."""
+    restarts = 0
+    last_remaining = None
+    total_pages = 0
+
+    def progress(status, remaining, total):
+        nonlocal restarts, last_remaining, total_pages
+        total_pages = total
+        if last_remaining is not None and remaining > last_remaining:
+            restarts += 1
+            if restarts > max_restarts:
+                raise BackupRestartedTooOften(
+                    f"{source} changed during the backup {restarts} times"
+                )
+        last_remaining = remaining
+        if remaining:
+            time.sleep(pause)
+
+    src = sqlite3.connect(f"{Path(source).absolute().as_uri()}?mode=ro", uri=True)
+    try:
+        dst = sqlite3.connect(target)
+        try:
+            src.backup(dst, pages=pages, progress=progress)
+        finally:
+            dst.close()
+    finally:
+        src.close()
+    return total_pages
+
+
+@dataclass(slots=True)
+class BackupStats:
+    started: datetime
+    snapshot: Optional[Path] = None
+    elapsed: float = 0.0
+    databases: int = 0
+    pages: int = 0
+    size: int = 0
+    failed: dict[str, str] = field(default_factory=dict)
+
+    def format(self) -> str:
+        lines = [
+            f"**Backup** {self.snapshot.name if self.snapshot else 'failed'}: "
+            f"{self.databases} databases, {format_size(self.size)} "
+            f"({self.pages} pages) in {self.elapsed:.2f} s"
+        ]
+        for name, error in self.failed.items():
+            lines.append(f"- {name} FAILED: {error}")
+        return "\n".join(lines)
+
+
+class Backups:
+    """Takes snapshots of databases into timestamped directories and keeps
+    the most recent ones.
+
+    get_sources returns (name, path) pairs of the databases to back up, name
+    being the path of the copy within the snapshot. Databases are copied one
+    after another in a worker thread, so neither the event loop nor the
+    database connections are blocked while a backup runs."""
+
+    def __init__(
+        self,
+        get_sources: Callable[[], list[tuple[str, str]]],
+        get_setting=None,
+    ):
+        self.get_sources = get_sources
+        self.get_setting = get_setting or (lambda setting, default: default)
+        self.last: Optional[BackupStats] = None
+        self._lock = asyncio.Lock()
+
+    @property
+    def directory(self) -> Path:
+        return Path(self.get_setting(BACKUP_DIR_SETTING, DEFAULT_BACKUP_DIR))
+
+    @property
+    def interval(self) -> timedelta:
+        return timedelta(
+            hours=get_number_setting(
+                self.get_setting,
+                BACKUP_INTERVAL_HOURS_SETTING,
+                DEFAULT_BACKUP_INTERVAL_HOURS,
+                minimum=0,
+                finite=True,
+            )
+        )
+
+    @property
+    def keep(self) -> int:
+        return get_number_setting(
+            self.get_setting, BACKUP_KEEP_SETTING, DEFAULT_BACKUP_KEEP, int, minimum=1
+        )
+
+    @property
+    def running(self) -> bool:
+        return self._lock.locked()
+
+    def snapshots(self) -> list[Path]:
+        """Completed snapshots, oldest first"""
+        if not self.directory.exists():
+            return []
+        return sorted(
+            path
+            for path in self.directory.iterdir()
+            if path.is_dir() and not path.name.endswith(PARTIAL_SUFFIX)
+        )
+
+    @staticmethod
+    def get_snapshot_time(snapshot: Path) -> datetime:
+        return datetime.strptime(snapshot.name, SNAPSHOT_FORMAT).replace(
+            tzinfo=timezone.utc
+        )
+
+    @staticmethod
+    def get_size(snapshot: Path) -> int:
+        return sum(path.stat().st_size for path in snapshot.rglob("*.db"))
+
+    def is_due(self, now: Optional[datetime] = None) -> bool:
+        if self.interval <= timedelta(0):
+            return False
+        snapshots = self.snapshots()
+        if not snapshots:
+            return True
+        now = now or datetime.now(timezone.utc)
+        return now - self.get_snapshot_time(snapshots[-1]) >= self.interval
+
+    async def run(self) -> BackupStats:
+        async with self._lock:
+            stats = BackupStats(datetime.now(timezone.utc))
+            start = time.perf_counter()
+            snapshot = self.directory / stats.started.strftime(SNAPSHOT_FORMAT)
+            partial = snapshot.with_name(snapshot.name + PARTIAL_SUFFIX)
+            for name, source in self.get_sources():
+                target = partial / name
+                try:
+                    target.parent.mkdir(parents=True, exist_ok=True)
+                    stats.pages += await asyncio.to_thread(
+                        backup_database, source, target
+                    )
+                except (sqlite3.Error, OSError) as e:
+                    stats.failed[name] = str(e)
+                    target.unlink(missing_ok=True)
+                    continue
+                stats.databases += 1
+                stats.size += target.stat().st_size
+
+            # Databases that failed are missing from the snapshot, but the
+            # others are worth keeping
+            if stats.databases:
+                partial.rename(snapshot)
+                stats.snapshot = snapshot
+                await asyncio.to_thread(self.rotate)
+            elif partial.exists():
+                await asyncio.to_thread(shutil.rmtree, partial)
+            stats.elapsed = time.perf_counter() - start
+            self.last = stats
+            return stats
+
+    def rotate(self):
+        snapshots = self.snapshots()
+        for snapshot in snapshots[: max(len(snapshots) - self.keep, 0)]:
+            shutil.rmtree(snapshot)
+
+    def format(self) -> str:
+        snapshots = self.snapshots()
+        lines = [f"**Backups** in {self.directory}, keeping {self.keep}"]
+        if self.last:
+            lines.append(self.last.format())
+        for snapshot in reversed(snapshots):
+            lines.append(f"- {snapshot.name} {format_size(self.get_size(snapshot))}")
+        if not snapshots:
+            lines.append("No backups yet.")
+        return "\n".join(lines)
@@ -0,0 +1,55 @@
+from collections import defaultdict
+from typing import Callable, Iterable, Optional
+
+# Called with the tables that changed, or None if it is not known which
+Listener = Callable[[Optional[frozenset[str]]], None]
+
+
+class Changes:
+    """Change notifications for the tables of one database.
+
+    Writes made through this process are published per table once they are
+    committed. Changes made by other connections (the migration tool, a
+    manual edit) are only noticed as a whole, through PRAGMA data_version,
+    and are published as None: anything may have changed.
+
+    Caches can either listen for changes, or store get_version(tables) with
+    what they cache and only use it while the version is unchanged."""
+
+    def __init__(self):
+        # Bumped when anything may have changed
+        self.version = 0
+        self.versions: defaultdict[str, int] = defaultdict(int)
+        # Tables written to by the unit of work in progress
+        self.pending: set[str] = set()
+        self.listeners: list[Listener] = []
+        self.published = 0
+
+    def get_version(self, tables: Iterable[str]) -> tuple[int, ...]:
+        return (self.version, *(self.versions[table] for table in tables))
+
+    def listen(self, listener: Listener) -> Callable[[], None]:
+        """Calls listener on every change. Returns a function that stops
+        calling it."""
+        self.listeners.append(listener)
+        return lambda: self.listeners.remove(listener)
+
+    def publish(self, tables: Optional[Iterable[str]]):
+        if tables is None:
+            self.version += 1
+        else:
+            tables = frozenset(tables)
+            if not tables:
+                return
+            for table in tables:
+                self.versions[table] += 1
+        self.published += 1
+        for listener in list(self.listeners):
+            listener(tables)
+
+    def commit(self):
+        tables, self.pending = self.pending, set()
+        self.publish(tables)
+
+    def rollback(self):
+        self.pending.clear()
@@ -0,0 +1,229 @@
+import asyncio
+import logging
+import sqlite3
+import time
+
+from collections import deque
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Optional
+
+from buffedbot.extensions.settings import get_number_setting
+
+from .backup import format_size
+
+# Hours between two maintenance runs of a database, 0 disables maintenance
+MAINTENANCE_INTERVAL_HOURS_SETTING = "sqlite-maintenance-interval-hours"
+DEFAULT_MAINTENANCE_INTERVAL_HOURS = 24
+# Time a maintenance cycle may spend before leaving the remaining databases
+# to the next cycle
+MAINTENANCE_BUDGET_SECONDS_SETTING = "sqlite-maintenance-budget-seconds"
+DEFAULT_MAINTENANCE_BUDGET_SECONDS = 10
+MAINTENANCE_CONCURRENCY_SETTING = "sqlite-maintenance-concurrency"
+DEFAULT_MAINTENANCE_CONCURRENCY = 2
+
+# Pause between two databases, so a cycle never keeps a connection thread
+# busy back to back
+MAINTENANCE_PAUSE_SECONDS = 0.1
+# Rows ANALYZE looks at per index, which bounds its cost on large tables
+ANALYSIS_LIMIT = 400
+# Free pages returned to the file system per run
+INCREMENTAL_VACUUM_PAGES = 1024
+# Databases created before incremental auto vacuum was enabled need a full
+# VACUUM to switch. Only small ones are switched, as VACUUM rewrites the file.
+VACUUM_CONVERT_MAX_BYTES = 8 * 1024 * 1024
+RESULT_LOG_SIZE = 100
+
+# PRAGMA auto_vacuum values
+AUTO_VACUUM_INCREMENTAL = 2
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(slots=True)
+class MaintenanceResult:
+    name: str = ""
+    elapsed: float = 0.0
+    reclaimed: int = 0
+    checkpointed: int = 0
+    analyzed: bool = False
+    converted: bool = False
+    error: Optional[str] = None
+
+    def format(self) -> str:
+        prefix = f"Maintained {self.name} in {self.elapsed * 1000:.1f} ms"
+        if self.error is not None:
+            return f"{prefix}: FAILED: {self.error}"
+        done = ["analyzed" if self.analyzed else "optimized"]
+        if self.converted:
+            done.append("switched to incremental vacuum")
+        done.append(f"reclaimed {format_size(self.reclaimed)}")
+        done.append(f"checkpointed {self.checkpointed} pages")
+        return f"{prefix}: {', '.join(done)}"
+
+
+def get_pragma(connection, pragma):
+    (value,) = connection.execute(f"PRAGMA {pragma}").fetchone()
+    return value
+
+
+def get_size(connection) -> int:
+    return get_pragma(connection, "page_count") * get_pragma(connection, "page_size")
+
+
+def maintain_connection(connection) -> MaintenanceResult:
+    """Updates the planner statistics of a database, returns free pages to the
+    file system and checkpoints its WAL. Runs in the connection's thread,
+    outside of a transaction."""
+    result = MaintenanceResult()
+    size = get_size(connection)
+
+    connection.execute(f"PRAGMA analysis_limit = {ANALYSIS_LIMIT}")
+    analyzed = connection.execute(
+        "SELECT 1 FROM sqlite_master WHERE name = 'sqlite_stat1'"
+    ).fetchone()
+    if analyzed:
+        # Only analyzes the tables whose statistics are out of date
+        connection.execute("PRAGMA optimize").fetchall()
+    else:
+        connection.execute("ANALYZE")
+        result.analyzed = True
+
+    if get_pragma(connection, "auto_vacuum") == AUTO_VACUUM_INCREMENTAL:
+        # The pragma frees pages while its rows are stepped through
+        connection.execute(
+            f"PRAGMA incremental_vacuum({INCREMENTAL_VACUUM_PAGES})"
+        ).fetchall()
+    elif size <= VACUUM_CONVERT_MAX_BYTES:
+        connection.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        connection.execute("VACUUM")
+        result.converted = True
+
+    if get_pragma(connection, "journal_mode") == "wal":
+        # PASSIVE never waits for readers or writers
+        _, _, checkpointed = connection.execute(
+            "PRAGMA wal_checkpoint(PASSIVE)"
+        ).fetchone()
+        result.checkpointed = max(checkpointed, 0)
+
+    result.reclaimed = size - get_size(connection)
+    return result
+
+
+class Maintenance:
+    """Maintains databases, each once per interval.
+
+    Every cycle maintains the databases that are due, least recently
+    maintained first, a few at a time and with a pause after each. A cycle
+    stops when its time budget is spent, leaving the rest to the next cycle,
+    so maintaining thousands of guild databases is spread out over many
+    cycles.
+
+    get_databases returns (name, db) pairs. run runs a function in the
+    connection thread of db without a unit of work being open on it."""
+
+    def __init__(
+        self,
+        get_databases: Callable[[], list[tuple[str, object]]],
+        run: Callable[..., Awaitable],
+        get_setting=None,
+    ):
+        self.get_databases = get_databases
+        self.run = run
+        self.get_setting = get_setting or (lambda setting, default: default)
+        self.last_maintained: dict[str, float] = {}
+        self.results: deque[MaintenanceResult] = deque(maxlen=RESULT_LOG_SIZE)
+        self.maintained = 0
+        self.reclaimed = 0
+        self.last_cycle: Optional[tuple[int, float]] = None
+
+    @property
+    def interval(self) -> float:
+        return 3600 * get_number_setting(
+            self.get_setting,
+            MAINTENANCE_INTERVAL_HOURS_SETTING,
+            DEFAULT_MAINTENANCE_INTERVAL_HOURS,
+            minimum=0,
+            finite=True,
+        )
+
+    @property
+    def budget(self) -> float:
+        return get_number_setting(
+            self.get_setting,
+            MAINTENANCE_BUDGET_SECONDS_SETTING,
+            DEFAULT_MAINTENANCE_BUDGET_SECONDS,
+            minimum=0,
+            finite=True,
+        )
+
+    @property
+    def concurrency(self) -> int:
+        return get_number_setting(
+            self.get_setting,
+            MAINTENANCE_CONCURRENCY_SETTING,
+            DEFAULT_MAINTENANCE_CONCURRENCY,
+            int,
+            minimum=1,
+        )
+
+    def is_due(self, name: str, now: float) -> bool:
+        last = self.last_maintained.get(name)
+        return last is None or now - last >= self.interval
+
+    async def maintain(self, name: str, db) -> MaintenanceResult:
+        start = time.perf_counter()
+        try:
+            result = await self.run(db, maintain_connection)
+        except sqlite3.Error as e:
+            result = MaintenanceResult(error=str(e))
+        result.name = name
+        result.elapsed = time.perf_counter() - start
+
+        self.last_maintained[name] = time.monotonic()
+        self.results.append(result)
+        self.maintained += 1
+        self.reclaimed += result.reclaimed
+        if result.error is not None:
+            logger.warning(result.format())
+        else:
+            logger.info(result.format())
+        return result
+
+    async def run_cycle(self) -> list[MaintenanceResult]:
+        if self.interval <= 0:
+            return []
+        start = time.monotonic()
+        deadline = start + self.budget
+        due = [
+            (name, db) for name, db in self.get_databases() if self.is_due(name, start)
+        ]
+        due.sort(key=lambda item: self.last_maintained.get(item[0], 0.0))
+        # Shared by the workers, so each database is taken by one of them
+        queue = iter(due)
+        results = []
+
+        async def worker():
+            for name, db in queue:
+                if time.monotonic() >= deadline:
+                    return
+                results.append(await self.maintain(name, db))
+                await asyncio.sleep(MAINTENANCE_PAUSE_SECONDS)
+
+        await asyncio.gather(*[worker() for _ in range(max(self.concurrency, 1))])
+        self.last_cycle = (len(results), time.monotonic() - start)
+        if results:
+            logger.info(
+                f"Maintained {len(results)} of {len(due)} due databases in "
+                f"{self.last_cycle[1]:.2f} s, reclaimed "
+                f"{format_size(sum(result.reclaimed for result in results))}"
+            )
+        return results
+
+    def summary(self) -> str:
+        summary = (
+            f"{self.maintained} maintained, {format_size(self.reclaimed)} reclaimed"
+        )
+        if self.last_cycle is not None:
+            count, elapsed = self.last_cycle
+            summary += f", last cycle {count} in {elapsed:.2f} s"
+        return summary
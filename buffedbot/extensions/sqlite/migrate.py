@@ -0,0 +1,177 @@
+"""Brings the databases of the bot up to the current schema versions.
+
+Run from the bot's working directory, preferably while the bot is stopped:
+
+    python -m buffedbot.extensions.sqlite.migrate [--jobs 8] [--dry-run]
+
+Covers the steam cache in the bot database, the letstry database of every
+guild and the consolidated database, if there is one. Databases are migrated
+in parallel. Every migration runs in a transaction of its own, so a database
+whose migration fails stays at the last version that applied, and running
+the migrations again resumes from there. Up to date databases are skipped.
+"""
+from asyncio import Semaphore, as_completed, run
+from dataclasses import dataclass, field
+from pathlib import Path
+from time import perf_counter
+from typing import Optional
+import argparse
+import sqlite3
+import sys
+
+import aiosqlite
+
+from buffedbot.extensions.guildstorage import GUILD_STORAGE_ROOT
+from .schema import Schema
+from .sqlite import DB_FILENAME, CONSOLIDATED_DB_FILENAME
+
+DEFAULT_JOBS = 8
+SLOWEST_COUNT = 5
+
+
+@dataclass
+class Target:
+    label: str
+    path: Path
+    schemas: tuple[Schema, ...]
+
+
+@dataclass
+class Result:
+    target: Target
+    scripts: list[str] = field(default_factory=list)
+    elapsed: float = 0.0
+    error: Optional[Exception] = None
+    # The schema that failed to migrate and the version it was left at
+    failed_version: Optional[tuple[Schema, Optional[int]]] = None
+
+
+def find_targets(guilds_dir=GUILD_STORAGE_ROOT) -> list[Target]:
+    # The extensions depend on this package, so they can't be imported at the
+    # top
+    from buffedbot.extensions.letstry import (
+        LETSTRY_SCHEMA,
+        LETSTRY_CONSOLIDATED_SCHEMA,
+    )
+    from buffedbot.extensions.steam import STEAM_SCHEMA
+
+    # Databases that don't exist yet are bootstrapped by the bot
+    targets = []
+    if Path(DB_FILENAME).exists():
+        targets.append(Target("bot", Path(DB_FILENAME), (STEAM_SCHEMA,)))
+    if Path(CONSOLIDATED_DB_FILENAME).exists():
+        targets.append(
+            Target(
+                "consolidated",
+                Path(CONSOLIDATED_DB_FILENAME),
+                (LETSTRY_CONSOLIDATED_SCHEMA,),
+            )
+        )
+    for path in sorted(Path(guilds_dir).glob(f"*/{DB_FILENAME}")):
+        targets.append(Target(f"guild {path.parent.name}", path, (LETSTRY_SCHEMA,)))
+    return targets
+
+
+async def migrate_target(target: Target, *, dry_run=False) -> Result:
+    result = Result(target)
+    start = perf_counter()
+    try:
+        if dry_run:
+            uri = f"{target.path.absolute().as_uri()}?mode=ro"
+            db = await aiosqlite.connect(uri, uri=True)
+        else:
+            db = await aiosqlite.connect(target.path)
+        try:
+            for schema in target.schemas:
+                try:
+                    scripts = await schema.upgrade(db, dry_run=dry_run)
+                except sqlite3.Error as e:
+                    result.error = e
+                    result.failed_version = (schema, await schema.get_version(db))
+                    break
+                result.scripts += [f"{schema.name}/{script}" for script in scripts]
+        finally:
+            await db.close()
+    except sqlite3.Error as e:
+        result.error = e
+    result.elapsed = perf_counter() - start
+    return result
+
+
+def format_result(result: Result, *, dry_run=False) -> str:
+    prefix = f"{result.target.label} ({result.elapsed * 1000:.1f} ms):"
+    if result.failed_version is not None:
+        schema, version = result.failed_version
+        return f"{prefix} FAILED, {schema.name} left at v{version}: {result.error}"
+    if result.error is not None:
+        return f"{prefix} FAILED: {result.error}"
+    if not result.scripts:
+        return f"{prefix} up to date."
+    scripts = ", ".join(result.scripts)
+    return f"{prefix} {'would run' if dry_run else 'ran'} {scripts}."
+
+
+async def migrate(
+    targets: list[Target], *, jobs=DEFAULT_JOBS, dry_run=False, report=print
+) -> list[Result]:
+    """Migrates targets, at most jobs at a time. Reports each result as it
+    completes."""
+    semaphore = Semaphore(jobs)
+
+    async def migrate_one(target):
+        async with semaphore:
+            return await migrate_target(target, dry_run=dry_run)
+
+    results = []
+    for i, future in enumerate(
+        as_completed([migrate_one(target) for target in targets]), start=1
+    ):
+        result = await future
+        results.append(result)
+        report(f"[{i}/{len(targets)}] {format_result(result, dry_run=dry_run)}")
+    return results
+
+
+def format_summary(results: list[Result], elapsed: float, *, dry_run=False) -> str:
+    migrated = [result for result in results if result.scripts and not result.error]
+    failed = [result for result in results if result.error]
+    lines = [
+        f"{len(results)} databases in {elapsed:.2f} s: {len(migrated)} "
+        f"{'to migrate' if dry_run else 'migrated'}, "
+        f"{len(results) - len(migrated) - len(failed)} up to date, "
+        f"{len(failed)} failed."
+    ]
+    slowest = sorted(results, key=lambda result: result.elapsed, reverse=True)
+    lines += ["Slowest:"] + [
+        f"  {result.target.label}: {result.elapsed * 1000:.1f} ms"
+        for result in slowest[:SLOWEST_COUNT]
+    ]
+    if failed:
+        lines += ["Failed, run again to resume:"] + [
+            f"  {result.target.label} ({result.target.path})" for result in failed
+        ]
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--guilds", default=GUILD_STORAGE_ROOT)
+    parser.add_argument("--jobs", type=int, default=DEFAULT_JOBS)
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="only report the scripts that would run",
+    )
+    args = parser.parse_args(argv)
+
+    start = perf_counter()
+    results = run(
+        migrate(find_targets(args.guilds), jobs=args.jobs, dry_run=args.dry_run)
+    )
+    if results:
+        print(format_summary(results, perf_counter() - start, dry_run=args.dry_run))
+    return 1 if any(result.error for result in results) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,95 @@
+import sqlite3
+
+from dataclasses import dataclass
+from functools import cache
+from pathlib import Path
+from typing import Optional
+
+
+@cache
+def read_script(path: Path) -> Optional[str]:
+    """Reads a sql script once per process. Returns None if it does not
+    exist."""
+    try:
+        return path.read_text()
+    except FileNotFoundError:
+        return None
+
+
+@dataclass(frozen=True)
+class Schema:
+    """A versioned schema.
+
+    bootstrap.sql in directory creates the schema (if it does not exist yet)
+    and records its version in versions_table. migrate_from_v{N}.sql upgrades
+    the schema from version N to N + 1."""
+
+    name: str
+    directory: Path
+    versions_table: str
+
+    def script(self, filename: str) -> Optional[str]:
+        return read_script(Path(self.directory, filename))
+
+    def migration(self, version: int) -> Optional[str]:
+        return self.script(f"migrate_from_v{version}.sql")
+
+    def pending(self, version: int) -> list[int]:
+        """The versions to migrate from to bring version up to date"""
+        versions = []
+        while self.migration(version) is not None:
+            versions.append(version)
+            version += 1
+        return versions
+
+    async def get_version(self, db) -> Optional[int]:
+        """The schema version of db, or None if it was never bootstrapped"""
+        try:
+            async with db.execute(
+                f"SELECT MAX(version) FROM {self.versions_table}"
+            ) as cursor:
+                (version,) = await cursor.fetchone()
+        except sqlite3.OperationalError:
+            # The versions table does not exist
+            return None
+        return version
+
+    async def bootstrap(self, db):
+        await db.executescript(self.script("bootstrap.sql"))
+        await db.commit()
+
+    async def migrate(self, db, version: int):
+        """Migrates db from version to version + 1 in a transaction of its
+        own, so an upgrade that fails half way keeps the steps before"""
+        try:
+            await db.executescript(f"BEGIN TRANSACTION ; {self.migration(version)}")
+            await db.execute(
+                f"INSERT INTO {self.versions_table} VALUES (:version)",
+                (version + 1,),
+            )
+            await db.commit()
+        except sqlite3.Error:
+            await db.rollback()
+            raise
+
+    async def upgrade(self, db, *, dry_run=False) -> list[str]:
+        """Bootstraps db if needed and applies the pending migrations. Returns
+        the scripts run, or for a dry run, the scripts that would run.
+
+        A dry run of a database that was never bootstrapped only reports the
+        bootstrap, as the version it bootstraps to is not known."""
+        version = await self.get_version(db)
+        if version is None:
+            if dry_run:
+                return ["bootstrap.sql"]
+            await self.bootstrap(db)
+            version = await self.get_version(db)
+            scripts = ["bootstrap.sql"]
+        else:
+            scripts = []
+
+        for version in self.pending(version):
+            if not dry_run:
+                await self.migrate(db, version)
+            scripts.append(f"migrate_from_v{version}.sql")
+        return scripts
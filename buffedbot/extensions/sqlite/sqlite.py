@@ -1,8 +1,28 @@
 import aiosqlite
+import logging
+import math
+import sqlite3
+import threading
+import time
 
-from discord.ext import commands
-from asyncio import gather
+from pathlib import Path
+
+from discord.ext import commands, tasks
+from asyncio import create_task, current_task, gather, get_running_loop, sleep, Lock
 from aiopath import PurePath, AsyncPath
+from aiosqlite.context import contextmanager
+from collections import deque, OrderedDict
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from functools import lru_cache
+from weakref import WeakKeyDictionary, WeakSet
+
+from buffedbot.extensions.settings import get_number_setting
+
+from .backup import Backups
+from .changes import Changes
+from .maintenance import Maintenance
 
 
 def dict_compact(dict):
@@ -26,16 +46,902 @@ def get_placeholder_values(dict):
 
 DB_FILENAME = "sqlite.db"
 
+STORAGE_MODE_SETTING = "sqlite-storage-mode"
+# "guild" keeps a database file per guild, "consolidated" keeps the rows of
+# all guilds in CONSOLIDATED_DB_FILENAME, partitioned by TENANT_COLUMN
+DEFAULT_STORAGE_MODE = "guild"
+CONSOLIDATED_DB_FILENAME = "guilds.db"
+TENANT_COLUMN = "guild_id"
+
+SLOW_QUERY_MS_SETTING = "sqlite-slow-query-ms"
+EXPLAIN_QUERY_MS_SETTING = "sqlite-explain-query-ms"
+DEFAULT_SLOW_QUERY_MS = 100
+SLOW_QUERY_LOG_SIZE = 50
+
+MAX_GUILD_CONNECTIONS_SETTING = "sqlite-max-guild-connections"
+DEFAULT_MAX_GUILD_CONNECTIONS = 64
+PRAGMA_PROFILE_SETTING = "sqlite-pragma-profile"
+DEFAULT_PRAGMA_PROFILE = "wal"
+PRAGMA_PROFILES = {
+    # How guild databases were opened before profiles existed
+    "journal": {
+        "foreign_keys": "ON",
+        "journal_mode": "DELETE",
+    },
+    # Readers don't block the writer and commits only fsync on checkpoints
+    "wal": {
+        "foreign_keys": "ON",
+        # Only takes effect for new databases, maintenance switches the
+        # existing ones (see maintenance.py)
+        "auto_vacuum": "INCREMENTAL",
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "mmap_size": 64 * 1024 * 1024,
+        "cache_size": -8 * 1024,
+        "temp_store": "MEMORY",
+    },
+}
+# Pragmas of a profile that apply to read-only connections
+READER_PRAGMAS = ("mmap_size", "cache_size", "temp_store")
+
+# Writes to a guild database that arrive while one of its commits is in
+# flight are committed together, after waiting this long for more writes.
+# Unset, every write is committed on its own.
+GROUP_COMMIT_MS_SETTING = "sqlite-group-commit-ms"
+# Writes committed together at most
+GROUP_COMMIT_MAX_WRITES = 64
+
+# How often open connections are checked for changes made by other
+# connections
+CHANGE_POLL_SECONDS = 5
+
+# How often a guild database waiting for a connection checks whether one of
+# the open connections became idle
+GUILD_CONNECTION_WAIT_SECONDS = 0.05
+
+# How often the backup schedule is checked, see backup.py for the settings
+BACKUP_CHECK_MINUTES = 30
+# How often due databases are maintained, see maintenance.py for the settings
+MAINTENANCE_CYCLE_MINUTES = 5
+
+# Upper bounds (in ms) of the latency histogram buckets
+LATENCY_BUCKETS_MS = (1, 5, 25, 100, 500, math.inf)
+
+# Connection calls that run a statement. Everything else (fetches, cursor
+# management, close) is passed through untimed.
+TIMED_CALLS = frozenset(
+    {"execute", "executemany", "executescript", "_execute_insert", "_execute_fetchall"}
+)
+EXPLAINED_CALLS = frozenset({"execute", "_execute_insert", "_execute_fetchall"})
+
+logger = logging.getLogger(__name__)
+
+
+@lru_cache(maxsize=1024)
+def to_template(sql):
+    """Statement text with whitespace collapsed, so the same statement built
+    with different indentation counts as one template"""
+    return " ".join(sql.split())
+
+
+@dataclass(slots=True)
+class TemplateStats:
+    count: int = 0
+    total_ms: float = 0
+    max_ms: float = 0
+    histogram: list[int] = field(default_factory=lambda: [0] * len(LATENCY_BUCKETS_MS))
+
+    @property
+    def mean_ms(self):
+        return self.total_ms / self.count if self.count else 0
+
+
+@dataclass(slots=True)
+class SlowQuery:
+    template: str
+    duration_ms: float
+    timestamp: float
+    plan: list[str] | None = None
+
+
+class StatementStats:
+    """Counts, latency histograms and a slow query log per statement template.
+
+    Statements are recorded from the connection threads, so all updates go
+    through a lock. Thresholds are looked up on every statement so changing
+    the settings takes effect immediately; a value is only parsed once."""
+
+    def __init__(self, get_setting=None, *, slow_log_size=SLOW_QUERY_LOG_SIZE):
+        self.get_setting = get_setting or (lambda setting, default: default)
+        self.templates: dict[str, TemplateStats] = {}
+        self.slow_queries: deque[SlowQuery] = deque(maxlen=slow_log_size)
+        self._lock = threading.Lock()
+
+    @property
+    def slow_query_ms(self):
+        return get_number_setting(
+            self.get_setting, SLOW_QUERY_MS_SETTING, DEFAULT_SLOW_QUERY_MS, minimum=0
+        )
+
+    @property
+    def explain_query_ms(self):
+        return get_number_setting(
+            self.get_setting, EXPLAIN_QUERY_MS_SETTING, None, minimum=0
+        )
+
+    def wants_plan(self, duration_ms):
+        explain_query_ms = self.explain_query_ms
+        return explain_query_ms is not None and duration_ms >= explain_query_ms
+
+    def record(self, sql, duration_ms, plan=None):
+        template = to_template(sql)
+        bucket = next(
+            i for i, bound in enumerate(LATENCY_BUCKETS_MS) if duration_ms <= bound
+        )
+        is_slow = duration_ms >= self.slow_query_ms
+        with self._lock:
+            stats = self.templates.get(template)
+            if stats is None:
+                stats = self.templates[template] = TemplateStats()
+            stats.count += 1
+            stats.total_ms += duration_ms
+            stats.max_ms = max(stats.max_ms, duration_ms)
+            stats.histogram[bucket] += 1
+            if is_slow:
+                self.slow_queries.append(
+                    SlowQuery(template, duration_ms, time.time(), plan)
+                )
+        if is_slow:
+            logger.warning(f"Slow query ({duration_ms:.1f}ms): {template}")
+            for line in plan or []:
+                logger.warning(f"  {line}")
+
+    def top(self, limit=10):
+        """Templates that took the most time in total"""
+        with self._lock:
+            templates = list(self.templates.items())
+        templates.sort(key=lambda item: item[1].total_ms, reverse=True)
+        return templates[:limit]
+
+    def reset(self):
+        with self._lock:
+            self.templates.clear()
+            self.slow_queries.clear()
+
+
+def format_stats(stats, limit=10, width=80):
+    def shorten(template):
+        return template if len(template) <= width else template[: width - 1] + "…"
+
+    buckets = "/".join(
+        "inf" if math.isinf(bound) else str(bound) for bound in LATENCY_BUCKETS_MS
+    )
+    lines = [f"**SQL statements** (histogram ≤{buckets}ms)"]
+    for template, template_stats in stats.top(limit):
+        histogram = "/".join(str(count) for count in template_stats.histogram)
+        lines.append(
+            f"`{shorten(template)}`\n"
+            f"{template_stats.count}x, {template_stats.total_ms:.1f}ms total, "
+            f"{template_stats.mean_ms:.2f}ms mean, {template_stats.max_ms:.1f}ms max, "
+            f"[{histogram}]"
+        )
+    if len(lines) == 1:
+        lines.append("*No statements recorded*")
+
+    slow_queries = list(stats.slow_queries)[-5:]
+    if slow_queries:
+        lines.append(f"**Slow queries** (≥{stats.slow_query_ms:g}ms)")
+    for slow_query in reversed(slow_queries):
+        lines.append(f"{slow_query.duration_ms:.1f}ms `{shorten(slow_query.template)}`")
+        for line in slow_query.plan or []:
+            lines.append(f"> {line}")
+    return "\n".join(lines)
+
+
+class InstrumentedConnection(aiosqlite.Connection):
+    """aiosqlite connection that records the statements it runs.
+
+    Statements are timed in the connection thread, so the time spent waiting
+    in the connection's queue is not counted. For SELECTs the time covers
+    running the statement up to its first row; fetching the rest is not
+    included. Statements crossing the explain threshold have their query plan
+    captured on the same connection right after they ran.
+
+    The connection is busy while a call is in flight or a cursor it returned
+    is still referenced (e.g. while it is being iterated)."""
+
+    def __init__(self, connector, iter_chunk_size, stats):
+        super().__init__(connector, iter_chunk_size)
+        self.stats = stats
+        self.in_flight = 0
+        self.cursors = WeakSet()
+
+    @property
+    def busy(self):
+        return self.in_flight > 0 or len(self.cursors) > 0
+
+    async def _execute(self, fn, *args, **kwargs):
+        name = getattr(fn, "__name__", None)
+        if name in TIMED_CALLS:
+            fn = self._timed(fn, name in EXPLAINED_CALLS)
+        elif name == "commit" and self.in_transaction:
+            # Commits are where the fsyncs happen, so they are worth a template
+            fn = self._timed(fn, False, "COMMIT")
+        self.in_flight += 1
+        try:
+            return await super()._execute(fn, *args, **kwargs)
+        finally:
+            self.in_flight -= 1
+
+    @contextmanager
+    async def execute(self, sql, parameters=None):
+        cursor = await super().execute(sql, parameters)
+        self.cursors.add(cursor)
+        return cursor
+
+    def _timed(self, fn, explain, sql=None):
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                duration_ms = (time.perf_counter() - start) * 1000
+                statement = sql or args[0]
+                plan = None
+                if explain and self.stats.wants_plan(duration_ms):
+                    plan = self._explain(statement, args[1] if len(args) > 1 else ())
+                self.stats.record(statement, duration_ms, plan)
+
+        return timed
+
+    async def run_sync(self, fn, *args, **kwargs):
+        # Statements run by fn are not recorded one by one, the whole call is
+        # recorded under its name instead
+        timed = self._timed(
+            lambda: fn(self._conn, *args, **kwargs),
+            False,
+            f"run_sync {getattr(fn, '__qualname__', fn)}",
+        )
+        return await self._execute(timed)
+
+    def _explain(self, sql, parameters):
+        try:
+            rows = self._conn.execute(
+                f"EXPLAIN QUERY PLAN {sql}", parameters or ()
+            ).fetchall()
+        except sqlite3.Error as e:
+            return [f"EXPLAIN failed: {e}"]
+        return [row[-1] for row in rows]
+
+
+def connect(database, stats, *, iter_chunk_size=64, **kwargs):
+    """Like aiosqlite.connect, but returns an InstrumentedConnection recording
+    into stats"""
+
+    def connector():
+        return sqlite3.connect(str(database), **kwargs)
+
+    return InstrumentedConnection(connector, iter_chunk_size, stats)
+
+
+async def apply_pragmas(db, pragmas):
+    for pragma, value in pragmas.items():
+        # Some pragmas return a row, which keeps the statement in progress
+        # (and commits failing) until it is fetched
+        await db.execute_fetchall(f"PRAGMA {pragma} = {value}")
+
+
+def get_reader(db):
+    """Connection to run SELECTs on that don't have to see the writes of the
+    current unit of work.
+
+    For guild databases this is the read-only reader connection, which does
+    not queue behind writes. Inside a unit of work, or for connections without
+    a reader, it is db itself."""
+    if in_unit_of_work(db) or db.in_transaction:
+        return db
+    return getattr(db, "reader", db)
+
+
+def get_transaction_key(db):
+    # Handles sharing a connection have to share its units of work, too
+    return getattr(db, "transaction_key", db)
+
+
+def get_tenant(db):
+    """Guild id the rows of db are partitioned by, or None if db belongs to a
+    single guild"""
+    return getattr(db, "tenant", None)
+
+
+# One unit of work at a time per connection. Connections are shared between
+# all commands of a guild, so without this a commit issued by one command
+# would also commit another command's half-finished work.
+_transaction_locks: WeakKeyDictionary = WeakKeyDictionary()
+
+# Units of work the current task holds, as (connection key, task) pairs.
+# Tasks spawned from within a unit inherit the context, so the task is part
+# of the pair: the spawned tasks are not part of the unit, and may well run
+# after it ended.
+_active_transactions: ContextVar[frozenset] = ContextVar(
+    "active_transactions", default=frozenset()
+)
+
+
+def in_unit_of_work(db):
+    """Whether the current task holds a unit of work on db"""
+    return (get_transaction_key(db), current_task()) in _active_transactions.get()
+
+
+# Change notifications per connection, see get_changes
+_changes: WeakKeyDictionary = WeakKeyDictionary()
+
+
+def get_changes(db) -> Changes:
+    """Change notifications for the tables of db. Handles sharing a
+    connection share them, too."""
+    key = get_transaction_key(db)
+    if key not in _changes:
+        _changes[key] = Changes()
+    return _changes[key]
+
+
+def notify_changes(db, tables):
+    """Records that tables of db were written to. Inside a unit of work the
+    change is published once the unit commits, so nothing caches what the
+    reader still reads from before the commit."""
+    changes = get_changes(db)
+    if in_unit_of_work(db):
+        changes.pending.update(tables)
+    else:
+        changes.publish(tables)
+
+
+def end_changes(key, committed):
+    changes = _changes.get(key)
+    if changes is not None:
+        changes.commit() if committed else changes.rollback()
+
+
+@asynccontextmanager
+async def transaction(db):
+    """Unit of work on a connection.
+
+    Commits once when the outermost unit exits and rolls back if it raises.
+    Nested units (including the ones opened by writes inside the unit) join
+    the outer unit instead of committing on their own. Units opened by other
+    tasks, including the ones spawned from within the unit, wait for it to
+    end instead."""
+    key = get_transaction_key(db)
+    unit = (key, current_task())
+    active = _active_transactions.get()
+    if unit in active:
+        yield db
+        return
+
+    lock = _transaction_locks.setdefault(key, Lock())
+    async with lock:
+        token = _active_transactions.set(active | {unit})
+        try:
+            # Fails rather than joining a transaction begun outside of a unit
+            await db.execute("BEGIN")
+            yield db
+        except BaseException:
+            await db.rollback()
+            end_changes(key, committed=False)
+            raise
+        else:
+            await db.commit()
+            end_changes(key, committed=True)
+        finally:
+            _active_transactions.reset(token)
+
+
+async def run_sync(db, fn, *args, **kwargs):
+    """Runs fn(connection, *args, **kwargs) in the thread of db, connection
+    being the sqlite3.Connection behind db.
+
+    Any number of statements run by fn cost a single round trip to the
+    thread, where every await on db costs one each. fn blocks the connection
+    while it runs, so it must not wait on anything but the database. Rows of
+    tenant databases are not scoped for fn; it has to do that itself."""
+    if hasattr(db, "run_sync"):
+        return await db.run_sync(fn, *args, **kwargs)
+    # Plain aiosqlite connections
+    return await db._execute(fn, db._conn, *args, **kwargs)
+
+
+async def run_sync_transaction(db, fn, *args, **kwargs):
+    """Like run_sync, but fn runs as a unit of work (see transaction) that is
+    begun and committed (or rolled back) in the same round trip"""
+    if in_unit_of_work(db):
+        return await run_sync(db, fn, *args, **kwargs)
+
+    def run_in_transaction(connection, *args, **kwargs):
+        connection.execute("BEGIN")
+        try:
+            result = fn(connection, *args, **kwargs)
+        except BaseException:
+            connection.rollback()
+            raise
+        connection.commit()
+        return result
+
+    async with _transaction_locks.setdefault(get_transaction_key(db), Lock()):
+        return await run_sync(db, run_in_transaction, *args, **kwargs)
+
+
+async def run_sync_exclusive(db, fn, *args, **kwargs):
+    """Like run_sync, but fn runs once the unit of work on db is done and
+    none begins while it runs, for statements that can't run in a transaction
+    (e.g. VACUUM). Must not be called from within a unit of work on db."""
+    async with _transaction_locks.setdefault(get_transaction_key(db), Lock()):
+        return await run_sync(db, fn, *args, **kwargs)
+
+
+class WriteQueue:
+    """Commits the writes to a database that arrive at about the same time in
+    one transaction, so a burst of writes costs one commit (and with it one
+    fsync) instead of one each.
+
+    A write to an idle queue is committed right away (after the window, if
+    there is one), and the writes that arrive meanwhile make up the next
+    batch, so batches grow with the load without delaying lone writes.
+
+    Every write runs in a savepoint of its own, so a write that fails is
+    rolled back alone and its caller gets the error, while the others are
+    committed and their callers get their results."""
+
+    def __init__(self, db, get_setting=None):
+        self.db = db
+        self.get_setting = get_setting or (lambda setting, default: default)
+        self.pending = []
+        self.flusher = None
+        self.writes = 0
+        self.commits = 0
+
+    @property
+    def window(self):
+        """Seconds to wait for more writes, or None if writes are not grouped"""
+        window_ms = get_number_setting(
+            self.get_setting, GROUP_COMMIT_MS_SETTING, None, minimum=0, finite=True
+        )
+        return None if window_ms is None else window_ms / 1000
+
+    async def submit(self, fn, *args, **kwargs):
+        future = get_running_loop().create_future()
+        self.pending.append((fn, args, kwargs, future))
+        if self.flusher is None:
+            self.flusher = create_task(self.flush())
+        return await future
+
+    async def flush(self):
+        try:
+            if self.window:
+                await sleep(self.window)
+            # Writes arriving while a batch commits make up the next one
+            while self.pending:
+                batch = self.pending[:GROUP_COMMIT_MAX_WRITES]
+                del self.pending[:GROUP_COMMIT_MAX_WRITES]
+                await self.commit(batch)
+        finally:
+            self.flusher = None
+
+    async def commit(self, batch):
+        def run_batch(connection):
+            results = []
+            for fn, args, kwargs, _ in batch:
+                connection.execute("SAVEPOINT grouped_write")
+                try:
+                    results.append((fn(connection, *args, **kwargs), None))
+                except Exception as e:
+                    connection.execute("ROLLBACK TO grouped_write")
+                    results.append((None, e))
+                connection.execute("RELEASE grouped_write")
+            return results
+
+        try:
+            results = await run_sync_transaction(self.db, run_batch)
+        except BaseException as e:
+            # The commit failed, which takes all of the batch with it
+            for *_, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            if not isinstance(e, Exception):
+                raise
+            return
+
+        self.commits += 1
+        self.writes += len(batch)
+        for (*_, future), (result, error) in zip(batch, results):
+            # Callers that gave up waiting still had their write committed
+            if future.done():
+                continue
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+
+async def run_sync_grouped(db, fn, *args, **kwargs):
+    """Like run_sync_transaction, but fn may be committed together with the
+    writes of other callers (see WriteQueue). Inside a unit of work, and for
+    connections without a write queue, it is run_sync_transaction."""
+    queue = getattr(db, "write_queue", None)
+    if queue is None or queue.window is None or in_unit_of_work(db):
+        return await run_sync_transaction(db, fn, *args, **kwargs)
+    return await queue.submit(fn, *args, **kwargs)
+
+
+class GuildDatabase:
+    """Handle for a guild database.
+
+    Handles are created for every guild up front and are what get_guild_db
+    returns, so they can be held on to (e.g. by views) for as long as needed.
+    The connection behind a handle is opened on first use and may be closed
+    by GuildDatabases while idle, in which case the next use reopens it."""
+
+    def __init__(self, manager, guild):
+        self.manager = manager
+        self.guild = guild
+        self.connection = None
+        self.reader = GuildDatabaseReader(self)
+        self.write_queue = WriteQueue(self, manager.get_setting)
+        self._lock = Lock()
+
+    async def connect(self):
+        if self.connection is None:
+            async with self._lock:
+                if self.connection is None:
+                    self.connection = await self.manager.open(self)
+        else:
+            self.manager.touch(self)
+        return self.connection
+
+    @property
+    def in_transaction(self):
+        return self.connection is not None and self.connection.in_transaction
+
+    @property
+    def idle(self):
+        if self.connection is None:
+            return True
+        lock = _transaction_locks.get(self)
+        return (
+            not self.connection.in_transaction
+            and not (lock and lock.locked())
+            and not any(
+                connection.busy
+                for connection in (self.connection, self.reader.connection)
+                if connection is not None
+            )
+        )
+
+    @contextmanager
+    async def execute(self, sql, parameters=None):
+        return await (await self.connect()).execute(sql, parameters)
+
+    @contextmanager
+    async def executemany(self, sql, parameters):
+        return await (await self.connect()).executemany(sql, parameters)
+
+    @contextmanager
+    async def executescript(self, sql_script):
+        return await (await self.connect()).executescript(sql_script)
+
+    async def execute_fetchall(self, sql, parameters=None):
+        return await (await self.connect()).execute_fetchall(sql, parameters)
+
+    async def execute_insert(self, sql, parameters=None):
+        return await (await self.connect()).execute_insert(sql, parameters)
+
+    async def run_sync(self, fn, *args, **kwargs):
+        return await run_sync(await self.connect(), fn, *args, **kwargs)
+
+    async def commit(self):
+        if self.connection is not None:
+            await self.connection.commit()
+
+    async def rollback(self):
+        if self.connection is not None:
+            await self.connection.rollback()
+
+    async def close(self):
+        await self.reader.close()
+        connection, self.connection = self.connection, None
+        if connection is not None:
+            await connection.close()
+
+
+class GuildDatabaseReader:
+    """Read-only side of a GuildDatabase.
+
+    SELECTs run on a separate read-only connection with its own thread, so
+    they neither wait for nor hold up writes. It only sees committed data.
+    Without a reader connection (e.g. outside of WAL mode) statements run on
+    the writer."""
+
+    def __init__(self, db):
+        self.db = db
+        self.connection = None
+        self._lock = Lock()
+
+    async def connect(self):
+        # The writer creates the database, which must exist for a read-only
+        # connection, and keeps the handle in the LRU
+        writer = await self.db.connect()
+        if self.connection is None:
+            async with self._lock:
+                if self.connection is None:
+                    connect_reader = self.db.manager.connect_reader
+                    reader = connect_reader and await connect_reader(self.db.guild)
+                    self.connection = reader or writer
+        return self.connection
+
+    @property
+    def in_transaction(self):
+        return False
+
+    @contextmanager
+    async def execute(self, sql, parameters=None):
+        return await (await self.connect()).execute(sql, parameters)
+
+    async def execute_fetchall(self, sql, parameters=None):
+        return await (await self.connect()).execute_fetchall(sql, parameters)
+
+    async def run_sync(self, fn, *args, **kwargs):
+        return await run_sync(await self.connect(), fn, *args, **kwargs)
+
+    async def close(self):
+        connection, self.connection = self.connection, None
+        if connection is not None and connection is not self.db.connection:
+            await connection.close()
+
+
+class GuildDatabases:
+    """Guild database handles, of which at most max_open keep a connection
+    (and with it a thread and a file handle) open.
+
+    When a connection is opened while the limit is reached, the least recently
+    used idle connections are closed. Connections in use (in a unit of work,
+    running a statement or with a cursor still referenced) are never closed,
+    so when all of them are busy, opening another waits for one to become
+    idle. A task must therefore not open a guild database while it keeps
+    another one busy."""
+
+    def __init__(self, connect, get_setting=None, *, connect_reader=None):
+        self.connect = connect
+        self.connect_reader = connect_reader
+        self.get_setting = get_setting or (lambda setting, default: default)
+        self.handles: dict[int, GuildDatabase] = {}
+        # Handles with an open connection, least recently used first
+        self.connected: OrderedDict[int, GuildDatabase] = OrderedDict()
+        # Connections being opened, which count towards the limit
+        self.opening = 0
+        self.opened = 0
+        self.evicted = 0
+        self.waited = 0
+
+    @property
+    def max_open(self):
+        return get_number_setting(
+            self.get_setting,
+            MAX_GUILD_CONNECTIONS_SETTING,
+            DEFAULT_MAX_GUILD_CONNECTIONS,
+            int,
+            minimum=1,
+        )
+
+    def __contains__(self, guild_id):
+        return guild_id in self.handles
+
+    def __getitem__(self, guild_id):
+        return self.handles[guild_id]
+
+    def add(self, guild):
+        if guild.id not in self.handles:
+            self.handles[guild.id] = GuildDatabase(self, guild)
+        return self.handles[guild.id]
+
+    async def remove(self, guild):
+        handle = self.handles.pop(guild.id, None)
+        if handle is not None:
+            self.connected.pop(guild.id, None)
+            await handle.close()
+
+    def touch(self, handle):
+        self.connected.move_to_end(handle.guild.id)
+
+    async def open(self, handle):
+        waited = False
+        while True:
+            await self.evict(self.max_open - 1 - self.opening)
+            if len(self.connected) + self.opening < self.max_open:
+                break
+            waited = True
+            await sleep(GUILD_CONNECTION_WAIT_SECONDS)
+        self.waited += waited
+
+        self.opening += 1
+        try:
+            connection = await self.connect(handle.guild)
+        finally:
+            self.opening -= 1
+        self.connected[handle.guild.id] = handle
+        self.opened += 1
+        # Changes made while the connection was closed can't be told apart
+        changes = _changes.get(handle)
+        if changes is not None:
+            changes.publish(None)
+        return connection
+
+    async def evict(self, max_open):
+        """Closes least recently used idle connections until at most max_open
+        connections are open"""
+        victims = []
+        for handle in self.connected.values():
+            if len(self.connected) - len(victims) <= max_open:
+                break
+            if handle.idle:
+                victims.append(handle)
+        for handle in victims:
+            del self.connected[handle.guild.id]
+        self.evicted += len(victims)
+        await gather(*[handle.close() for handle in victims])
+
+    async def close(self):
+        handles = list(self.connected.values())
+        self.connected.clear()
+        await gather(*[handle.close() for handle in handles])
+
+    def summary(self):
+        queues = [handle.write_queue for handle in self.handles.values()]
+        return (
+            f"{len(self.connected)} open (max {self.max_open}), "
+            f"{self.opened} opened, {self.evicted} evicted, "
+            f"{self.waited} waited for a connection, "
+            f"{sum(queue.writes for queue in queues)} grouped writes in "
+            f"{sum(queue.commits for queue in queues)} commits"
+        )
+
+
+class TenantDatabase:
+    """A guild's partition of the consolidated database.
+
+    Statements run on the connection shared by all guilds, so extensions have
+    to scope them to the partition of get_tenant(db) themselves. Units of work
+    are per shared connection, not per guild."""
+
+    def __init__(self, connection, guild, reader_connection=None, write_queue=None):
+        self.connection = connection
+        self.guild = guild
+        self.tenant = guild.id
+        self.transaction_key = connection
+        self.write_queue = write_queue
+        self.reader = (
+            self
+            if reader_connection is None
+            else TenantDatabase(reader_connection, guild)
+        )
+
+    @property
+    def in_transaction(self):
+        return self.connection.in_transaction
+
+    @contextmanager
+    async def execute(self, sql, parameters=None):
+        return await self.connection.execute(sql, parameters)
+
+    @contextmanager
+    async def executemany(self, sql, parameters):
+        return await self.connection.executemany(sql, parameters)
+
+    @contextmanager
+    async def executescript(self, sql_script):
+        return await self.connection.executescript(sql_script)
+
+    async def execute_fetchall(self, sql, parameters=None):
+        return await self.connection.execute_fetchall(sql, parameters)
+
+    async def execute_insert(self, sql, parameters=None):
+        return await self.connection.execute_insert(sql, parameters)
+
+    async def run_sync(self, fn, *args, **kwargs):
+        return await run_sync(self.connection, fn, *args, **kwargs)
+
+    async def commit(self):
+        await self.connection.commit()
+
+    async def rollback(self):
+        await self.connection.rollback()
+
+
+class TenantDatabases:
+    """Guild database handles of the consolidated database, which is opened
+    once for all guilds"""
+
+    def __init__(self, connection, reader_connection=None, get_setting=None):
+        self.connection = connection
+        self.reader_connection = reader_connection
+        # Writes of all guilds are committed together
+        self.write_queue = WriteQueue(connection, get_setting)
+        self.handles: dict[int, TenantDatabase] = {}
+
+    def __contains__(self, guild_id):
+        return guild_id in self.handles
+
+    def __getitem__(self, guild_id):
+        return self.handles[guild_id]
+
+    def add(self, guild):
+        if guild.id not in self.handles:
+            self.handles[guild.id] = TenantDatabase(
+                self.connection, guild, self.reader_connection, self.write_queue
+            )
+        return self.handles[guild.id]
+
+    async def remove(self, guild):
+        # The guild's rows stay in the consolidated database
+        self.handles.pop(guild.id, None)
+
+    async def close(self):
+        if self.reader_connection is not None:
+            await self.reader_connection.close()
+        await self.connection.close()
+
+    def summary(self):
+        return (
+            f"consolidated, {len(self.handles)} guilds, "
+            f"{self.write_queue.writes} grouped writes in "
+            f"{self.write_queue.commits} commits"
+        )
+
 
 class SQLite(commands.Cog, name="sqlite"):
     def __init__(self, bot):
         self.bot = bot
+        self.stats = StatementStats(self.get_setting)
+        self.guild_dbs = GuildDatabases(
+            self.connect_guild_db,
+            self.get_setting,
+            connect_reader=self.connect_guild_reader,
+        )
+        self.backups = Backups(self.get_backup_sources, self.get_setting)
+        # Last PRAGMA data_version seen per connection
+        self.data_versions: WeakKeyDictionary = WeakKeyDictionary()
+        self.maintenance = Maintenance(
+            self.get_maintenance_databases, run_sync_exclusive, self.get_setting
+        )
+
+    def get_setting(self, setting, default):
+        settings = self.bot.get_cog("settings")
+        if not settings:
+            return default
+        return settings.get(setting, default)
+
+    def format_stats(self, limit=10):
+        return (
+            f"**Guild connections** {self.guild_dbs.summary()}\n"
+            f"**Maintenance** {self.maintenance.summary()}\n"
+        ) + format_stats(self.stats, limit)
 
     def get_ctx_db(self, ctx):
         if not ctx.guild:
             return self.db
         return self.get_guild_db(ctx.guild)
 
+    def guild_transaction(self, guild):
+        return transaction(self.get_guild_db(guild))
+
+    async def guild_run_sync(self, guild, fn, *args, **kwargs):
+        return await run_sync(self.get_guild_db(guild), fn, *args, **kwargs)
+
+    async def guild_run_sync_transaction(self, guild, fn, *args, **kwargs):
+        return await run_sync_transaction(self.get_guild_db(guild), fn, *args, **kwargs)
+
+    async def guild_run_sync_grouped(self, guild, fn, *args, **kwargs):
+        return await run_sync_grouped(self.get_guild_db(guild), fn, *args, **kwargs)
+
     def get_guild_db(self, guild):
         if not guild:
             raise commands.NoPrivateMessage()
@@ -47,22 +953,46 @@ class SQLite(commands.Cog, name="sqlite"):
     async def on_guild_join(self, guild):
         # Ensure guild path was created
         await self.bot.get_cog("guildstorage").create_guild_storage(guild)
-        self.guild_dbs[guild.id] = await self.connect_guild_db(guild)
+        self.guild_dbs.add(guild)
 
     async def on_guild_remove(self, guild):
         if guild.id in self.guild_dbs:
-            await self.guild_dbs[guild.id].close()
-            await AsyncPath(self.get_guild_db_path(guild)).unlink()
+            await self.guild_dbs.remove(guild)
+            if not self.consolidated:
+                await AsyncPath(self.get_guild_db_path(guild)).unlink()
+
+    @property
+    def consolidated(self):
+        return isinstance(self.guild_dbs, TenantDatabases)
 
     async def cog_load(self):
-        self.db = await aiosqlite.connect(DB_FILENAME)
+        self.db = await connect(DB_FILENAME, self.stats)
+
+        # The storage mode can't change while databases are open, so it is
+        # only read on load
+        mode = self.get_setting(STORAGE_MODE_SETTING, DEFAULT_STORAGE_MODE)
+        if mode == "consolidated":
+            self.guild_dbs = TenantDatabases(
+                await self.connect_db(CONSOLIDATED_DB_FILENAME),
+                await self.connect_reader(CONSOLIDATED_DB_FILENAME),
+                self.get_setting,
+            )
+        elif mode != "guild":
+            raise ValueError(f"Unknown {STORAGE_MODE_SETTING} {mode}")
 
-        dbs = await gather(*[self.connect_guild_db(guild) for guild in self.bot.guilds])
-        self.guild_dbs = dict(zip([guild.id for guild in self.bot.guilds], dbs))
+        # Guild databases are connected on first use
+        for guild in self.bot.guilds:
+            self.guild_dbs.add(guild)
+        self.scheduled_backup.start()
+        self.scheduled_maintenance.start()
+        self.poll_changes.start()
 
     async def cog_unload(self):
+        self.scheduled_backup.cancel()
+        self.scheduled_maintenance.cancel()
+        self.poll_changes.cancel()
         await self.db.close()
-        await gather(*[self.guild_dbs[db].close() for db in self.guild_dbs])
+        await self.guild_dbs.close()
 
     def get_guild_db_path(self, guild):
         guild_storage_path = self.bot.get_cog("guildstorage").get_guild_storage_path(
@@ -70,12 +1000,108 @@ class SQLite(commands.Cog, name="sqlite"):
         )
         return str(PurePath(guild_storage_path, DB_FILENAME))
 
+    def get_backup_sources(self):
+        sources = [(DB_FILENAME, DB_FILENAME)]
+        if self.consolidated:
+            sources.append((CONSOLIDATED_DB_FILENAME, CONSOLIDATED_DB_FILENAME))
+            return sources
+        for handle in self.guild_dbs.handles.values():
+            path = self.get_guild_db_path(handle.guild)
+            # Databases of guilds that were never used don't exist yet
+            if Path(path).exists():
+                sources.append((f"guilds/{handle.guild.id}/{DB_FILENAME}", path))
+        return sources
+
+    @tasks.loop(minutes=BACKUP_CHECK_MINUTES)
+    async def scheduled_backup(self):
+        if not self.backups.is_due() or self.backups.running:
+            return
+        stats = await self.backups.run()
+        if stats.failed:
+            logger.warning(stats.format())
+        else:
+            logger.info(stats.format())
+
+    def get_maintenance_databases(self):
+        databases = [("bot", self.db)]
+        if self.consolidated:
+            databases.append(("consolidated", self.guild_dbs.connection))
+            return databases
+        for handle in self.guild_dbs.handles.values():
+            # Maintaining a database that does not exist would create it
+            if Path(self.get_guild_db_path(handle.guild)).exists():
+                databases.append((f"guild {handle.guild.id}", handle))
+        return databases
+
+    @tasks.loop(minutes=MAINTENANCE_CYCLE_MINUTES)
+    async def scheduled_maintenance(self):
+        await self.maintenance.run_cycle()
+
+    def get_guild_changes(self, guild) -> Changes:
+        return get_changes(self.get_guild_db(guild))
+
+    def get_open_connections(self):
+        """(db, connection) pairs of the open connections written to"""
+        connections = [(self.db, self.db)]
+        if self.consolidated:
+            connections.append((self.guild_dbs.connection, self.guild_dbs.connection))
+            return connections
+        for handle in self.guild_dbs.connected.values():
+            if handle.connection is not None:
+                connections.append((handle, handle.connection))
+        return connections
+
+    async def check_changes(self, db, connection):
+        """Publishes a change of db if another connection committed to it
+        since the last check"""
+        ((data_version,),) = await connection.execute_fetchall("PRAGMA data_version")
+        last = self.data_versions.get(connection)
+        self.data_versions[connection] = data_version
+        if last is not None and last != data_version:
+            get_changes(db).publish(None)
+
+    @tasks.loop(seconds=CHANGE_POLL_SECONDS)
+    async def poll_changes(self):
+        for db, connection in self.get_open_connections():
+            try:
+                await self.check_changes(db, connection)
+            except (sqlite3.Error, ValueError):
+                # Closed while being checked
+                continue
+
+    def get_pragma_profile(self):
+        return PRAGMA_PROFILES[
+            self.get_setting(PRAGMA_PROFILE_SETTING, DEFAULT_PRAGMA_PROFILE)
+        ]
+
     async def connect_guild_db(self, guild):
-        return await aiosqlite.connect(self.get_guild_db_path(guild))
+        return await self.connect_db(self.get_guild_db_path(guild))
+
+    async def connect_guild_reader(self, guild):
+        return await self.connect_reader(self.get_guild_db_path(guild))
+
+    async def connect_db(self, path):
+        db = await connect(path, self.stats)
+        await apply_pragmas(db, self.get_pragma_profile())
+        return db
+
+    async def connect_reader(self, path):
+        # Outside of WAL mode readers block the writer
+        profile = self.get_pragma_profile()
+        if profile.get("journal_mode") != "WAL":
+            return None
+        uri = f"{Path(path).absolute().as_uri()}?mode=ro"
+        db = await connect(uri, self.stats, uri=True)
+        await apply_pragmas(
+            db, {k: v for k, v in profile.items() if k in READER_PRAGMAS}
+        )
+        return db
 
 
 async def setup(bot):
     await bot.get_cog("system").load_extension("guildstorage")
+    # The storage mode is a setting
+    await bot.get_cog("system").load_extension("settings")
     await bot.add_cog(SQLite(bot))
 
 
@@ -9,4 +9,15 @@ CREATE TABLE IF NOT EXISTS
     review_count INT NOT NULL,
     review_summary TEXT NOT NULL,
     date_created DATETIME NOT NULL
-  )
\ No newline at end of file
+  );
+
+CREATE TABLE IF NOT EXISTS
+  steam_versions (
+    version INTEGER PRIMARY KEY
+  );
+
+INSERT INTO
+  steam_versions
+VALUES
+  (0)
+ON CONFLICT DO NOTHING ;
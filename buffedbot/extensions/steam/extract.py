@@ -0,0 +1,234 @@
+"""Single-pass extraction of Steam store pages.
+
+The parsers below read a page with the standard library's tokenizer and
+keep only the few values the cog needs, instead of building a tree of the
+whole page and querying it with CSS selectors. They stop reading once they
+have found everything they look for.
+"""
+from html.parser import HTMLParser
+from typing import Optional
+
+from buffedbot.errors import AttributeNotFoundError, ElementNotFoundError
+
+# Markup is fed to the parsers in chunks of this many characters, so they
+# can stop early
+CHUNK_SIZE = 16 * 1024
+
+# Elements that never have an end tag
+VOID_ELEMENTS = frozenset(
+    {
+        "area",
+        "base",
+        "br",
+        "col",
+        "embed",
+        "hr",
+        "img",
+        "input",
+        "link",
+        "meta",
+        "source",
+        "track",
+        "wbr",
+    }
+)
+
+OG_PROPERTIES = ("og:url", "og:description", "og:image")
+
+
+def decode(markup: bytes | str) -> str:
+    if isinstance(markup, str):
+        return markup
+    return markup.decode("utf-8", errors="replace")
+
+
+class ExtractingParser(HTMLParser):
+    """Keeps the stack of open elements, so subclasses can tell what an
+    element is nested in. Subclasses set done once they have found all they
+    look for."""
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        # (tag, marker) of the open elements, marker being what a subclass
+        # marked the element as, if anything
+        self.stack: list[tuple[str, Optional[str]]] = []
+        self.markers: dict[str, int] = {}
+        self.done = False
+
+    def run(self, markup: bytes | str):
+        markup = decode(markup)
+        for start in range(0, len(markup), CHUNK_SIZE):
+            self.feed(markup[start : start + CHUNK_SIZE])
+            if self.done:
+                return self
+        self.close()
+        return self
+
+    def inside(self, marker: str) -> bool:
+        return self.markers.get(marker, 0) > 0
+
+    def push(self, tag: str, marker: Optional[str]):
+        if tag in VOID_ELEMENTS:
+            return
+        self.stack.append((tag, marker))
+        if marker is not None:
+            self.markers[marker] = self.markers.get(marker, 0) + 1
+
+    def handle_starttag(self, tag, attrs):
+        self.push(tag, self.start(tag, dict(attrs)))
+
+    def handle_startendtag(self, tag, attrs):
+        self.start(tag, dict(attrs))
+
+    def handle_endtag(self, tag):
+        # Elements left open (e.g. <p> or <li>) are closed with their parent
+        if not any(open_tag == tag for open_tag, _ in self.stack):
+            return
+        while self.stack:
+            open_tag, marker = self.stack.pop()
+            if marker is not None:
+                self.markers[marker] -= 1
+                self.end(marker)
+            if open_tag == tag:
+                return
+
+    def start(self, tag: str, attrs: dict) -> Optional[str]:
+        """Called for every start tag, returns the marker of the element"""
+        return None
+
+    def end(self, marker: str):
+        """Called when a marked element ends"""
+
+
+class GameParser(ExtractingParser):
+    """Reads the values of a store page of a game, see SteamGameSoup"""
+
+    def __init__(self):
+        super().__init__()
+        self.og: dict[str, str] = {}
+        self.name: Optional[list[str]] = None
+        self.price: Optional[str] = None
+        self.review_count: Optional[str] = None
+        self.review_summary: Optional[list[str]] = None
+
+    def start(self, tag, attrs):
+        if tag == "meta":
+            if attrs.get("property") in OG_PROPERTIES:
+                self.og.setdefault(attrs["property"], attrs.get("content"))
+            elif attrs.get("itemprop") == "price" and self.inside("offers"):
+                if self.price is None:
+                    self.price = attrs.get("content")
+            elif attrs.get("itemprop") == "reviewCount" and self.inside("rating"):
+                if self.review_count is None:
+                    self.review_count = attrs.get("content")
+            self.check_done()
+            return None
+
+        itemprop = attrs.get("itemprop")
+        if itemprop == "offers":
+            return "offers"
+        if itemprop == "aggregateRating":
+            return "rating"
+        if tag == "span" and itemprop == "name" and self.name is None:
+            self.name = []
+            return "name"
+        if (
+            tag == "span"
+            and itemprop == "description"
+            and self.inside("rating")
+            and self.review_summary is None
+        ):
+            self.review_summary = []
+            return "review_summary"
+        return None
+
+    def handle_data(self, data):
+        if self.inside("name"):
+            self.name.append(data)
+        if self.inside("review_summary"):
+            self.review_summary.append(data)
+
+    def end(self, marker):
+        self.check_done()
+
+    def check_done(self):
+        self.done = (
+            len(self.og) == len(OG_PROPERTIES)
+            and self.name is not None
+            and not self.inside("name")
+            and self.price is not None
+            and self.review_count is not None
+            and self.review_summary is not None
+            and not self.inside("review_summary")
+        )
+
+    def get_og(self, property: str) -> str:
+        if property not in self.og:
+            raise ElementNotFoundError(
+                f'Element for query "meta[property="{property}"]" not found'
+            )
+        if self.og[property] is None:
+            raise AttributeNotFoundError('Attribute "content" missing')
+        return self.og[property]
+
+    def get_name(self) -> str:
+        if self.name is None:
+            raise ElementNotFoundError(
+                'Element for query "span[itemprop=name]" not found'
+            )
+        return "".join(self.name)
+
+    def get_price(self) -> float:
+        return float(self.price) if self.price is not None else -1.0
+
+    def get_review_count(self) -> int:
+        return int(self.review_count) if self.review_count is not None else 0
+
+    def get_review_summary(self) -> str:
+        if self.review_summary is None:
+            return "No reviews"
+        return "".join(self.review_summary)
+
+
+class SearchResultsParser(ExtractingParser):
+    """Reads the first limit rows of a search results page, as (href, title,
+    price) with price in cents, or None if the row has none"""
+
+    def __init__(self, limit: int):
+        super().__init__()
+        self.limit = limit
+        self.rows: list[tuple[str, str, Optional[str]]] = []
+        self.row: Optional[dict] = None
+
+    def start(self, tag, attrs):
+        if self.row is None:
+            # The rest of the chunk is still fed once done
+            if self.done:
+                return None
+            if tag == "a" and "search_result_row" in (attrs.get("class") or "").split():
+                self.row = {"href": attrs.get("href"), "title": None, "price": None}
+                return "row"
+            return None
+
+        if "data-price-final" in attrs and self.row["price"] is None:
+            self.row["price"] = attrs["data-price-final"]
+        if (
+            tag == "span"
+            and "title" in (attrs.get("class") or "").split()
+            and self.row["title"] is None
+        ):
+            self.row["title"] = []
+            return "title"
+        return None
+
+    def handle_data(self, data):
+        if self.inside("title"):
+            self.row["title"].append(data)
+
+    def end(self, marker):
+        if marker != "row":
+            return
+        row, self.row = self.row, None
+        if row["href"] is not None and row["title"] is not None:
+            self.rows.append((row["href"], "".join(row["title"]), row["price"]))
+        self.done = len(self.rows) >= self.limit
@@ -0,0 +1,7 @@
+-- Search results by normalized term, stored as a JSON array
+CREATE TABLE IF NOT EXISTS
+  steam_search_cache (
+    term TEXT PRIMARY KEY,
+    results TEXT NOT NULL,
+    date_created DATETIME NOT NULL DEFAULT (DATETIME('now'))
+  ) ;
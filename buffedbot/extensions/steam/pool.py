@@ -0,0 +1,130 @@
+from asyncio import Semaphore, get_running_loop
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import get_context
+from time import perf_counter
+from typing import Callable, Optional, TypeVar
+
+from buffedbot.errors import SteamBusyError
+from buffedbot.extensions.settings import get_number_setting
+
+# Where store pages are parsed: "process" (a pool of worker processes, which
+# parse in parallel), "thread" (a pool of threads, which keeps the event loop
+# responsive but shares the interpreter with it) or "inline" (on the event
+# loop). Read when the pool is first used.
+PARSE_EXECUTOR_SETTING = "steam-parse-executor"
+DEFAULT_PARSE_EXECUTOR = "process"
+PARSE_WORKERS_SETTING = "steam-parse-workers"
+DEFAULT_PARSE_WORKERS = 2
+# Pages waiting for or being parsed at most. Lookups beyond that fail
+# instead of queuing up behind a backlog.
+PARSE_QUEUE_SIZE_SETTING = "steam-parse-queue-size"
+DEFAULT_PARSE_QUEUE_SIZE = 16
+
+T = TypeVar("T")
+
+
+def timed(fn: Callable[..., T], *args) -> tuple[T, float]:
+    """Runs in the worker, so the time spent parsing can be told apart from
+    the time spent waiting for a worker"""
+    start = perf_counter()
+    return fn(*args), perf_counter() - start
+
+
+class ParsePool:
+    """Parses pages off the event loop.
+
+    At most as many pages as there are workers are handed to the executor,
+    the others wait their turn in the (bounded) queue. fn and its arguments
+    are sent to worker processes, so they have to be picklable, as do the
+    results (plain data such as dicts and lists)."""
+
+    def __init__(self, get_setting=None):
+        self.get_setting = get_setting or (lambda setting, default: default)
+        self.kind: Optional[str] = None
+        self.executor: Optional[Executor] = None
+        self.slots: Optional[Semaphore] = None
+        self.pending = 0
+        self.parses = 0
+        self.rejected = 0
+        self.queue_time = 0.0
+        self.parse_time = 0.0
+        self.max_queue_time = 0.0
+
+    @property
+    def queue_size(self) -> int:
+        return get_number_setting(
+            self.get_setting,
+            PARSE_QUEUE_SIZE_SETTING,
+            DEFAULT_PARSE_QUEUE_SIZE,
+            int,
+            minimum=1,
+        )
+
+    def start(self):
+        self.kind = self.get_setting(PARSE_EXECUTOR_SETTING, DEFAULT_PARSE_EXECUTOR)
+        workers = get_number_setting(
+            self.get_setting,
+            PARSE_WORKERS_SETTING,
+            DEFAULT_PARSE_WORKERS,
+            int,
+            minimum=1,
+        )
+        if self.kind == "process":
+            # Forking would copy the bot's threads (e.g. the database
+            # connections) in whatever state they are in
+            self.executor = ProcessPoolExecutor(
+                workers, mp_context=get_context("spawn")
+            )
+        elif self.kind == "thread":
+            self.executor = ThreadPoolExecutor(
+                workers, thread_name_prefix="steam-parse"
+            )
+        elif self.kind == "inline":
+            workers = 1
+        else:
+            raise ValueError(f"Unknown {PARSE_EXECUTOR_SETTING} {self.kind}")
+        self.slots = Semaphore(workers)
+
+    async def run(self, fn: Callable[..., T], *args) -> T:
+        if self.pending >= self.queue_size:
+            self.rejected += 1
+            raise SteamBusyError()
+        if self.slots is None:
+            self.start()
+
+        self.pending += 1
+        submitted = perf_counter()
+        try:
+            async with self.slots:
+                if self.executor is None:
+                    result, parse_time = timed(fn, *args)
+                else:
+                    result, parse_time = await get_running_loop().run_in_executor(
+                        self.executor, timed, fn, *args
+                    )
+        finally:
+            self.pending -= 1
+
+        # Includes sending the page to the worker and the result back
+        queue_time = perf_counter() - submitted - parse_time
+        self.parses += 1
+        self.parse_time += parse_time
+        self.queue_time += queue_time
+        self.max_queue_time = max(self.max_queue_time, queue_time)
+        return result
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+        self.executor = None
+        self.slots = None
+
+    def format(self) -> str:
+        parses = max(self.parses, 1)
+        return (
+            f"parsing ({self.kind or 'not started'}): {self.parses} pages, "
+            f"{self.parse_time / parses * 1000:.1f} ms parsing and "
+            f"{self.queue_time / parses * 1000:.1f} ms queued on average "
+            f"(max {self.max_queue_time * 1000:.1f} ms), {self.pending} pending, "
+            f"{self.rejected} rejected"
+        )
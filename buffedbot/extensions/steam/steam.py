@@ -1,30 +1,107 @@
-from datetime import datetime
+from asyncio import Future, Task, ensure_future, shield
+from collections import OrderedDict
+from datetime import datetime, timezone
 from http.cookies import SimpleCookie
+import json
+import logging
 import re
-from typing import TypedDict
-from aiopath import PurePath
-import aiofiles
+import time
+from typing import Awaitable, Callable, Hashable, TypedDict, TypeVar
+from pathlib import Path
 import inspect
 from discord.ext import commands
 from discord import Embed
 from aiohttp import ClientSession
 from bs4 import BeautifulSoup, Tag
 from buffedbot.extensions.sqlite import (
+    Schema,
     get_column_names,
     get_placeholder_names,
     get_placeholder_values,
+    transaction,
 )
 from urllib.parse import urlencode, urljoin, urlparse, urlunparse
+from buffedbot.extensions.settings import get_number_setting
 from buffedbot.errors import (
     GameNotFoundError,
     AttributeNotFoundError,
     ElementNotFoundError,
+    SteamBusyError,
 )
 from dataclasses import dataclass
+from .extract import GameParser, SearchResultsParser
+from .pool import ParsePool
 
 
 from yarl import URL
 
+STEAM_SCHEMA = Schema("steam", Path(__file__).parent, "steam_versions")
+
+T = TypeVar("T")
+
+logger = logging.getLogger(__name__)
+
+# Games in steam_games_cache are served as they are for the soft TTL. After
+# that they are still served, but refreshed in the background, until the
+# hard TTL, after which lookups wait for a fresh download.
+GAME_CACHE_SOFT_TTL_SETTING = "steam-game-cache-soft-hours"
+DEFAULT_GAME_CACHE_SOFT_TTL_HOURS = 24
+GAME_CACHE_HARD_TTL_SETTING = "steam-game-cache-hard-hours"
+DEFAULT_GAME_CACHE_HARD_TTL_HOURS = 7 * 24
+
+# Search results are kept this long, in memory and in steam_search_cache
+SEARCH_CACHE_TTL_HOURS = 12
+# Terms whose results are kept in memory at most
+SEARCH_CACHE_SIZE = 256
+# Search results read from a search page at most. The search command shows 5
+# and name lookups only look at the first.
+MAX_SEARCH_RESULTS = 10
+
+# How store pages are read, see EXTRACTORS
+EXTRACTOR_SETTING = "steam-extractor"
+DEFAULT_EXTRACTOR = "stream"
+
+
+class SingleFlight:
+    """Coalesces concurrent calls for the same key into one.
+
+    The first caller for a key starts the call, callers arriving while it is
+    in flight wait for it and all of them get its result (the same object)
+    or its error. The call runs as a task of its own, so a caller that is
+    cancelled does not cancel it for the others."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.in_flight: dict[Hashable, Future] = {}
+        self.calls = 0
+        self.coalesced = 0
+
+    async def run(self, key: Hashable, fn: Callable[[], Awaitable[T]]) -> T:
+        future = self.in_flight.get(key)
+        if future is not None:
+            self.coalesced += 1
+            return await shield(future)
+
+        self.calls += 1
+        future = ensure_future(fn())
+        self.in_flight[key] = future
+        future.add_done_callback(lambda future: self.done(key, future))
+        return await shield(future)
+
+    def done(self, key: Hashable, future: Future):
+        if self.in_flight.get(key) is future:
+            del self.in_flight[key]
+        # Retrieved so a call whose callers all gave up isn't logged as an
+        # unretrieved error
+        if not future.cancelled():
+            future.exception()
+
+    def format(self) -> str:
+        return (
+            f"{self.name}: {self.calls} calls, {self.coalesced} coalesced, "
+            f"{len(self.in_flight)} in flight"
+        )
+
 
 @dataclass
 class Game:
@@ -67,6 +144,96 @@ def game_to_discord_embed(game: Game) -> Embed:
     return embed
 
 
+def normalize_search_term(term: str) -> str:
+    return " ".join(term.lower().split())
+
+
+class SearchCache:
+    """In-memory LRU tier of the search result cache, in front of the
+    steam_search_cache table"""
+
+    def __init__(self, max_size: int = SEARCH_CACHE_SIZE):
+        self.max_size = max_size
+        # Results and when they expire (as a timestamp) by normalized term
+        self.entries: OrderedDict[str, tuple[list[SearchResult], float]] = OrderedDict()
+        self.hits = 0
+        self.table_hits = 0
+        self.downloads = 0
+
+    def get(self, term: str) -> list[SearchResult] | None:
+        entry = self.entries.get(term)
+        if entry is None:
+            return None
+        results, expires = entry
+        if expires <= time.time():
+            del self.entries[term]
+            return None
+        self.entries.move_to_end(term)
+        self.hits += 1
+        return results
+
+    def put(self, term: str, results: list[SearchResult], expires: float):
+        if expires <= time.time():
+            return
+        self.entries[term] = (results, expires)
+        self.entries.move_to_end(term)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def format(self) -> str:
+        return (
+            f"search cache: {len(self.entries)} terms, {self.hits} memory hits, "
+            f"{self.table_hits} table hits, {self.downloads} downloads"
+        )
+
+
+class GameRefreshes:
+    """Background refreshes of stale games in steam_games_cache, at most one
+    per game at a time"""
+
+    def __init__(self):
+        self.tasks: dict[str, Task] = {}
+        self.hits = 0
+        self.stale_hits = 0
+        self.downloads = 0
+        self.refreshes = 0
+        self.failures = 0
+
+    def start(self, url: str, fn: Callable[[], Awaitable]):
+        if url in self.tasks:
+            return
+        self.refreshes += 1
+        task = ensure_future(fn())
+        self.tasks[url] = task
+        task.add_done_callback(lambda task: self.done(url, task))
+
+    def done(self, url: str, task: Task):
+        if self.tasks.get(url) is task:
+            del self.tasks[url]
+        if task.cancelled():
+            return
+        error = task.exception()
+        if error is None:
+            return
+        self.failures += 1
+        if isinstance(error, SteamBusyError):
+            # The stale game is served again until a refresh gets through
+            logger.info(f"Refresh of {url} skipped: {error}")
+        else:
+            logger.warning(f"Refresh of {url} failed", exc_info=error)
+
+    def cancel(self):
+        for task in list(self.tasks.values()):
+            task.cancel()
+
+    def format(self) -> str:
+        return (
+            f"game cache: {self.hits} fresh hits, {self.stale_hits} stale hits, "
+            f"{self.downloads} downloads, {self.refreshes} background refreshes "
+            f"({len(self.tasks)} running, {self.failures} failed)"
+        )
+
+
 class ResultsEmbed(Embed):
     def add_result(self, result: SearchResult) -> "ResultsEmbed":
         price = result["price"]
@@ -82,6 +249,14 @@ class ResultsEmbed(Embed):
         )
 
 
+def to_search_result(href: str, name: str, price: str | None) -> SearchResult:
+    return SearchResult(
+        name=name,
+        url=urljoin(href, urlparse(href).path),
+        price=int(price) / 100.0 if price is not None else -1,
+    )
+
+
 class SteamSearchResultsSoup:
     def __init__(self, bs: BeautifulSoup):
         self.bs = bs
@@ -89,27 +264,23 @@ class SteamSearchResultsSoup:
     def get_result_anchors(self):
         return self.bs.select("a.search_result_row")
 
-    def get_result_title_spans(self):
-        return self.bs.select("a.search_result_row span.title")
-
-    def get_result_price_elements(self):
-        return self.bs.select("a.search_result_row [data-price-final]")
-
     def get_search_results(self) -> list[SearchResult]:
-        anchors = self.get_result_anchors()
-        spans = self.get_result_title_spans()
-        price_elements = self.get_result_price_elements()
-        if len(spans) != len(anchors):
-            raise RuntimeError()
-
-        return [
-            SearchResult(
-                name=str(span.string),
-                url=urljoin(anchor.attrs["href"], urlparse(anchor.attrs["href"]).path),
-                price=int(price_element.attrs["data-price-final"]) / 100.0,
+        results = []
+        # Rows may have more than one price element (e.g. the discount
+        # block), so prices are looked up per row
+        for anchor in self.get_result_anchors():
+            span = anchor.select_one("span.title")
+            if span is None:
+                raise RuntimeError()
+            price_element = anchor.select_one("[data-price-final]")
+            results.append(
+                to_search_result(
+                    anchor.attrs["href"],
+                    str(span.string),
+                    price_element.attrs["data-price-final"] if price_element else None,
+                )
             )
-            for (anchor, span, price_element) in zip(anchors, spans, price_elements)
-        ]
+        return results
 
 
 class SteamGameSoup:
@@ -185,13 +356,97 @@ class SteamGameSoup:
         return self.get_text(("span[itemprop=name]"))
 
 
+class SoupExtractor:
+    """Reads store pages by parsing them into a tree with BeautifulSoup and
+    querying it"""
+
+    def get_game_fields(self, markup: bytes) -> dict:
+        game_soup = SteamGameSoup(BeautifulSoup(markup, "html.parser"))
+        return dict(
+            name=game_soup.get_name(),
+            description=game_soup.get_description(),
+            url=game_soup.get_url(),
+            image=game_soup.get_image(),
+            price=game_soup.get_price(),
+            review_count=game_soup.get_review_count(),
+            review_summary=game_soup.get_review_summary(),
+        )
+
+    def get_search_results(self, markup: bytes, limit: int) -> list[SearchResult]:
+        search_results = SteamSearchResultsSoup(BeautifulSoup(markup, "html.parser"))
+        return search_results.get_search_results()[:limit]
+
+
+class StreamExtractor:
+    """Reads store pages in a single pass, keeping only the values needed
+    (see extract.py)"""
+
+    def get_game_fields(self, markup: bytes) -> dict:
+        parser = GameParser().run(markup)
+        return dict(
+            name=parser.get_name(),
+            description=parser.get_og("og:description"),
+            url=parser.get_og("og:url"),
+            image=parser.get_og("og:image"),
+            price=parser.get_price(),
+            review_count=parser.get_review_count(),
+            review_summary=parser.get_review_summary(),
+        )
+
+    def get_search_results(self, markup: bytes, limit: int) -> list[SearchResult]:
+        return [
+            to_search_result(*row)
+            for row in SearchResultsParser(limit).run(markup).rows
+        ]
+
+
+EXTRACTORS = {"soup": SoupExtractor(), "stream": StreamExtractor()}
+
+
 class Steam(commands.Cog, name="steam"):
     GameNotFoundError = GameNotFoundError
     AttributeNotFoundError = AttributeNotFoundError
     ElementNotFoundError = ElementNotFoundError
+    SteamBusyError = SteamBusyError
 
     def __init__(self, bot: commands.Bot):
         self.bot = bot
+        self.parse_pool = ParsePool(self.get_setting)
+        # Concurrent requests for the same game, search or name share one
+        # fetch and parse
+        self.game_flights = SingleFlight("get_game")
+        self.search_flights = SingleFlight("get_search_results")
+        self.url_by_name_flights = SingleFlight("get_game_url_by_name")
+        self.search_cache = SearchCache()
+        self.game_refreshes = GameRefreshes()
+
+    def get_setting(self, setting, default):
+        settings = self.bot.get_cog("settings")
+        if not settings:
+            return default
+        return settings.get(setting, default)
+
+    @property
+    def extractor(self):
+        return EXTRACTORS[self.get_setting(EXTRACTOR_SETTING, DEFAULT_EXTRACTOR)]
+
+    def format_stats(self) -> str:
+        return "\n".join(
+            ["**Steam requests**"]
+            + [
+                f"- {flights.format()}"
+                for flights in (
+                    self.game_flights,
+                    self.search_flights,
+                    self.url_by_name_flights,
+                )
+            ]
+            + [
+                f"- {self.search_cache.format()}",
+                f"- {self.game_refreshes.format()}",
+                f"- {self.parse_pool.format()}",
+            ]
+        )
 
     def get_db(self):
         return self.bot.get_cog("sqlite").db  # type: ignore
@@ -200,18 +455,14 @@ class Steam(commands.Cog, name="steam"):
     def db(self):
         return self.get_db()
 
-    @staticmethod
-    def get_bootstrap_file_path():
-        return PurePath(PurePath(__file__).parent, "bootstrap.sql")
-
     async def cog_load(self):
         self.session = ClientSession()
-        async with aiofiles.open(__class__.get_bootstrap_file_path(), "r") as f:
-            sql = await f.read()
-        await self.db.executescript(sql)
+        await STEAM_SCHEMA.upgrade(self.db)
 
     async def cog_unload(self):
+        self.game_refreshes.cancel()
         await self.session.close()
+        self.parse_pool.close()
 
     @commands.group()
     async def steam(self, ctx):
@@ -224,7 +475,10 @@ class Steam(commands.Cog, name="steam"):
         async with ctx.typing():
             term = " ".join(terms)
             limit = 5
-            results = await self.get_search_results(term)
+            try:
+                results = await self.get_search_results(term)
+            except SteamBusyError as e:
+                return await ctx.reply(f"*{str(e)}*")
             embed = ResultsEmbed(
                 title=f'Results for "{term}"',
                 url=__class__.get_search_url(term),
@@ -251,6 +505,11 @@ class Steam(commands.Cog, name="steam"):
         return f"https://store.steampowered.com/app/{appid}/"
 
     async def get_game_url_by_name(self, name):
+        return await self.url_by_name_flights.run(
+            name, lambda: self.fetch_game_url_by_name(name)
+        )
+
+    async def fetch_game_url_by_name(self, name):
         url_from_cache = await self.get_game_url_from_cache(name)
         if url_from_cache is not None:
             return url_from_cache
@@ -269,9 +528,10 @@ class Steam(commands.Cog, name="steam"):
             game_name = " ".join(message)
             try:
                 url = await self.get_game_url_by_name(game_name)
-            except GameNotFoundError as e:
+                game = await self.get_game(url)
+            except (GameNotFoundError, SteamBusyError) as e:
                 return await ctx.reply(f"*{str(e)}*")
-            embed = game_to_discord_embed(await self.get_game(url))
+            embed = game_to_discord_embed(game)
             await ctx.reply(embed=embed)
 
     @staticmethod
@@ -280,13 +540,87 @@ class Steam(commands.Cog, name="steam"):
         return f"https://store.steampowered.com/search/?{query}"
 
     async def get_search_results(self, term: str) -> list[SearchResult]:
-        request = await self.session.get(__class__.get_search_url(term))
-        markup = await request.read()
+        """Search results for term, from the search cache if they are in it.
+        The results are shared with other callers, so they must not be
+        modified."""
+        term = normalize_search_term(term)
+        results = self.search_cache.get(term)
+        if results is not None:
+            return results
+        return await self.search_flights.run(
+            term, lambda: self.fetch_search_results(term)
+        )
+
+    async def fetch_search_results(self, term: str) -> list[SearchResult]:
+        cached = await self.get_search_results_from_cache(term)
+        if cached is not None:
+            results, expires = cached
+            self.search_cache.table_hits += 1
+        else:
+            results = await self.download_search_results(term)
+            await self.store_search_results_in_cache(term, results)
+            expires = time.time() + SEARCH_CACHE_TTL_HOURS * 3600
+            self.search_cache.downloads += 1
+        self.search_cache.put(term, results, expires)
+        return results
+
+    async def get_search_results_from_cache(
+        self, term: str
+    ) -> tuple[list[SearchResult], float] | None:
+        sql = f"""
+            SELECT
+                results, date_created
+            FROM
+                steam_search_cache
+            WHERE
+                term = ? AND
+                DATETIME(date_created, '+{SEARCH_CACHE_TTL_HOURS} hours') > DATETIME('now')
+        """
+        async with await self.db.execute(sql, (term,)) as cursor:
+            async for results, date_created in cursor:
+                created = datetime.fromisoformat(date_created).replace(
+                    tzinfo=timezone.utc
+                )
+                return (
+                    json.loads(results),
+                    created.timestamp() + SEARCH_CACHE_TTL_HOURS * 3600,
+                )
 
-        bs = BeautifulSoup(markup, "html.parser")
-        search_results = SteamSearchResultsSoup(bs)
+    async def store_search_results_in_cache(
+        self, term: str, results: list[SearchResult]
+    ):
+        async with transaction(self.db):
+            # Expired results are only ever replaced, so they are dropped
+            # whenever new ones are stored
+            await self.db.execute(
+                f"""
+                    DELETE FROM
+                        steam_search_cache
+                    WHERE
+                        DATETIME(date_created, '+{SEARCH_CACHE_TTL_HOURS} hours') <= DATETIME('now')
+                """
+            )
+            await self.db.execute(
+                """
+                    INSERT INTO
+                        steam_search_cache (term, results)
+                    VALUES
+                        (?, ?)
+                    ON CONFLICT
+                        (term)
+                    DO UPDATE SET
+                        results = excluded.results,
+                        date_created = excluded.date_created
+                """,
+                (term, json.dumps(results)),
+            )
 
-        return search_results.get_search_results()
+    async def download_search_results(self, term: str) -> list[SearchResult]:
+        request = await self.session.get(__class__.get_search_url(term))
+        markup = await request.read()
+        return await self.parse_pool.run(
+            self.extractor.get_search_results, markup, MAX_SEARCH_RESULTS
+        )
 
     normalize_re = re.compile("^(/app/[0-9]+).*$")
 
@@ -311,20 +645,39 @@ class Steam(commands.Cog, name="steam"):
             async for row in cursor:
                 return row[0]
 
-    async def get_game_from_cache(self, normalized_url: str) -> Game | None:
-        CACHE_EXPIRATION = "+1 days"
+    async def get_game_from_cache(
+        self, normalized_url: str
+    ) -> tuple[Game, bool] | None:
+        """Returns the cached game, if it is younger than the hard TTL, and
+        whether it is older than the soft TTL"""
+        # Both are interpolated into the statement, so they must be finite
+        soft_ttl = get_number_setting(
+            self.get_setting,
+            GAME_CACHE_SOFT_TTL_SETTING,
+            DEFAULT_GAME_CACHE_SOFT_TTL_HOURS,
+            minimum=0,
+            finite=True,
+        )
+        hard_ttl = get_number_setting(
+            self.get_setting,
+            GAME_CACHE_HARD_TTL_SETTING,
+            DEFAULT_GAME_CACHE_HARD_TTL_HOURS,
+            minimum=0,
+            finite=True,
+        )
         app_id = __class__.get_app_id_from_url(normalized_url)
         sql = f"""
             SELECT
-                {get_column_names(inspect.get_annotations(Game), wrap_brackets=False)}
+                {get_column_names(inspect.get_annotations(Game), wrap_brackets=False)},
+                DATETIME(date_created, '+{soft_ttl} hours') <= DATETIME('now')
             FROM
                 steam_games_cache
             WHERE
-                app_id = ? AND DATETIME(date_created, '{CACHE_EXPIRATION}') > DATETIME('now')
+                app_id = ? AND DATETIME(date_created, '+{hard_ttl} hours') > DATETIME('now')
         """
         async with await self.db.execute(sql, (app_id,)) as cursor:
             async for row in cursor:
-                return Game(
+                game = Game(
                     name=row[0],
                     url=row[1],
                     description=row[2],
@@ -334,6 +687,7 @@ class Steam(commands.Cog, name="steam"):
                     review_summary=row[6],
                     date_created=row[7],
                 )
+                return game, bool(row[8])
 
     app_id_from_path_re = re.compile("^/app/([0-9]+).*$")
 
@@ -362,19 +716,30 @@ class Steam(commands.Cog, name="steam"):
                 date_created < excluded.date_created
         """
 
-        await self.db.execute(sql, get_placeholder_values(game_with_app_id))
-        await self.db.commit()
+        async with transaction(self.db):
+            await self.db.execute(sql, get_placeholder_values(game_with_app_id))
 
     async def get_game(self, url: str) -> Game:
         url = __class__.normalize_game_url(url)
+        return await self.game_flights.run(url, lambda: self.fetch_game(url))
 
+    async def fetch_game(self, url: str) -> Game:
         cached = await self.get_game_from_cache(url)
         if cached:
-            return cached
-
-        # We should do a mutex lock on the cache key here until the fetch has
-        # completed and the cache is populated to avoid thunderin herds
-
+            game, stale = cached
+            if stale:
+                # A day old price is fine for an embed, the next lookup gets
+                # the refreshed one
+                self.game_refreshes.stale_hits += 1
+                self.game_refreshes.start(url, lambda: self.download_game(url))
+            else:
+                self.game_refreshes.hits += 1
+            return game
+
+        self.game_refreshes.downloads += 1
+        return await self.download_game(url)
+
+    async def download_game(self, url: str) -> Game:
         # We might only need to explicitly add this cookie once per session
         additional_cookies = SimpleCookie()
         JAN_1_1980_UNIX_EPOCH_TIME = 315561600
@@ -384,21 +749,13 @@ class Steam(commands.Cog, name="steam"):
 
         response = await self.session.get(url)
         markup = await response.read()
-        bs = BeautifulSoup(markup, "html.parser")
-        game_soup = SteamGameSoup(bs)
 
         date_as_iso = datetime.strptime(
             response.headers["date"], "%a, %d %b %Y %H:%M:%S %Z"
         ).isoformat(sep=" ", timespec="seconds")
 
         game = Game(
-            name=game_soup.get_name(),
-            description=game_soup.get_description(),
-            url=game_soup.get_url(),
-            image=game_soup.get_image(),
-            price=game_soup.get_price(),
-            review_count=game_soup.get_review_count(),
-            review_summary=game_soup.get_review_summary(),
+            **await self.parse_pool.run(self.extractor.get_game_fields, markup),
             date_created=date_as_iso,
         )
 
@@ -59,6 +59,52 @@ class System(commands.Cog, name="system"):
             await self.reload_extension(ext)
             await ctx.reply(f"Reloaded {ext}.")
 
+    @system.group(name="sql")
+    async def sql(self, ctx):
+        pass
+
+    def get_sqlite(self):
+        # Extensions are reloaded independently of the system cog, so the
+        # sqlite cog is looked up on use instead of imported
+        sqlite = self.bot.get_cog("sqlite")
+        if not sqlite:
+            raise commands.BadArgument("The sqlite extension is not loaded.")
+        return sqlite
+
+    @sql.command(name="stats")
+    async def sql_stats(self, ctx, limit: int = 10):
+        await ctx.reply(self.get_sqlite().format_stats(limit)[:2000])
+
+    @sql.command(name="reset")
+    async def sql_reset(self, ctx):
+        self.get_sqlite().stats.reset()
+        await ctx.reply("Reset SQL statement stats.")
+
+    @system.group(name="backup", invoke_without_command=True)
+    async def backup(self, ctx):
+        backups = self.get_sqlite().backups
+        if backups.running:
+            raise commands.BadArgument("A backup is already running.")
+        async with ctx.typing():
+            stats = await backups.run()
+            await ctx.reply(stats.format()[:2000])
+
+    @backup.command(name="list")
+    async def backup_list(self, ctx):
+        await ctx.reply(self.get_sqlite().backups.format()[:2000])
+
+    @system.group(name="steam")
+    async def steam(self, ctx):
+        pass
+
+    @steam.command(name="stats")
+    async def steam_stats(self, ctx):
+        # steam cog is looked up on use instead of imported
+        steam = self.bot.get_cog("steam")
+        if not steam:
+            raise commands.BadArgument("The steam extension is not loaded.")
+        await ctx.reply(steam.format_stats()[:2000])
+
     async def load_extensions(self):
         print("Loading extensions...")
         exts = await get_extensions()